@@ -0,0 +1,114 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It measures the memory and the time of FilterByBam.
+
+A BAM sorted by name with half of the reads mapped is created and all the
+reads are filtered, in packets, with the mapped names kept in an id set and
+read along with the reads from the sorted BAM. Every mode runs in its own
+process.
+
+usage: python bench_bam_filter.py [num_reads]
+'''
+
+import sys
+import resource
+import subprocess
+from time import time
+from tempfile import NamedTemporaryFile
+
+import pysam
+
+from crumbs.filters import FilterByBam
+from crumbs.seq import SeqItem, SeqWrapper
+from crumbs.utils.tags import SEQITEM, SEQS_PASSED, SEQS_FILTERED_OUT
+
+_PACKET_SIZE = 1000
+
+
+def _get_max_rss():
+    'It returns the maximum resident memory of the process in bytes'
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _create_names(num_reads):
+    for idx in xrange(num_reads):
+        yield 'HWI-ST1234:8:1101:{}:{}'.format(idx, idx % 20000)
+
+
+def _write_bam(bam_fpath, num_reads):
+    header = {'HD': {'VN': '1.0', 'SO': 'queryname'},
+              'SQ': [{'SN': 'ref', 'LN': 1000}]}
+    bam = pysam.AlignmentFile(bam_fpath, 'wb', header=header)
+    for idx, name in enumerate(_create_names(num_reads)):
+        read = pysam.AlignedSegment()
+        read.query_name = name
+        read.query_sequence = 'ACGTACGTAC'
+        if idx % 2:
+            read.flag = 4
+            read.reference_id = -1
+        else:
+            read.reference_id = 0
+            read.reference_start = idx % 900
+            read.mapping_quality = 30
+            read.cigartuples = [(0, 10)]
+        bam.write(read)
+    bam.close()
+
+
+def _packets(num_reads):
+    packet = []
+    for name in _create_names(num_reads):
+        seq = SeqItem(name, ['@' + name + '\n', 'ACGTACGTAC\n', '+\n',
+                             'IIIIIIIIII\n'])
+        packet.append([SeqWrapper(SEQITEM, seq, 'fastq')])
+        if len(packet) == _PACKET_SIZE:
+            yield {SEQS_PASSED: packet, SEQS_FILTERED_OUT: []}
+            packet = []
+    if packet:
+        yield {SEQS_PASSED: packet, SEQS_FILTERED_OUT: []}
+
+
+def _measure(mode, bam_fpath, num_reads):
+    rss = _get_max_rss()
+    start = time()
+    filter_ = FilterByBam([bam_fpath], sorted_by_name=mode == 'sorted')
+    setup_secs = time() - start
+    passed = 0
+    for packet in _packets(num_reads):
+        passed += len(filter_(packet)[SEQS_PASSED])
+    secs = time() - start
+    assert passed == (num_reads + 1) // 2
+    msg = '{}: {:.0f} MB of extra peak memory, setup {:.1f} s, '
+    msg += 'total {:.1f} s'
+    print msg.format(mode, (_get_max_rss() - rss) / 2. ** 20, setup_secs,
+                     secs)
+
+
+def main():
+    if len(sys.argv) > 3:
+        _measure(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+        return
+    num_reads = sys.argv[1] if len(sys.argv) > 1 else '2000000'
+    bam_fhand = NamedTemporaryFile(suffix='.bam')
+    _write_bam(bam_fhand.name, int(num_reads))
+    print '{} reads'.format(num_reads)
+    for mode in ('id_set', 'sorted'):
+        subprocess.check_call([sys.executable, __file__, mode, bam_fhand.name,
+                               num_reads])
+
+
+if __name__ == '__main__':
+    main()
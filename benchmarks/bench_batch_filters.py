@@ -0,0 +1,79 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It compares the per seq and the batch implementations of the filters.
+
+Every filter is run on the same SeqBatch packets with the BATCH_FILTERS
+setting off and on. The time includes the creation of the columns.
+
+usage: python bench_batch_filters.py [fastq_fpath]
+'''
+
+import sys
+import random
+from time import time
+from cStringIO import StringIO
+
+from crumbs.seqio import read_seq_packets
+from crumbs.seq_batch import NUMPY_AVAILABLE
+from crumbs.filters import (FilterByLength, FilterByQuality, FilterAllNs,
+                            FilterDustComplexity, seq_to_filterpackets)
+from crumbs.settings import get_settings
+from crumbs.utils.tags import SEQS_PASSED
+
+
+def _create_fastq(num_reads=50000, read_len=150):
+    random.seed(42)
+    reads = []
+    for idx in xrange(num_reads):
+        seq = ''.join(random.choice('ACGTacgtN') for _ in xrange(read_len))
+        quals = ''.join(random.choice('#5?FIJ') for _ in xrange(read_len))
+        reads.append('@read_{}\n{}\n+\n{}\n'.format(idx, seq, quals))
+    return ''.join(reads)
+
+
+def _time_filter(filter_, fastq, batch_filters):
+    get_settings()['BATCH_FILTERS'] = batch_filters
+    packets = read_seq_packets([StringIO(fastq)], batches=True)
+    packets = list(seq_to_filterpackets(packets))
+    start = time()
+    n_passed = 0
+    for packet in packets:
+        n_passed += len(filter_(packet)[SEQS_PASSED])
+    return time() - start, n_passed
+
+
+def main():
+    if not NUMPY_AVAILABLE:
+        sys.exit('NumPy is required to run the batch filters')
+    if len(sys.argv) > 1:
+        fastq = open(sys.argv[1]).read()
+    else:
+        fastq = _create_fastq()
+    filters = [('length', FilterByLength(minimum=100, ignore_masked=True)),
+               ('quality', FilterByQuality(threshold=25)),
+               ('all Ns', FilterAllNs()),
+               ('dust', FilterDustComplexity())]
+    for name, filter_ in filters:
+        seq_secs, seq_passed = _time_filter(filter_, fastq, False)
+        batch_secs, batch_passed = _time_filter(filter_, fastq, True)
+        assert seq_passed == batch_passed
+        msg = '{}: per seq {:.2f} s, batch {:.2f} s, speedup {:.1f}x'
+        print msg.format(name, seq_secs, batch_secs, seq_secs / batch_secs)
+    get_settings()['BATCH_FILTERS'] = True
+
+
+if __name__ == '__main__':
+    main()
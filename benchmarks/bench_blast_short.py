@@ -0,0 +1,114 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It measures the time taken to look for two oligos in the reads.
+
+The reads are looked for in packets with a blast database of the reads
+created for every packet, like BlasterForFewSubjects does, with the
+OligoBlaster database of the oligos, created once, and with the in process
+OligoMatcher. A third of the reads have one of the oligos.
+It has not been run where it was written because blast is not installed
+there, so there are no timings to report yet.
+
+usage: python bench_blast_short.py [num_reads] [blast_threads]
+'''
+
+import sys
+import random
+from time import time
+
+from crumbs.blast import BlasterForFewSubjects, create_blast_short_blaster
+from crumbs.oligo_matcher import OligoMatcher
+from crumbs.seq import SeqItem, SeqWrapper, get_name
+from crumbs.seqio import write_seqs
+from crumbs.utils.tags import SEQITEM
+
+_PACKET_SIZE = 1000
+_OLIGOS = ['AAGCAGTGGTATCAACGCAGAGTACATGGG',
+           'AAGCAGTGGTATCAACGCAGAGTACTTTTT']
+
+
+def _create_seq(name, str_seq):
+    seq = SeqItem(name, ['>' + name + '\n', str_seq + '\n'])
+    return SeqWrapper(SEQITEM, seq, 'fasta')
+
+
+def _packets(num_reads):
+    random.seed(1)
+    packet = []
+    for idx in xrange(num_reads):
+        str_seq = ''.join(random.choice('ACGT') for _ in range(100))
+        if not idx % 3:
+            position = random.randint(0, 70)
+            oligo = _OLIGOS[idx % 2]
+            str_seq = str_seq[:position] + oligo + str_seq[position + 30:]
+        packet.append(_create_seq('read{}'.format(idx), str_seq))
+        if len(packet) == _PACKET_SIZE:
+            yield packet
+            packet = []
+    if packet:
+        yield packet
+
+
+class _BlastPerPacket(object):
+    'It creates a blast database of the reads for every packet'
+    def __init__(self, oligos):
+        self.oligos = oligos
+        self._blaster = None
+
+    def match_seqs(self, seqs):
+        db_fhand = write_seqs(seqs, file_format='fasta')
+        db_fhand.flush()
+        params = {'task': 'blastn-short', 'expect': '0.0001'}
+        filters = [{'kind': 'score_threshold', 'score_key': 'identity',
+                    'min_score': 87},
+                   {'kind': 'min_length', 'min_num_residues': 13,
+                    'length_in_query': False}]
+        self._blaster = BlasterForFewSubjects(db_fhand.name, self.oligos,
+                                              program='blastn',
+                                              filters=filters, params=params)
+
+    def get_matched_segments_for_read(self, read_name):
+        return self._blaster.get_matched_segments_for_read(read_name)
+
+
+def _measure(name, matcher, packets):
+    start = time()
+    matched = 0
+    for packet in packets:
+        matcher.match_seqs(packet)
+        for seq in packet:
+            if matcher.get_matched_segments_for_read(get_name(seq)):
+                matched += 1
+    print '{}: {} matched reads, {:.1f} s'.format(name, matched,
+                                                  time() - start)
+
+
+def main():
+    num_reads = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    blast_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    print '{} reads'.format(num_reads)
+    oligos = [_create_seq('oligo{}'.format(idx), oligo)
+              for idx, oligo in enumerate(_OLIGOS)]
+    packets = list(_packets(num_reads))
+    _measure('reads db per packet', _BlastPerPacket(oligos), packets)
+    _measure('oligos db', create_blast_short_blaster(oligos,
+                                                 num_threads=blast_threads),
+             packets)
+    _measure('in process', OligoMatcher(oligos), packets)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It measures the memory and the lookup time of the id sets.
+
+Every kind of set is created with the same read names in its own process.
+Half of the looked up names are in the set.
+
+usage: python bench_id_sets.py [num_ids]
+'''
+
+import os
+import sys
+import subprocess
+from time import time
+from tempfile import NamedTemporaryFile
+
+from crumbs.id_sets import HashedIdSet, create_id_set
+from crumbs.settings import get_settings
+
+_NUM_LOOKUPS = 200000
+
+
+def _get_rss():
+    'It returns the resident memory of the process in bytes'
+    with open('/proc/self/statm') as fhand:
+        return int(fhand.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _create_names(num_ids):
+    for idx in xrange(num_ids):
+        yield 'HWI-ST1234:8:1101:{}:{}'.format(idx, idx % 20000)
+
+
+def _measure(kind, num_ids):
+    rss = _get_rss()
+    start = time()
+    if kind == 'set':
+        id_set = set(_create_names(num_ids))
+    elif kind == 'hashed':
+        id_set = HashedIdSet.from_names(_create_names(num_ids))
+    else:
+        get_settings()['ID_BLOOM_BITS_PER_ID'] = 10 if kind == 'bloom' else 0
+        index_fhand = NamedTemporaryFile(suffix='.crumbs.ids')
+        id_set = create_id_set(_create_names(num_ids),
+                               index_fpath=index_fhand.name)
+    build_secs = time() - start
+    used = _get_rss() - rss
+
+    names = list(_create_names(_NUM_LOOKUPS // 2))
+    names += ['absent_{}'.format(idx) for idx in xrange(_NUM_LOOKUPS // 2)]
+    start = time()
+    found = sum(1 for name in names if name in id_set)
+    lookup_secs = time() - start
+    assert found == _NUM_LOOKUPS // 2
+    msg = '{}: {:.0f} bytes per id in memory, built in {:.1f} s, '
+    msg += '{:.1f} us per lookup'
+    print msg.format(kind, used / float(num_ids), build_secs,
+                     lookup_secs / _NUM_LOOKUPS * 1e6)
+
+
+def main():
+    if len(sys.argv) > 2:
+        _measure(sys.argv[1], int(sys.argv[2]))
+        return
+    num_ids = sys.argv[1] if len(sys.argv) > 1 else '2000000'
+    print '{} ids'.format(num_ids)
+    for kind in ('set', 'hashed', 'mapped', 'bloom'):
+        subprocess.check_call([sys.executable, __file__, kind, num_ids])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It measures the bytes sent to the workers with every filter_by_name packet.
+
+The multiprocessing pool pickles every task: the function to run and the
+packet. Before the filters were installed in the workers the function was
+the whole pipeline, a FilterById with every id included, now it is just a
+reference to a module function.
+
+usage: python bench_ipc_packets.py [num_ids]
+'''
+
+import sys
+from time import time
+from cPickle import dumps, HIGHEST_PROTOCOL
+from cStringIO import StringIO
+
+from crumbs.filters import FilterById, seq_to_filterpackets
+from crumbs.seqio import read_seq_packets
+from crumbs.utils.seq_utils import _FunctionRunner, _run_worker_functions
+
+
+def _create_packet(num_reads=1000, read_len=150):
+    'It returns a filter packet like the ones created by filter_by_name'
+    fastq = ''.join('@read_%i\n%s\n+\n%s\n' % (idx, 'A' * read_len,
+                                               'I' * read_len)
+                    for idx in xrange(num_reads))
+    seq_packets = read_seq_packets([StringIO(fastq)], size=num_reads)
+    return next(seq_to_filterpackets(seq_packets))
+
+
+def _measure_task(function, packet):
+    'It returns the size of the pickled pool task and the pickling time'
+    start = time()
+    # this is the task tuple that Pool.imap puts in its queue
+    task = dumps((0, 0, function, (packet,), {}), HIGHEST_PROTOCOL)
+    return len(task), time() - start
+
+
+def main():
+    num_ids = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    filter_ = FilterById(('read_%i' % idx for idx in xrange(0, num_ids * 2,
+                                                            2)))
+    packet = _create_packet()
+    packet_size = len(dumps(packet, HIGHEST_PROTOCOL))
+    print 'packet with 1000 reads: {} bytes'.format(packet_size)
+
+    msg = '{}: {} bytes per packet, {:.3f} s to pickle it'
+    runner = _FunctionRunner([filter_])
+    size, secs = _measure_task(runner, packet)
+    print msg.format('pipeline sent with every packet', size, secs)
+    # the packet is pickled by the parent before sending it
+    pickled_packet = dumps(packet, HIGHEST_PROTOCOL)
+    size, secs = _measure_task(_run_worker_functions, pickled_packet)
+    print msg.format('pipeline installed in the workers', size, secs)
+
+
+if __name__ == '__main__':
+    main()
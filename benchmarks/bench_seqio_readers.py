@@ -0,0 +1,76 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It compares the throughput of the line, block and mmap SeqItem readers.
+
+Every reader is timed reading the file and reading and writing it back, the
+usual case for filters in which most reads pass unchanged.
+
+usage: python bench_seqio_readers.py [num_reads]
+'''
+
+import sys
+import os
+import random
+from time import time
+from tempfile import NamedTemporaryFile
+
+from crumbs.seqio import read_seqs, write_seqs
+from crumbs.utils.tags import LINE_READER, BLOCK_READER, MMAP_READER
+
+
+def _create_fastq(num_reads, read_len=150):
+    'It writes a fastq file with random reads'
+    fhand = NamedTemporaryFile(suffix='.fastq')
+    qual = 'I' * read_len + '\n'
+    for index in xrange(num_reads):
+        seq = ''.join(random.choice('ACTG') for _ in xrange(read_len))
+        fhand.write('@read_%i 1:N:0:ACGT\n%s\n+\n%s' % (index, seq, qual))
+    fhand.flush()
+    return fhand
+
+
+def _time_reader(fpath, reader):
+    'It returns the seconds required to read all seqs in the file'
+    start = time()
+    num_seqs = 0
+    for _ in read_seqs([open(fpath)], seqitem_reader=reader):
+        num_seqs += 1
+    return time() - start, num_seqs
+
+
+def _time_reader_writer(fpath, reader):
+    'It returns the seconds required to read and write all seqs'
+    start = time()
+    with open(os.devnull, 'w') as out_fhand:
+        write_seqs(read_seqs([open(fpath)], seqitem_reader=reader), out_fhand)
+    return time() - start
+
+
+def main():
+    num_reads = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    fhand = _create_fastq(num_reads)
+    megabytes = os.path.getsize(fhand.name) / 1024. / 1024.
+    for reader in (LINE_READER, BLOCK_READER, MMAP_READER):
+        secs, num_seqs = _time_reader(fhand.name, reader)
+        msg = '{}: {} reads in {:.2f} s ({:.1f} MB/s)'
+        print msg.format(reader, num_seqs, secs, megabytes / secs)
+        secs = _time_reader_writer(fhand.name, reader)
+        msg = '{}: read and written in {:.2f} s ({:.1f} MB/s)'
+        print msg.format(reader, secs, megabytes / secs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It measures the memory taken by a list of reads held as SeqItems.
+
+The reads are created like the fastq reader does it and they are kept in a
+list, like sorted_items or sample do, as SeqItems and as CompactSeqItems.
+Every kind is measured in its own process.
+
+usage: python bench_seqitem_memory.py [num_reads] [read_len]
+'''
+
+import os
+import sys
+import random
+import subprocess
+from time import time
+
+from crumbs.seq import SeqItem, SeqWrapper, compact_seqs, get_str_seq
+from crumbs.utils.tags import SEQITEM
+
+
+def _get_rss():
+    'It returns the resident memory of the process in bytes'
+    with open('/proc/self/statm') as fhand:
+        return int(fhand.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _create_reads(num_reads, read_len):
+    'It yields the reads with different seq and qual strings'
+    random.seed(42)
+    bases = ''.join(random.choice('ACGT') for _ in xrange(100000))
+    quals = ''.join(random.choice('#5?FIJ') for _ in xrange(100000))
+    max_start = len(bases) - read_len
+    for idx in xrange(num_reads):
+        start = idx % max_start
+        name = 'HWI-ST1234:8:1101:{}:{}'.format(idx, start)
+        lines = ['@' + name + ' 1:N:0:ACGTAC\n',
+                 bases[start:start + read_len] + '\n', '+\n',
+                 quals[start:start + read_len] + '\n']
+        yield SeqWrapper(SEQITEM, SeqItem(name, lines), 'fastq')
+
+
+def _measure(kind, num_reads, read_len):
+    reads = _create_reads(num_reads, read_len)
+    if kind == 'compact':
+        reads = compact_seqs(reads)
+    rss = _get_rss()
+    start = time()
+    reads = list(reads)
+    secs = time() - start
+    used = _get_rss() - rss
+    assert len(get_str_seq(reads[-1])) == read_len
+    msg = '{}: {:.1f} MB, {:.0f} bytes per read, {:.1f} s to create them'
+    print msg.format(kind, used / 1024. ** 2, used / float(num_reads), secs)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('seqitem', 'compact'):
+        _measure(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+        return
+    num_reads = sys.argv[1] if len(sys.argv) > 1 else '1000000'
+    read_len = sys.argv[2] if len(sys.argv) > 2 else '150'
+    print 'list of {} reads of {} bp'.format(num_reads, read_len)
+    for kind in ('seqitem', 'compact'):
+        subprocess.check_call([sys.executable, __file__, kind, num_reads,
+                               read_len])
+
+
+if __name__ == '__main__':
+    main()
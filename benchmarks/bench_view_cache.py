@@ -0,0 +1,81 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It shows the hit rates of the derived view cache in a chained pipeline.
+
+The reads are filtered by quality, trimmed by quality and by case, and the
+stats of the trimmed reads are calculated. The decoded qualities and the
+uppercase segments are only computed once for every SeqItem.
+
+usage: python bench_view_cache.py [fastq_fpath]
+'''
+
+import sys
+import random
+from time import time
+from cStringIO import StringIO
+
+from crumbs.seq import get_view_cache_stats, reset_view_cache_stats
+from crumbs.seqio import read_seq_packets
+from crumbs.filters import FilterByQuality
+from crumbs.trim import (TrimByQuality, TrimLowercasedLetters, TrimOrMask,
+                         seq_to_trim_packets)
+from crumbs.statistics import calculate_sequence_stats
+from crumbs.utils.tags import SEQS_PASSED, SEQS_FILTERED_OUT, ORPHAN_SEQS
+
+
+def _create_fastq(num_reads=20000, read_len=150):
+    random.seed(42)
+    reads = []
+    for idx in xrange(num_reads):
+        seq = ''.join(random.choice('ACGTacgt') for _ in xrange(read_len))
+        quals = ''.join(random.choice('#5?FIJ') for _ in xrange(read_len))
+        reads.append('@read_{}\n{}\n+\n{}\n'.format(idx, seq, quals))
+    return StringIO(''.join(reads))
+
+
+def _run_pipeline(fhand):
+    filter_ = FilterByQuality(threshold=20, ignore_masked=True)
+    trimmers = [TrimByQuality(window=5, threshold=20),
+                TrimLowercasedLetters(), TrimOrMask()]
+    trimmed_seqs = []
+    for packet in seq_to_trim_packets(read_seq_packets([fhand])):
+        filter_packet = filter_({SEQS_PASSED: packet[SEQS_PASSED],
+                                 SEQS_FILTERED_OUT: []})
+        packet = {SEQS_PASSED: filter_packet[SEQS_PASSED], ORPHAN_SEQS: []}
+        for trimmer in trimmers:
+            packet = trimmer(packet)
+        trimmed_seqs.extend(seq for pair in packet[SEQS_PASSED]
+                            for seq in pair)
+    calculate_sequence_stats(trimmed_seqs)
+
+
+def main():
+    if len(sys.argv) > 1:
+        fhand = open(sys.argv[1])
+    else:
+        fhand = _create_fastq()
+    reset_view_cache_stats()
+    start = time()
+    _run_pipeline(fhand)
+    print 'pipeline run in {:.2f} s'.format(time() - start)
+    for view, stats in sorted(get_view_cache_stats().items()):
+        msg = '{}: {} hits, {} misses, hit rate {:.1%}'
+        print msg.format(view, stats['hits'], stats['misses'],
+                         stats['hit_rate'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It looks for 3' adapters in the reads allowing errors.
+
+The adapter can be anywhere in the read and it can be cut by the read 3'
+end. The edit distances of the adapter against the reads are calculated
+with the Myers bit-parallel algorithm, for all the reads of a packet at once
+if NumPy is available, and the adapter start is found with a small dynamic
+programming alignment only for the reads with the adapter.
+NumPy is an optional requirement.
+'''
+
+try:
+    import numpy
+except ImportError:
+    # This is an optional requirement
+    numpy = None
+
+NEXTERA_ADAPTERS = ['CTGTCTCTTATACACATCT', 'AGATGTGTATAAGAGACAG']
+
+# the adapters that fit in an uint64 are looked for in all the reads at once
+_MAX_BATCH_ADAPTER_LENGTH = 64
+
+
+def _get_max_errors(length, error_rate):
+    return int(length * error_rate)
+
+
+def _myers_step(vp, vn, eq, mask, high, anchored=False):
+    '''It returns the vertical deltas of the next column.
+
+    It also returns if the last row score goes up and if it goes down.
+    It works with ints and with NumPy uint64 arrays. The text start is free,
+    so the first row is always 0, unless the alignment is anchored.
+    '''
+    xv = eq | vn
+    xh = ((((eq & vp) + vp) & mask) ^ vp) | eq
+    ph = vn | (~(xh | vp) & mask)
+    mh = vp & xh
+    score_up, score_down = ph & high, mh & high
+    ph = (ph << 1) & mask
+    if anchored:
+        ph |= 1
+    mh = (mh << 1) & mask
+    vp = mh | (~(xv | ph) & mask)
+    vn = ph & xv
+    return vp, vn, score_up, score_down
+
+
+def _get_peq(adapter):
+    'It returns the bit mask of the adapter positions of every letter'
+    peq = {}
+    for index, letter in enumerate(adapter.upper()):
+        bit = 1 << index
+        for case_letter in (letter, letter.lower()):
+            peq[case_letter] = peq.get(case_letter, 0) | bit
+    # an N in the read matches nothing
+    peq.pop('N', None)
+    peq.pop('n', None)
+    return peq
+
+
+def _search_in_seq(str_seq, adapter, max_errors):
+    '''It looks for the adapter in one read.
+
+    It returns the end of the first full adapter match with at most
+    max_errors, or None, and the vertical deltas of the last column.
+    '''
+    peq = _get_peq(adapter)
+    length = len(adapter)
+    mask = (1 << length) - 1
+    high = 1 << (length - 1)
+    vp, vn, score = mask, 0, length
+    match_end, match_score = None, None
+    for index, letter in enumerate(str_seq):
+        vp, vn, score_up, score_down = _myers_step(vp, vn, peq.get(letter, 0),
+                                                   mask, high)
+        if score_up:
+            score += 1
+        elif score_down:
+            score -= 1
+        # the match goes on while its score improves
+        if match_end is None:
+            if score <= max_errors:
+                match_end, match_score = index, score
+        elif match_end == index - 1 and score < match_score:
+            match_end, match_score = index, score
+    return match_end, vp, vn
+
+
+def _search_in_seqs(str_seqs, adapter, max_errors):
+    '''It looks for the adapter in all the reads at once.
+
+    It returns the same as _search_in_seq for every read. The reads are
+    the lanes of uint64 NumPy arrays and they are padded with letters that
+    do not match the adapter.
+    '''
+    if not str_seqs:
+        return []
+    length = len(adapter)
+    uint64 = numpy.uint64
+    mask = uint64((1 << length) - 1)
+    high = uint64(1 << (length - 1))
+    peq = numpy.zeros(256, dtype=uint64)
+    for letter, bits in _get_peq(adapter).items():
+        peq[ord(letter)] = bits
+
+    num_seqs = len(str_seqs)
+    lengths = numpy.fromiter((len(str_seq) for str_seq in str_seqs),
+                             dtype=numpy.int64, count=num_seqs)
+    max_length = int(lengths.max())
+    # the letters of the read position i of all the reads are in the row i
+    codes = numpy.zeros((max_length, num_seqs), dtype=numpy.uint8)
+    letters = numpy.frombuffer(''.join(str_seqs), dtype=numpy.uint8)
+    seq_indexes = numpy.repeat(numpy.arange(num_seqs), lengths)
+    starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    codes[numpy.arange(letters.size) - starts, seq_indexes] = letters
+
+    vp = numpy.full(num_seqs, mask, dtype=uint64)
+    vn = numpy.zeros(num_seqs, dtype=uint64)
+    last_vp, last_vn = vp.copy(), vn.copy()
+    score = numpy.full(num_seqs, length, dtype=numpy.int64)
+    match_ends = numpy.full(num_seqs, -1, dtype=numpy.int64)
+    match_scores = numpy.zeros(num_seqs, dtype=numpy.int64)
+    for index in range(max_length):
+        vp, vn, score_up, score_down = _myers_step(vp, vn, peq[codes[index]],
+                                                   mask, high)
+        score += score_up != 0
+        score -= score_down != 0
+        in_seq = lengths > index
+        first = in_seq & (match_ends < 0) & (score <= max_errors)
+        better = in_seq & (match_ends == index - 1) & (score < match_scores)
+        improved = first | better
+        match_ends[improved] = index
+        match_scores[improved] = score[improved]
+        ending = lengths == index + 1
+        last_vp[ending] = vp[ending]
+        last_vn[ending] = vn[ending]
+    return [(None if match_end < 0 else match_end, int(seq_vp), int(seq_vn))
+            for match_end, seq_vp, seq_vn in zip(match_ends.tolist(), last_vp,
+                                                 last_vn)]
+
+
+def _get_longest_partial_match(vp, vn, length, error_rate, min_overlap):
+    '''It returns the longest adapter prefix that ends at the read end.
+
+    The edit distances of the adapter prefixes against the read end are
+    the vertical deltas of the last column added.
+    '''
+    best, distance = None, 0
+    for index in range(length - 1):
+        bit = 1 << index
+        if vp & bit:
+            distance += 1
+        elif vn & bit:
+            distance -= 1
+        prefix_length = index + 1
+        if (prefix_length >= min_overlap and
+                distance <= _get_max_errors(prefix_length, error_rate)):
+            best = prefix_length
+    return best
+
+
+def _get_match_start(str_seq, adapter, match_end, max_errors):
+    '''It returns the read start of the adapter that ends in match_end.
+
+    The reversed adapter is aligned against the read going backwards from
+    match_end and the longest alignment with the minimum edit distance is
+    taken.
+    '''
+    length = len(adapter)
+    peq = _get_peq(adapter[::-1])
+    mask = (1 << length) - 1
+    high = 1 << (length - 1)
+    vp, vn, score = mask, 0, length
+    best_score, best_start = score, match_end + 1
+    first_start = max(match_end - length - max_errors + 1, 0)
+    for start in range(match_end, first_start - 1, -1):
+        vp, vn, score_up, score_down = _myers_step(vp, vn,
+                                                   peq.get(str_seq[start], 0),
+                                                   mask, high, anchored=True)
+        if score_up:
+            score += 1
+        elif score_down:
+            score -= 1
+        if score <= best_score:
+            best_score, best_start = score, start
+    return best_start
+
+
+def find_adapter_starts(str_seqs, adapters, error_rate=0.1, min_overlap=3):
+    '''It returns the start of the first adapter of every read.
+
+    The adapters can have an error rate of edit distance and they can be
+    partially in the 3' end of the read if at least min_overlap residues
+    are found. It returns None for the reads without adapter.
+    '''
+    adapter_starts = [None] * len(str_seqs)
+    for adapter in adapters:
+        length = len(adapter)
+        max_errors = _get_max_errors(length, error_rate)
+        if numpy is not None and length <= _MAX_BATCH_ADAPTER_LENGTH:
+            matches = _search_in_seqs(str_seqs, adapter, max_errors)
+        else:
+            matches = [_search_in_seq(str_seq, adapter, max_errors)
+                       for str_seq in str_seqs]
+        for index, (match_end, vp, vn) in enumerate(matches):
+            str_seq = str_seqs[index]
+            matched_adapter, match_max_errors = adapter, max_errors
+            if match_end is None:
+                prefix_length = _get_longest_partial_match(vp, vn, length,
+                                                           error_rate,
+                                                           min_overlap)
+                if prefix_length is None:
+                    continue
+                matched_adapter = adapter[:prefix_length]
+                match_end = len(str_seq) - 1
+                match_max_errors = _get_max_errors(prefix_length,
+                                                   error_rate)
+            start = _get_match_start(str_seq, matched_adapter, match_end,
+                                     match_max_errors)
+            if adapter_starts[index] is None or start < adapter_starts[index]:
+                adapter_starts[index] = start
+    return adapter_starts
@@ -0,0 +1,199 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''An on disk cache of parsed alignment results.
+
+The results are stored by key in a sqlite database, marshaled and
+compressed. The key should identify the query and the search, for
+instance a hash of the query sequence and of the database and parameters
+used. A result can be None, for the queries without matches. The size of
+the stored results is limited and the least recently used ones are removed
+when it is exceeded. The database can be shared by several processes and
+it keeps the number of hits, misses and evictions.
+'''
+
+import os
+import zlib
+import marshal
+import sqlite3
+from time import time
+
+from crumbs.settings import get_setting
+
+# maximum number of keys in a sqlite query
+_MAX_KEYS_PER_QUERY = 500
+
+_STATS = ('hits', 'misses', 'evictions', 'size')
+
+
+def _encode_result(result):
+    return buffer(zlib.compress(marshal.dumps(result), 1))
+
+
+def _decode_result(blob):
+    return marshal.loads(zlib.decompress(blob))
+
+
+class AlignmentCache(object):
+    'It stores the alignment results in a size bounded LRU cache on disk'
+    def __init__(self, fpath, max_size=None):
+        '''It inits the class.
+
+        fpath - The sqlite database, it is created if it does not exist
+        max_size - Maximum size of the stored results in bytes, by default
+                   the ALIGNMENT_CACHE_MAX_SIZE setting
+        '''
+        self.fpath = os.path.abspath(fpath)
+        if max_size is None:
+            max_size = get_setting('ALIGNMENT_CACHE_MAX_SIZE')
+        self.max_size = max_size
+        self._conn = None
+        self._conn_pid = None
+        self._new_results = []
+        self._get_conn()
+
+    def __getstate__(self):
+        # every process opens its own connection
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_new_results'] = []
+        return state
+
+    def _get_conn(self):
+        'It returns the sqlite connection of this process'
+        if self._conn is not None and self._conn_pid == os.getpid():
+            return self._conn
+        # the transactions are started explicitly
+        conn = sqlite3.connect(self.fpath, timeout=600, isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('''CREATE TABLE IF NOT EXISTS results(
+                            key TEXT PRIMARY KEY, result BLOB,
+                            size INTEGER, last_used REAL)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS results_last_used
+                        ON results(last_used)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS stats(
+                            name TEXT PRIMARY KEY, value INTEGER)''')
+        conn.executemany('INSERT OR IGNORE INTO stats VALUES (?, 0)',
+                         [(stat,) for stat in _STATS])
+        conn.execute('COMMIT')
+        self._conn = conn
+        self._conn_pid = os.getpid()
+        return conn
+
+    def _add_to_stats(self, conn, **values):
+        conn.executemany('UPDATE stats SET value = value + ? WHERE name = ?',
+                         [(value, name) for name, value in values.items()])
+
+    def get_results(self, keys):
+        '''It returns a dict with the stored results of the given keys.
+
+        The keys not found are missing from the dict. The results found are
+        marked as recently used.
+        '''
+        keys = list(set(keys))
+        conn = self._get_conn()
+        results = {}
+        now = time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for start in range(0, len(keys), _MAX_KEYS_PER_QUERY):
+                some_keys = keys[start:start + _MAX_KEYS_PER_QUERY]
+                select = 'SELECT key, result FROM results WHERE key IN ({})'
+                select = select.format(', '.join('?' * len(some_keys)))
+                for key, blob in conn.execute(select, some_keys):
+                    results[key] = _decode_result(blob)
+            conn.executemany('UPDATE results SET last_used = ? WHERE key = ?',
+                             [(now, key) for key in results])
+            self._add_to_stats(conn, hits=len(results),
+                               misses=len(keys) - len(results))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return results
+
+    def add_result(self, key, result):
+        '''It adds a result to the cache.
+
+        The result is encoded when it is added, so it can be modified
+        afterwards, but it is not stored until flush is called.
+        '''
+        self._new_results.append((key, _encode_result(result)))
+
+    def flush(self):
+        'It stores the added results and it removes the least recently used'
+        if not self._new_results:
+            return
+        conn = self._get_conn()
+        now = time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            size = 0
+            for key, blob in self._new_results:
+                insert = 'INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)'
+                if conn.execute(insert, (key, blob, len(blob), now)).rowcount:
+                    size += len(blob)
+            self._add_to_stats(conn, size=size)
+            self._evict(conn)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._new_results = []
+
+    def _evict(self, conn):
+        'It removes the least recently used results that do not fit'
+        select = "SELECT value FROM stats WHERE name = 'size'"
+        excess = conn.execute(select).fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        evicted, size = [], 0
+        select = 'SELECT key, size FROM results ORDER BY last_used'
+        cursor = conn.execute(select)
+        for key, result_size in cursor:
+            if size >= excess:
+                break
+            evicted.append((key,))
+            size += result_size
+        cursor.close()
+        conn.executemany('DELETE FROM results WHERE key = ?', evicted)
+        self._add_to_stats(conn, size=-size, evictions=len(evicted))
+
+    def get_stats(self):
+        '''It returns the hits, misses, evictions and the size stored.
+
+        They are the numbers of all the processes since the stats were
+        reset. The hit rate is also returned.
+        '''
+        conn = self._get_conn()
+        select = 'SELECT name, value FROM stats'
+        stats = {str(name): value for name, value in conn.execute(select)}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else None
+        stats['num_results'] = conn.execute('SELECT COUNT(*) FROM results'
+                                            ).fetchone()[0]
+        return stats
+
+    def reset_stats(self):
+        'It sets the hits, misses and evictions to zero'
+        conn = self._get_conn()
+        conn.execute("UPDATE stats SET value = 0 WHERE name != 'size'")
+
+    def close(self):
+        'It stores the added results and it closes the database'
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self.flush()
+            self._conn.close()
+        self._conn = None
@@ -217,7 +217,7 @@ class PolyaAnnotator(object):
 class BlastAnnotator(object):
     'It annotates using blast'
     def __init__(self, blastdb, program, dbtype=None, filters=None,
-                 params=None, remote=False):
+                 params=None, remote=False, cache=None):
         'Initializes the class'
         self.blastdb = blastdb
         self._program = program
@@ -225,6 +225,7 @@ class BlastAnnotator(object):
         self._params = params
         self._dbtype = dbtype
         self._remote = remote
+        self._cache = cache
 
     def __call__(self, seqrecords):
         'It does the work'
@@ -232,7 +233,8 @@ class BlastAnnotator(object):
             return seqrecords
         matcher = Blaster(seqrecords, self.blastdb, self._program,
                                self._dbtype, filters=self._filters,
-                               params=self._params, remote=self._remote)
+                               params=self._params, remote=self._remote,
+                               cache=self._cache)
         blasts = matcher.blasts
         blastdb = os.path.basename(self.blastdb)
         for seqrecord in seqrecords:
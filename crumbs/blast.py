@@ -13,15 +13,24 @@
 # You should have received a copy of the GNU General Public License
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import division
+
 import os.path
 import subprocess
 import tempfile
+import hashlib
+import Queue
+from glob import glob
+from threading import Thread
+from multiprocessing import cpu_count
 
 from crumbs.utils.optional_modules import NCBIWWW
 from crumbs.seqio import seqio, guess_seq_type, write_seqs
+from crumbs.seq import (get_length, get_name, get_str_seq, SeqItem,
+                        SeqWrapper)
 from crumbs.utils.bin_utils import (check_process_finishes, popen,
                                     get_binary_path)
-from crumbs.utils.tags import NUCL, PROT
+from crumbs.utils.tags import NUCL, PROT, SEQITEM
 from crumbs.alignment_result import (filter_alignments, ELONGATED, QUERY,
                                      covered_segments_from_match_parts,
                                      elongate_match_parts_till_global,
@@ -43,6 +52,11 @@ TASKS = {'blastn': ('megablast', 'blastn', 'blastn-short', 'dc-megablast',
 
 REMOTE_BLAST_DBS = ['nt', 'nr']
 
+_TABBLAST_FORMAT_WITH_LENGTHS = ['query', 'subject', 'query_length',
+                                 'subject_length', 'query_start', 'query_end',
+                                 'subject_start', 'subject_end', 'expect',
+                                 'identity']
+
 
 def generate_tabblast_format(fmt):
     'Given a list with fields with our names it return one with the blast ones'
@@ -175,8 +189,8 @@ def do_blast(query_fpath, db_fpath, program, out_fpath, params=None,
                         params=params)
 
 
-def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
-    'It does a blast'
+def _create_blast_cmd(query_fpath, db_fpath, program, params=None):
+    'It returns the blast command line, the output is written to stdout'
     if not params:
         params = {}
     evalue, task = _parse_blast_params(params, program)
@@ -190,19 +204,236 @@ def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
     if program not in ('blastn', 'blastp', 'blastx', 'tblastx', 'tblastn'):
         raise ValueError('The given program is invalid: ' + str(program))
     binary = get_binary_path(program)
-    cmd = [binary, '-query', query_fpath, '-db', db_fpath, '-out', out_fpath]
+    cmd = [binary, '-query', query_fpath, '-db', db_fpath]
     cmd.extend(['-evalue', str(evalue), '-outfmt', str(outfmt)])
     if task:
         cmd.extend(['-task', task])
     if params:
         for key, value in params.viewitems():
             cmd.extend(('-' + key, str(value)))
+    return cmd
+
+
+def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
+    'It does a blast'
+    cmd = _create_blast_cmd(query_fpath, db_fpath, program, params=params)
+    cmd.extend(['-out', out_fpath])
     process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     check_process_finishes(process, binary=cmd[0])
 
 
+def get_blast_threads(processes, threads=None, workers=1):
+    '''It returns the blast processes and threads to use by every worker.
+
+    By default every blast process uses one thread. The threads of the
+    blasts of all the workers are limited to BLAST_MAX_THREADS, or to the
+    number of CPUs, and there are not more processes than threads.
+    '''
+    max_threads = get_setting('BLAST_MAX_THREADS')
+    max_threads = cpu_count() if not max_threads else int(max_threads)
+    if threads is None:
+        threads = processes
+    threads = max(min(threads, max_threads // workers), 1)
+    return min(processes, threads), threads
+
+
+def _feed_blast(stdin, seqs, errors):
+    'It writes the seqs to the blast stdin'
+    try:
+        write_seqs(seqs, stdin, file_format='fasta')
+        stdin.close()
+    except IOError, error:
+        # blast has died, the reader will report it
+        errors.append(error)
+
+
+def _blast_chunk(cmd, seqs, out_queue):
+    'It blasts the seqs through stdin and it queues the output lines'
+    stderr = tempfile.NamedTemporaryFile(suffix='.stderr')
+    process = popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=stderr, bufsize=-1)
+    feeder_errors = []
+    feeder = Thread(target=_feed_blast,
+                    args=(process.stdin, seqs, feeder_errors))
+    feeder.daemon = True
+    feeder.start()
+    for line in iter(process.stdout.readline, ''):
+        out_queue.put(line)
+    feeder.join()
+    # the feeder has already closed stdin
+    process.stdin = None
+    check_process_finishes(process, binary=cmd[0], stderr=stderr)
+    if feeder_errors:
+        raise feeder_errors[0]
+
+
+def _run_blast_chunk(cmd, seqs, out_queue):
+    'It blasts the chunk and it queues the end of the output or the error'
+    try:
+        _blast_chunk(cmd, seqs, out_queue)
+    except Exception, error:
+        # the error is raised by the reader of the output
+        out_queue.put(error)
+        return
+    out_queue.put(None)
+
+
+def _iter_chunk_lines(out_queues):
+    'It yields the output lines of the chunks in order'
+    for out_queue in out_queues:
+        while True:
+            line = out_queue.get()
+            if line is None:
+                break
+            if isinstance(line, Exception):
+                raise line
+            yield line
+
+
+def _split_in_chunks(seqs, num_chunks):
+    'It splits the seqs in consecutive chunks of similar sizes'
+    chunk_size, rest = divmod(len(seqs), num_chunks)
+    chunks = []
+    start = 0
+    for index in range(num_chunks):
+        end = start + chunk_size + (1 if index < rest else 0)
+        chunks.append(seqs[start:end])
+        start = end
+    return chunks
+
+
+def _do_blast_in_chunks(queries, db_fpath, program, params=None,
+                        processes=1, threads=None):
+    '''It blasts the queries split in chunks by concurrent blast processes.
+
+    Every blast process gets a chunk and a share of the threads, so there
+    are not more processes than threads. It returns an iterator with the
+    output lines in query order, the lines of every chunk are yielded while
+    blast writes them.
+    '''
+    queries = list(queries)
+    if not queries:
+        return iter([])
+    if threads is None:
+        threads = processes
+    # every blast process uses at least one thread
+    chunks = _split_in_chunks(queries, min(processes, threads, len(queries)))
+    num_chunks = len(chunks)
+    params = {} if params is None else params
+    cmds = []
+    for index in range(num_chunks):
+        chunk_params = params.copy()
+        if 'num_threads' not in chunk_params:
+            threads_share = threads // num_chunks
+            threads_share += 1 if index < threads % num_chunks else 0
+            chunk_params['num_threads'] = threads_share
+        cmds.append(_create_blast_cmd('-', db_fpath, program,
+                                      params=chunk_params))
+
+    out_queues = []
+    for cmd, chunk in zip(cmds, chunks):
+        out_queue = Queue.Queue()
+        runner = Thread(target=_run_blast_chunk, args=(cmd, chunk, out_queue))
+        runner.daemon = True
+        runner.start()
+        out_queues.append(out_queue)
+    return _iter_chunk_lines(out_queues)
+
+
+def _get_cache_keys(queries, db_fpath, program, params, blast_format):
+    '''It returns the alignment cache key of every query.
+
+    It is a hash of the query sequence, the database path and modification
+    time, the program, the params and the blast format.
+    '''
+    db_fpath = os.path.abspath(db_fpath)
+    db_fpaths = glob(db_fpath + '.*')
+    if os.path.exists(db_fpath):
+        db_fpaths.append(db_fpath)
+    db_mtime = max(os.path.getmtime(fpath) for fpath in db_fpaths)
+    # the threads do not change the result
+    params = sorted((key, str(value)) for key, value in params.items()
+                    if key != 'num_threads')
+    blast_hash = hashlib.sha1(repr((db_fpath, db_mtime, program, params,
+                                    blast_format)))
+    keys = []
+    for query in queries:
+        query_hash = blast_hash.copy()
+        query_hash.update(get_str_seq(query))
+        keys.append(query_hash.hexdigest())
+    return keys
+
+
+# the queries not found in the cache are blasted with these names, so the
+# result of every query is cached with its key even if the names are repeated
+_MISSED_QUERY_NAME = 'crumbs_query_{}'
+
+
+def _rename_missed_query(query, index):
+    'It returns a fasta SeqItem with the query seq and a unique name'
+    name = _MISSED_QUERY_NAME.format(index)
+    lines = ['>' + name + '\n', get_str_seq(query) + '\n']
+    return SeqWrapper(SEQITEM, SeqItem(name, lines), 'fasta')
+
+
+def _do_cached_blast(queries, db_fpath, program, params, blast_format, cache,
+                     processes=1, threads=None):
+    '''It returns the blast results found in the cache and blasts the rest.
+
+    The results of the blasted queries, and the queries without matches, are
+    added to the cache.
+    '''
+    queries = list(queries)
+    keys = _get_cache_keys(queries, db_fpath, program, params, blast_format)
+    cached_results = cache.get_results(keys)
+    found_results, missed_queries, missed = [], [], {}
+    for query, key in zip(queries, keys):
+        name = get_name(query)
+        # a result found is used only once, repeated queries are blasted
+        if key in cached_results:
+            result = cached_results.pop(key)
+            if result is not None:
+                result['query']['name'] = name
+                found_results.append(result)
+        else:
+            missed_query = _rename_missed_query(query, len(missed_queries))
+            missed_queries.append(missed_query)
+            missed[get_name(missed_query)] = name, key
+    lines = _do_blast_in_chunks(missed_queries, db_fpath, program,
+                                params=params, processes=processes,
+                                threads=threads)
+    blasts = TabularBlastParser(lines, blast_format)
+    return _iter_cached_blasts(found_results, blasts, missed, cache)
+
+
+def _iter_cached_blasts(found_results, blasts, missed, cache):
+    '''It yields the results found and the blasted ones, that are cached.
+
+    missed has the name and the cache key of every blasted query by the
+    name used in the blast.
+    '''
+    for result in found_results:
+        yield result
+    unknown_names = False
+    for result in blasts:
+        blasted_name = result['query']['name']
+        if blasted_name in missed:
+            name, key = missed.pop(blasted_name)
+            result['query']['name'] = name
+            cache.add_result(key, result)
+        else:
+            unknown_names = True
+        yield result
+    # if blast has changed a name we do not know which queries had no match
+    if not unknown_names:
+        for _, key in missed.values():
+            cache.add_result(key, None)
+    cache.flush()
+
+
 def _do_blast_2(db_fpath, queries, program, dbtype=None, blast_format=None,
-                params=None, remote=False):
+                params=None, remote=False, processes=1, threads=None,
+                cache=None):
     '''It returns an alignment result with the blast.
 
     It is an alternative interface to the one based on fpaths.
@@ -210,34 +441,42 @@ def _do_blast_2(db_fpath, queries, program, dbtype=None, blast_format=None,
     queries should be a SeqRecord list.
     If an alternative blast output format is given it should be tabular, so
     blast_format is a list of fields.
+    The local blast is done by processes concurrent blasts that share the
+    threads and its result is parsed while blast writes it, so there is no
+    blast file to return.
+    If an AlignmentCache is given only the queries not found in it are
+    blasted by the local blast. The database is identified in the cache by
+    the path and modification time of the blast database.
     '''
-
-    query_fhand = write_seqs(queries, file_format='fasta')
-    query_fhand.flush()
-
     if remote:
         blastdb = db_fpath
         fmt = 'XML' if blast_format is None else blast_format.upper()
     else:
         blastdb = get_or_create_blastdb(db_fpath, dbtype=dbtype)
         if blast_format is None:
-            blast_format = ['query', 'subject', 'query_length', 'subject_length',
-                            'query_start', 'query_end', 'subject_start',
-                            'subject_end', 'expect', 'identity', ]
+            blast_format = _TABBLAST_FORMAT_WITH_LENGTHS
         fmt = generate_tabblast_format(blast_format)
 
     if params is None:
         params = {}
     params['outfmt'] = fmt
 
+    if not remote and cache is not None:
+        blasts = _do_cached_blast(queries, blastdb, program, params,
+                                  blast_format, cache, processes=processes,
+                                  threads=threads)
+        return blasts, None
+    elif not remote:
+        lines = _do_blast_in_chunks(queries, blastdb, program, params=params,
+                                    processes=processes, threads=threads)
+        return TabularBlastParser(lines, blast_format), None
+
+    query_fhand = write_seqs(queries, file_format='fasta')
+    query_fhand.flush()
     blast_fhand = tempfile.NamedTemporaryFile(suffix='.blast')
     do_blast(query_fhand.name, blastdb, program, blast_fhand.name, params,
              remote=remote)
-    if remote:
-        blasts = BlastParser(blast_fhand)
-    else:
-        blasts = TabularBlastParser(blast_fhand, blast_format)
-
+    blasts = BlastParser(blast_fhand)
     return blasts, blast_fhand
 
 
@@ -273,61 +512,233 @@ class BlasterForFewSubjects(object):
 
     def _look_for_blast_matches(self, seq_fpath, oligos, seqs_type):
         'It looks for the oligos in the given sequence files'
-        # we need to keep the blast_fhands, because they're temp files and
-        # otherwise they might be removed
         temp_dir = TemporaryDir()
         dbpath = os.path.join(temp_dir.name, os.path.basename(seq_fpath))
         seqio([open(seq_fpath)], open(dbpath, 'w'), out_format='fasta',
               copy_if_same_format=False)
 
-        blasts, blast_fhand = _do_blast_2(dbpath, oligos, params=self.params,
-                                          program=self.program,
-                                          dbtype=seqs_type)
+        blasts = _do_blast_2(dbpath, oligos, params=self.params,
+                             program=self.program, dbtype=seqs_type)[0]
         if self.filters is not None:
             blasts = filter_alignments(blasts, config=self.filters)
 
-        # Which are the regions covered in each sequence?
-        indexed_match_parts = {}
-        for blast in blasts:
-            oligo = blast['query']
-            for match in blast['matches']:
-                read = match['subject']
-                if self.elongate_for_global:
-                    elongate_match_parts_till_global(match['match_parts'],
+        indexed_match_parts = _index_match_parts_by_subject(blasts,
+                                                self.elongate_for_global)
+        temp_dir.close()
+        return indexed_match_parts
+
+    def get_matched_segments_for_read(self, read_name):
+        'It returns the matched segments for any oligo'
+        try:
+            match_parts = self._match_parts[read_name]
+        except KeyError:
+            # There was no match in the blast
+            return None
+        return get_read_matched_segments(match_parts)
+
+
+def _index_match_parts_by_subject(blasts, elongate_for_global):
+    '''It returns the match parts of the oligo queries for every read.
+
+    The match parts can be elongated to cover the whole oligo.
+    '''
+    # Which are the regions covered in each sequence?
+    indexed_match_parts = {}
+    for blast in blasts:
+        oligo = blast['query']
+        for match in blast['matches']:
+            read = match['subject']
+            if elongate_for_global:
+                elongate_match_parts_till_global(match['match_parts'],
                                                  query_length=oligo['length'],
                                                  subject_length=read['length'],
                                                  align_completely=QUERY)
 
-                # match_parts = [m['match_parts'] for m in blast['matches']]
-                match_parts = match['match_parts']
-                try:
-                    indexed_match_parts[read['name']].extend(match_parts)
-                except KeyError:
-                    indexed_match_parts[read['name']] = match_parts
+            # match_parts = [m['match_parts'] for m in blast['matches']]
+            match_parts = match['match_parts']
+            try:
+                indexed_match_parts[read['name']].extend(match_parts)
+            except KeyError:
+                indexed_match_parts[read['name']] = match_parts
+    return indexed_match_parts
 
-        temp_dir.close()
-        blast_fhand.close()
-        return indexed_match_parts
+
+def _swap_match_part(match_part):
+    '''It returns the match part with the query as subject.
+
+    The query coordinates are kept forward, like blast does.
+    '''
+    swapped = {'query_start': match_part['subject_start'],
+               'query_end': match_part['subject_end'],
+               'subject_start': match_part['query_start'],
+               'subject_end': match_part['query_end'],
+               'scores': match_part['scores']}
+    if swapped['query_start'] > swapped['query_end']:
+        for start, end in (('query_start', 'query_end'),
+                           ('subject_start', 'subject_end')):
+            swapped[start], swapped[end] = swapped[end], swapped[start]
+    return swapped
+
+
+def _swap_queries_and_subjects(blasts):
+    '''It yields a blast for every match with the subject as query.
+
+    The blast of the reads against the oligos are given as if the oligos
+    had been blasted against the reads.
+    '''
+    for blast in blasts:
+        read = blast['query']
+        for match in blast['matches']:
+            match_parts = [_swap_match_part(match_part)
+                           for match_part in match['match_parts']]
+            swapped_match = {'subject': read,
+                             'start': min(mp['query_start']
+                                          for mp in match_parts),
+                             'end': max(mp['query_end'] for mp in match_parts),
+                             'subject_start': match['start'],
+                             'subject_end': match['end'],
+                             'scores': match['scores'],
+                             'match_parts': match_parts}
+            yield {'query': match['subject'], 'matches': [swapped_match]}
+
+
+class OligoBlaster(object):
+    '''It looks for a few oligos in the packets of reads with blast.
+
+    It has the OligoMatcher interface. The blast database is created with
+    the oligos once, when the class is created, and it is used by all the
+    processes. The reads of every packet are blasted against it through the
+    blast stdin and the results are parsed while blast writes them. They
+    are given as if the oligos had been blasted against the reads, like in
+    BlasterForFewSubjects, so the same filters can be used.
+    '''
+    def __init__(self, oligos, program='blastn', params=None, filters=None,
+                 elongate_for_global=False, num_threads=1):
+        '''It inits the class.
+
+        params - The blast parameters. By default the database size is set
+                 to get the expects of a blast of the oligos against the
+                 packet and the reads are not masked by dust
+        num_threads - The threads used by every blast
+        '''
+        self._db_dir = None
+        self.program = program
+        self.params = {} if params is None else params
+        self.filters = [] if filters is None else filters
+        self.elongate_for_global = elongate_for_global
+        self.num_threads = num_threads
+        oligos = list(oligos)
+        self._num_oligos = len(oligos)
+        self._mean_oligo_length = (sum(get_length(oligo) for oligo in oligos) /
+                                   len(oligos))
+        self._match_parts = {}
+
+        self._db_dir = TemporaryDir()
+        self._db_dir_pid = os.getpid()
+        oligos_fpath = os.path.join(self._db_dir.name, 'oligos.fasta')
+        oligos_fhand = open(oligos_fpath, 'w')
+        write_seqs(oligos, oligos_fhand, file_format='fasta')
+        oligos_fhand.close()
+        self._blastdb = get_or_create_blastdb(oligos_fpath)
+
+    def _create_cmd(self, num_seqs):
+        params = self.params.copy()
+        params['outfmt'] = generate_tabblast_format(
+                                                _TABBLAST_FORMAT_WITH_LENGTHS)
+        params['max_target_seqs'] = self._num_oligos
+        params['num_threads'] = self.num_threads
+        if 'dbsize' not in params:
+            # the search space of every oligo in the packet
+            params['dbsize'] = int(self._mean_oligo_length * num_seqs) + 1
+        if 'dust' not in params:
+            # the reads are the queries, but they were not masked when they
+            # were the subjects
+            params['dust'] = 'no'
+        return _create_blast_cmd('-', self._blastdb, self.program,
+                                 params=params)
+
+    def match_seqs(self, seqs):
+        '''It looks for the oligos in the given reads.
+
+        The matches of the previous reads are forgotten.
+        '''
+        self._match_parts = {}
+        seqs = list(seqs)
+        if not seqs:
+            return
+        cmd = self._create_cmd(len(seqs))
+        stderr = tempfile.NamedTemporaryFile(suffix='.stderr')
+        process = popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        stderr=stderr, bufsize=-1)
+        feeder_errors = []
+        feeder = Thread(target=_feed_blast,
+                        args=(process.stdin, seqs, feeder_errors))
+        feeder.daemon = True
+        feeder.start()
+
+        blasts = TabularBlastParser(iter(process.stdout.readline, ''),
+                                    _TABBLAST_FORMAT_WITH_LENGTHS)
+        blasts = filter_alignments(_swap_queries_and_subjects(blasts),
+                                   config=self.filters)
+        match_parts = _index_match_parts_by_subject(blasts,
+                                                    self.elongate_for_global)
+        feeder.join()
+        # the feeder has already closed stdin
+        process.stdin = None
+        check_process_finishes(process, binary=cmd[0], stderr=stderr)
+        if feeder_errors:
+            raise feeder_errors[0]
+        self._match_parts = match_parts
 
     def get_matched_segments_for_read(self, read_name):
         'It returns the matched segments for any oligo'
-        setting_key = 'DEFAULT_IGNORE_ELONGATION_SHORTER'
-        ignore_elongation_shorter = get_setting(setting_key)
-
         try:
             match_parts = self._match_parts[read_name]
         except KeyError:
             # There was no match in the blast
             return None
+        return get_read_matched_segments(match_parts)
 
-        # Any of the match_parts has been elongated?
-        elongated_match = False
-        for m_p in match_parts:
-            if ELONGATED in m_p and m_p[ELONGATED] > ignore_elongation_shorter:
-                elongated_match = True
-        segments = covered_segments_from_match_parts(match_parts,
-                                                     in_query=False)
-        return segments, elongated_match
+    def close(self):
+        'It removes the blast database'
+        # the processes that got a copy do not remove it
+        if self._db_dir is not None and self._db_dir_pid == os.getpid():
+            self._db_dir.close()
+
+    def __del__(self):
+        self.close()
+
+
+def create_blast_short_blaster(oligos, elongate_for_global=False,
+                               num_threads=1):
+    'It returns an OligoBlaster that uses the blastn-short crumbs filters'
+    params = {'task': 'blastn-short', 'expect': '0.0001', 'dust': 'no'}
+    filters = [{'kind': 'score_threshold', 'score_key': 'identity',
+                'min_score': 87},
+               {'kind': 'min_length', 'min_num_residues': 13,
+                'length_in_query': False}]
+    return OligoBlaster(oligos, program='blastn', params=params,
+                        filters=filters,
+                        elongate_for_global=elongate_for_global,
+                        num_threads=num_threads)
+
+
+def get_read_matched_segments(match_parts):
+    '''It returns the segments of a read covered by the oligo match parts.
+
+    It also returns if any match part has been elongated.
+    '''
+    setting_key = 'DEFAULT_IGNORE_ELONGATION_SHORTER'
+    ignore_elongation_shorter = get_setting(setting_key)
+
+    # Any of the match_parts has been elongated?
+    elongated_match = False
+    for m_p in match_parts:
+        if ELONGATED in m_p and m_p[ELONGATED] > ignore_elongation_shorter:
+            elongated_match = True
+    segments = covered_segments_from_match_parts(match_parts,
+                                                 in_query=False)
+    return segments, elongated_match
 
 
 class Blaster(object):
@@ -336,7 +747,17 @@ class Blaster(object):
     '''
 
     def __init__(self, seqrecords, blastdb, program, dbtype=None, params=None,
-                 filters=None, remote=False):
+                 filters=None, remote=False, processes=1, threads=None,
+                 cache=None):
+        '''It inits the class.
+
+        processes - The seqrecords are split in chunks blasted by these
+                    concurrent blast processes
+        threads - The threads shared by the blast processes, by default one
+                  for every process
+        cache - An AlignmentCache, only the seqrecords not found in it are
+                blasted. It is not used by the remote blast
+        '''
         self.program = program
         if params is None:
             params = {}
@@ -345,6 +766,9 @@ class Blaster(object):
             filters = []
         self.filters = filters
         self._remote = remote
+        self._processes = processes
+        self._threads = threads
+        self._cache = cache
         if dbtype not in (NUCL, PROT, None):
             raise ValueError('dbtype must be NUCL, PROT or None (we guess)')
         self._blasts = self._look_for_blast_matches(seqrecords, blastdb,
@@ -354,13 +778,16 @@ class Blaster(object):
         'it makes the blast and filters the results'
         blasts, blast_fhand = _do_blast_2(blastdb, seqrecords, self.program,
                                           params=self.params, dbtype=dbtype,
-                                          remote=self._remote)
-        # print open(blast_fhand.name).read()
+                                          remote=self._remote,
+                                          processes=self._processes,
+                                          threads=self._threads,
+                                          cache=self._cache)
         if self.filters is not None:
             blasts = filter_alignments(blasts, config=self.filters)
 
         blasts = {blast['query']['name']: blast for blast in blasts}
-        blast_fhand.close()
+        if blast_fhand is not None:
+            blast_fhand.close()
         return blasts
 
     def get_matched_segments(self, seqrecord_name):
@@ -15,7 +15,7 @@
 
 # pylint: disable=C0111
 
-from crumbs.seq import get_str_seq
+from crumbs.seq import get_str_seq, compact_seqs
 from crumbs.pairs import group_pairs_by_name, group_pairs
 from crumbs.seqio import read_seqs, write_seqs
 from crumbs.utils.tags import SEQITEM
@@ -32,8 +32,11 @@ def _seqitem_pairs_equal(pair1, pair2):
         return True
 
 
-def _read_pairs(in_fhands, paired_reads):
+def _read_pairs(in_fhands, paired_reads, compact=False):
     seqs = read_seqs(in_fhands, prefered_seq_classes=[SEQITEM])
+    if compact:
+        # the reads will be held in memory
+        seqs = compact_seqs(seqs)
     if paired_reads:
         pairs = group_pairs_by_name(seqs)
     else:
@@ -52,10 +55,11 @@ def filter_duplicates(in_fhands, out_fhand, paired_reads,
                       n_seqs_packet=None, tempdir=None):
     if not in_fhands:
         raise ValueError('At least one input fhand is required')
-    pairs = _read_pairs(in_fhands, paired_reads)
     if n_seqs_packet is None:
+        pairs = _read_pairs(in_fhands, paired_reads)
         unique_pairs = unique_unordered(pairs, key=_get_pair_key)
     else:
+        pairs = _read_pairs(in_fhands, paired_reads, compact=True)
         sorted_pairs = sorted_items(pairs, key=_get_pair_key, tempdir=tempdir,
                                 max_items_in_memory=n_seqs_packet)
         unique_pairs = unique(sorted_pairs, key=_get_pair_key)
@@ -16,7 +16,7 @@
 # pylint: disable=C0111
 
 from __future__ import division
-from tempfile import NamedTemporaryFile
+import os
 
 try:
     from pysam import Samfile
@@ -24,28 +24,44 @@ except ImportError:
     # This is an optional requirement
     pass
 
+try:
+    import numpy
+except ImportError:
+    # This is an optional requirement
+    pass
+
 from crumbs.utils.tags import (SEQS_PASSED, SEQS_FILTERED_OUT, SEQITEM,
-                               SEQRECORD)
-from crumbs.utils.seq_utils import uppercase_length, get_uppercase_segments
-from crumbs.seq import get_name, get_file_format, get_str_seq, get_length
-from crumbs.exceptions import WrongFormatError
-from crumbs.blast import Blaster, BlasterForFewSubjects
-from crumbs.statistics import calculate_dust_score
+                               SEQRECORD, SEQ_BATCH)
+from crumbs.utils.seq_utils import (uppercase_length,
+                                    get_seq_uppercase_segments)
+from crumbs.seq import (get_name, get_file_format, get_str_seq, get_length,
+                        get_int_qualities)
+from crumbs.exceptions import WrongFormatError, ItemsNotSortedError
+from crumbs.blast import Blaster, create_blast_short_blaster
+from crumbs.oligo_matcher import OligoMatcher
+from crumbs.statistics import calculate_dust_score, calculate_dust_scores
+from crumbs.seq_batch import SeqBatch, NUMPY_AVAILABLE
+from crumbs.id_sets import create_id_set, HashedIdSet, MappedIdSet
 from crumbs.settings import get_setting
-from crumbs.mapping import map_with_bowtie2, map_process_to_bam
-from crumbs.seqio import write_seqs
+from crumbs.mapping import create_bowtie2_session
 from crumbs.pairs import group_pairs, group_pairs_by_name
+from crumbs.utils.sam import iter_sam_mapped_names, natural_name_key
 
 
 def seq_to_filterpackets(seq_packets, group_paired_reads=False):
     'It yields packets suitable for the filters'
 
     for packet in seq_packets:
+        batch = packet if isinstance(packet, SeqBatch) else None
         if group_paired_reads:
             packet = list(group_pairs_by_name(packet))
         else:
             packet = list(group_pairs(packet, n_seqs_in_pair=1))
-        yield {SEQS_PASSED: packet, SEQS_FILTERED_OUT: []}
+        filterpacket = {SEQS_PASSED: packet, SEQS_FILTERED_OUT: []}
+        if batch is not None:
+            # the pairs keep the order of the seqs
+            filterpacket[SEQ_BATCH] = batch
+        yield filterpacket
 
 
 def _reverse_bools(bools):
@@ -53,6 +69,10 @@ def _reverse_bools(bools):
 
 
 class _BaseFilter(object):
+    # It can be a method that checks all the seqs of a SeqBatch at once and
+    # returns a boolean array
+    _do_check_batch = None
+
     def __init__(self, failed_drags_pair=True, reverse=False):
         self.reverse = reverse
         self.failed_drags_pair = failed_drags_pair
@@ -63,8 +83,42 @@ class _BaseFilter(object):
     def _do_check(self, seq):
         raise NotImplementedError()
 
+    def _filter_batch(self, filterpacket):
+        pairs = filterpacket[SEQS_PASSED]
+        filtered_out = filterpacket[SEQS_FILTERED_OUT][:]
+        if not pairs:
+            return {SEQS_PASSED: [], SEQS_FILTERED_OUT: filtered_out}
+        pair_lengths = numpy.fromiter((len(pair) for pair in pairs),
+                                      dtype=numpy.int64, count=len(pairs))
+        batch = filterpacket.get(SEQ_BATCH)
+        if batch is None or len(batch) != pair_lengths.sum():
+            batch = SeqBatch(seq for pair in pairs for seq in pair)
+        checks = numpy.asarray(self._do_check_batch(batch), dtype=bool)
+        if self.reverse:
+            checks = ~checks
+
+        # the checks of the seqs of every pair are reduced at once
+        pair_starts = numpy.cumsum(pair_lengths) - pair_lengths
+        if self.failed_drags_pair:
+            pairs_passed = numpy.logical_and.reduceat(checks, pair_starts)
+        else:
+            pairs_passed = numpy.logical_or.reduceat(checks, pair_starts)
+
+        seqs_passed = []
+        for pair, pair_passed in zip(pairs, pairs_passed):
+            if pair_passed:
+                seqs_passed.append(pair)
+            else:
+                filtered_out.append(pair)
+        batch = batch.take(numpy.repeat(pairs_passed, pair_lengths))
+        return {SEQS_PASSED: seqs_passed, SEQS_FILTERED_OUT: filtered_out,
+                SEQ_BATCH: batch}
+
     def __call__(self, filterpacket):
         self._setup_checks(filterpacket)
+        if (self._do_check_batch is not None and NUMPY_AVAILABLE and
+                get_setting('BATCH_FILTERS')):
+            return self._filter_batch(filterpacket)
         reverse = self.reverse
         failed_drags_pair = self.failed_drags_pair
         seqs_passed = []
@@ -131,6 +185,11 @@ class FilterByRpkm(_BaseFilter):
         return True if rpkm >= self._min_rpkm else False
 
 
+def _get_uppercase_mask(residues):
+    'It returns True for the uppercase residues of an uint8 array'
+    return (residues >= ord('A')) & (residues <= ord('Z'))
+
+
 class FilterByLength(_BaseFilter):
     'It removes the sequences according to their length.'
     def __init__(self, minimum=None, maximum=None, ignore_masked=False,
@@ -161,17 +220,30 @@ class FilterByLength(_BaseFilter):
             passed = False
         return passed
 
+    def _do_check_batch(self, batch):
+        if self.ignore_masked:
+            lengths = batch.sum_per_seq(_get_uppercase_mask(batch.seqs))
+        else:
+            lengths = batch.lengths
+        passed = numpy.ones(len(lengths), dtype=bool)
+        if self.min is not None:
+            passed &= lengths >= self.min
+        if self.max is not None:
+            passed &= lengths <= self.max
+        return passed
+
 
 class FilterById(_BaseFilter):
     'It removes the sequences not found in the given set'
     def __init__(self, seq_ids, failed_drags_pair=True, reverse=False):
         '''The initiator.
 
-        seq_ids - An iterator with the sequence ids to keep
+        seq_ids - An iterator with the sequence ids to keep or an id set
+                  (a set, a HashedIdSet or a MappedIdSet)
         reverse - if True keep the sequences not found on the list
         '''
-        if not isinstance(seq_ids, set):
-            seq_ids = set(seq_ids)
+        if not isinstance(seq_ids, (set, HashedIdSet, MappedIdSet)):
+            seq_ids = create_id_set(seq_ids)
         self.seq_ids = seq_ids
         super(FilterById, self).__init__(failed_drags_pair=failed_drags_pair,
                                               reverse=reverse)
@@ -180,22 +252,125 @@ class FilterById(_BaseFilter):
         return True if get_name(seq) in self.seq_ids else False
 
 
-def _get_mapped_reads(bam_fpath, min_mapq=0):
+def _iter_mapped_names(bam_fpath, min_mapq=0):
+    'It yields the names of the mapped reads of a BAM file'
     bam = Samfile(bam_fpath)
-    return [read.qname for read in bam if not read.is_unmapped and (not min_mapq or read.mapq > min_mapq)]
+    try:
+        for read in bam:
+            if read.is_unmapped or (min_mapq and read.mapq <= min_mapq):
+                continue
+            yield read.qname
+    finally:
+        bam.close()
+
+
+def _lexicographic_name_key(name):
+    return name
+
+# the orders of the BAMs sorted by read name, samtools sort -n uses the
+# natural one and picard SortSam the lexicographic one
+NAME_ORDER_KEYS = {'natural': natural_name_key,
+                   'lexicographic': _lexicographic_name_key}
+
+
+class _SortedNamesCursor(object):
+    '''It goes through the mapped names of a BAM sorted by read name.
+
+    The names looked for should follow the same order, so the cursor only
+    goes forward and only the current name is kept in memory.
+    '''
+    def __init__(self, bam_fpath, min_mapq=0, name_key=natural_name_key):
+        self._bam_fpath = bam_fpath
+        self._names = _iter_mapped_names(bam_fpath, min_mapq=min_mapq)
+        self._name_key = name_key
+        self._current = None
+        self._current_key = None
+        self._last_key = None
+        self._next_name()
+
+    def _next_name(self):
+        previous_key = self._current_key
+        try:
+            self._current = next(self._names)
+        except StopIteration:
+            self._current, self._current_key = None, None
+            return
+        self._current_key = self._name_key(self._current)
+        if previous_key is not None and self._current_key < previous_key:
+            msg = 'The BAM file is not sorted by read name: '
+            raise ItemsNotSortedError(msg + self._bam_fpath)
+
+    def advance_to(self, name):
+        '''It returns True if the name is mapped in the BAM.
+
+        The cursor does not go beyond the name, the mates share it.
+        '''
+        if name == self._current:
+            self._last_key = self._current_key
+            return True
+        name_key = self._name_key(name)
+        if self._last_key is not None and name_key < self._last_key:
+            msg = 'The reads are not sorted by name like the BAM file: '
+            raise ItemsNotSortedError(msg + self._bam_fpath)
+        self._last_key = name_key
+        while self._current is not None and self._current_key < name_key:
+            self._next_name()
+        return self._current == name
 
 
 class FilterByBam(FilterById):
     'It filters the reads not mapped in the given BAM files'
-    def __init__(self, bam_fpaths, min_mapq=0, reverse=False):
-        seq_ids = self._get_mapped_reads(bam_fpaths, min_mapq)
-        super(FilterByBam, self).__init__(seq_ids, reverse=reverse)
+    def __init__(self, bam_fpaths, min_mapq=0, reverse=False,
+                 sorted_by_name=False, name_order='natural'):
+        '''The initiator.
+
+        bam_fpaths - The BAM files with the mapped reads
+        sorted_by_name - If True the BAMs and the reads should be sorted by
+                         read name and the mapped names are read along with
+                         the reads instead of being kept in memory
+        name_order - natural, like samtools sort -n, or lexicographic, like
+                     picard SortSam
+        '''
+        self._bam_fpaths = bam_fpaths
+        self.min_mapq = min_mapq
+        self.sorted_by_name = sorted_by_name
+        if not sorted_by_name:
+            seq_ids = (name for fpath in bam_fpaths
+                       for name in _iter_mapped_names(fpath, min_mapq))
+            super(FilterByBam, self).__init__(seq_ids, reverse=reverse)
+            return
+        if name_order not in NAME_ORDER_KEYS:
+            raise ValueError('Unknown read name order: ' + str(name_order))
+        self._name_key = NAME_ORDER_KEYS[name_order]
+        self.seq_ids = None
+        self._cursors = None
+        self._cursors_pid = None
+        super(FilterById, self).__init__(reverse=reverse)
+
+    def __getstate__(self):
+        # the cursors are opened again by every worker
+        state = self.__dict__.copy()
+        state['_cursors'] = None
+        return state
+
+    def _get_cursors(self):
+        if self._cursors is None or self._cursors_pid != os.getpid():
+            self._cursors = [_SortedNamesCursor(fpath, self.min_mapq,
+                                                self._name_key)
+                             for fpath in self._bam_fpaths]
+            self._cursors_pid = os.getpid()
+        return self._cursors
 
-    def _get_mapped_reads(self, bam_fpaths, min_mapq):
-        mapped_reads = []
-        for fpath in bam_fpaths:
-            mapped_reads.extend(_get_mapped_reads(fpath, min_mapq=min_mapq))
-        return mapped_reads
+    def _do_check(self, seq):
+        if not self.sorted_by_name:
+            return super(FilterByBam, self)._do_check(seq)
+        name = get_name(seq)
+        mapped = False
+        for cursor in self._get_cursors():
+            # every cursor should see every name to check the read order
+            if cursor.advance_to(name):
+                mapped = True
+        return mapped
 
 
 class FilterByQuality(_BaseFilter):
@@ -213,46 +388,64 @@ class FilterByQuality(_BaseFilter):
                                            failed_drags_pair=failed_drags_pair)
 
     def _do_check(self, seq):
-        seq_object = seq.object
         try:
-            quals = seq_object.letter_annotations['phred_quality']
-        except KeyError:
+            quals = get_int_qualities(seq)
+        except AttributeError:
             msg = 'Some of the input sequences do not have qualities: {}'
             msg = msg.format(get_name(seq))
             raise WrongFormatError(msg)
         if self.ignore_masked:
-            str_seq = str(seq_object.seq)
-            seg_quals = [quals[segment[0]: segment[1] + 1]
-                            for segment in get_uppercase_segments(str_seq)]
-            qual = sum(sum(q) * len(q) for q in seg_quals) / len(quals)
+            qual_sum, num_quals = 0, 0
+            for start, end in get_seq_uppercase_segments(seq):
+                qual_sum += sum(quals[start: end + 1])
+                num_quals += end - start + 1
         else:
-            qual = sum(quals) / len(quals)
+            qual_sum, num_quals = sum(quals), len(quals)
+        qual = qual_sum / num_quals if num_quals else 0
         return True if qual >= self.threshold else False
 
+    def _do_check_batch(self, batch):
+        try:
+            quals = batch.quals
+        except AttributeError:
+            # the seq without qualities is reported by the per seq check
+            for seq in batch:
+                self._do_check(seq)
+            raise
+        if self.ignore_masked:
+            uppercase = _get_uppercase_mask(batch.seqs)
+            qual_sums = batch.sum_per_seq(numpy.where(uppercase, quals, 0))
+            nums_quals = batch.sum_per_seq(uppercase)
+        else:
+            qual_sums = batch.sum_per_seq(quals)
+            nums_quals = batch.lengths
+        # the seqs without qualities have a mean of 0
+        means = qual_sums / numpy.maximum(nums_quals, 1)
+        return means >= self.threshold
+
 
 class FilterBlastShort(_BaseFilter):
-    'It filters a seq if there is a match against the given oligos'
-    def __init__(self, oligos, failed_drags_pair=True, reverse=False):
+    '''It filters a seq if there is a match against the given oligos.
+
+    By default the oligos are looked for with an OligoMatcher, with the same
+    filters as the blastn-short search, that is used if use_blast is True.
+    '''
+    def __init__(self, oligos, failed_drags_pair=True, reverse=False,
+                 use_blast=False, blast_threads=1):
         self.oligos = oligos
+        self.use_blast = use_blast
+        if use_blast:
+            self._matcher = create_blast_short_blaster(oligos,
+                                          elongate_for_global=False,
+                                          num_threads=blast_threads)
+        else:
+            self._matcher = OligoMatcher(oligos, elongate_for_global=False)
         super(FilterBlastShort, self).__init__(reverse=reverse,
                                           failed_drags_pair=failed_drags_pair)
 
     def _setup_checks(self, filterpacket):
         seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
-
-        # we create a blastdb for these reads and then we use the oligos
-        # as the blast query
-        db_fhand = write_seqs(seqs, file_format='fasta')
-        db_fhand.flush()
-        params = {'task': 'blastn-short', 'expect': '0.0001'}
-        filters = [{'kind': 'score_threshold', 'score_key': 'identity',
-                    'min_score': 87},
-                   {'kind': 'min_length', 'min_num_residues': 13,
-                    'length_in_query': False}]
-        self._matcher = BlasterForFewSubjects(db_fhand.name, self.oligos,
-                                             program='blastn', filters=filters,
-                                             params=params,
-                                             elongate_for_global=False)
+        self._matcher.match_seqs(seqs)
 
     def _do_check(self, seq):
         segments = self._matcher.get_matched_segments_for_read(get_name(seq))
@@ -262,18 +455,25 @@ class FilterBlastShort(_BaseFilter):
 class FilterBlastMatch(_BaseFilter):
     'It filters a seq if there is a match against a blastdb'
     def __init__(self, database, program, filters, dbtype=None,
-                 failed_drags_pair=True, reverse=False):
+                 failed_drags_pair=True, reverse=False, blast_processes=1,
+                 blast_threads=None, blast_cache=None):
         '''The initiator
             database: path to a file with seqs or a blast database
             filter_params:
                 expect_threshold
                 similarty treshlod
                 min_length_percentaje
+            blast_processes: concurrent blasts for every packet
+            blast_threads: threads shared by the blasts of every packet
+            blast_cache: AlignmentCache with the blast results
         '''
         self._blast_db = database
         self._blast_program = program
         self._filters = filters
         self._dbtype = dbtype
+        self._blast_processes = blast_processes
+        self._blast_threads = blast_threads
+        self._blast_cache = blast_cache
         super(FilterBlastMatch, self).__init__(reverse=reverse,
                                           failed_drags_pair=failed_drags_pair)
 
@@ -281,7 +481,10 @@ class FilterBlastMatch(_BaseFilter):
         seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
         self._matcher = Blaster(seqs, self._blast_db, dbtype=self._dbtype,
                                 program=self._blast_program,
-                                filters=self._filters)
+                                filters=self._filters,
+                                processes=self._blast_processes,
+                                threads=self._blast_threads,
+                                cache=self._blast_cache)
 
     def _do_check(self, seq):
         segments = self._matcher.get_matched_segments(get_name(seq))
@@ -295,48 +498,63 @@ class FilterBowtie2Match(_BaseFilter):
         self._index_fpath = index_fpath
         self._reverse = reverse
         self.min_mapq = min_mapq
+        self._session = None
+        self._session_pid = None
         super(FilterBowtie2Match, self).__init__(reverse=reverse,
                                           failed_drags_pair=failed_drags_pair)
 
+    def __getstate__(self):
+        # every worker starts its own bowtie2
+        state = self.__dict__.copy()
+        state['_session'] = None
+        return state
+
+    def _get_session(self, file_format):
+        'It returns the bowtie2 session, bowtie2 is started only once'
+        session = self._session
+        if (session is not None and self._session_pid == os.getpid() and
+                session.file_format == file_format):
+            return session
+        if session is not None and self._session_pid == os.getpid():
+            session.close()
+        self._session = create_bowtie2_session(self._index_fpath,
+                                               file_format=file_format)
+        self._session_pid = os.getpid()
+        return self._session
+
+    def close(self):
+        'It stops bowtie2, an error is raised if it has failed'
+        session = self._session
+        self._session = None
+        if session is not None and self._session_pid == os.getpid():
+            session.close()
+
     def _setup_checks(self, filterpacket):
-        index_fpath = self._index_fpath
         seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
+        if not seqs:
+            self.mapped_reads = set()
+            return
         seq_class = seqs[0].kind
-        extra_params = []
-        # Which format do we need for the bowtie2 input read file fasta or
+        # Which format do we need for the bowtie2 input reads fasta or
         # fastq?
         if seq_class == SEQRECORD:
             if 'phred_quality' in seqs[0].object.letter_annotations.viewkeys():
                 file_format = 'fastq'
             else:
-                extra_params.append('-f')
                 file_format = 'fasta'
         elif seq_class == SEQITEM:
             file_format = get_file_format(seqs[0])
-            if 'illumina' in file_format:
-                extra_params.append('--phred64')
-            elif 'fasta' in file_format:
-                extra_params.append('-f')
-            elif 'fastq' in file_format:
-                pass
-            else:
+            if ('illumina' not in file_format and 'fasta' not in file_format
+                    and 'fastq' not in file_format):
                 msg = 'For FilterBowtie2Match and SeqItems fastq or fasta '
                 msg += 'files are required'
                 raise RuntimeError(msg)
         else:
             raise NotImplementedError()
 
-        reads_fhand = NamedTemporaryFile(suffix=file_format)
-        write_seqs(seqs, reads_fhand, file_format=file_format)
-        reads_fhand.flush()
-
-        bam_fhand = NamedTemporaryFile(suffix='.bam')
-        map_process = map_with_bowtie2(index_fpath,
-                                       unpaired_fpath=reads_fhand.name,
-                                       extra_params=extra_params)
-        map_process_to_bam(map_process, bam_fhand.name)
-
-        self.mapped_reads = _get_mapped_reads(bam_fhand.name, self.min_mapq)
+        sam_lines = self._get_session(file_format).map_seqs(seqs)
+        self.mapped_reads = set(iter_sam_mapped_names(sam_lines,
+                                                      self.min_mapq))
 
     def _do_check(self, seq):
         return False if get_name(seq) in self.mapped_reads else True
@@ -357,6 +575,17 @@ class FilterDustComplexity(_BaseFilter):
         dustscore = calculate_dust_score(seq)
         return True if dustscore < threshold else False
 
+    def _do_check_batch(self, batch):
+        dustscores = calculate_dust_scores(batch)
+        # the seqs too short to be scored (NaN) pass
+        scored = ~numpy.isnan(dustscores)
+        passed = numpy.ones(dustscores.shape, dtype=bool)
+        passed[scored] = dustscores[scored] < self._threshold
+        return passed
+
+
+_N_RESIDUES = [ord(residue) for residue in 'Nn-*']
+
 
 class FilterAllNs(_BaseFilter):
     'It filters a sequence completely composed by Ns'
@@ -374,3 +603,9 @@ class FilterAllNs(_BaseFilter):
             return True
         else:
             return False
+
+    def _do_check_batch(self, batch):
+        n_residues = numpy.in1d(batch.seqs, _N_RESIDUES)
+        lengths = batch.lengths
+        # the empty seqs pass
+        return (batch.sum_per_seq(n_residues) < lengths) | (lengths == 0)
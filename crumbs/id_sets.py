@@ -0,0 +1,346 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''Compact sets of seq names for huge id lists.
+
+A name is in a set if its 64 bit hash is. Two different names could share
+the hash, but with 64 bits that is very unlikely even for billions of names.
+A HashedIdSet keeps the sorted hashes in a NumPy array and a MappedIdSet
+reads them from a memory mapped id index file (.crumbs.ids). The index
+file can hold a Bloom filter that is checked before the binary search, so
+most of the missing names are rejected without reading the hashes.
+create_id_set chooses the set for the number of names.
+'''
+
+import os
+import mmap
+import struct
+from bisect import bisect_left
+from heapq import merge
+from itertools import islice, chain
+from tempfile import NamedTemporaryFile, TemporaryFile
+
+try:
+    import numpy
+except ImportError:
+    # This is an optional requirement
+    numpy = None
+
+from crumbs.exceptions import MalformedFile
+from crumbs.iterutils import group_in_packets
+from crumbs.seq_index import _hash_name
+from crumbs.settings import get_setting
+
+ID_INDEX_EXTENSION = '.crumbs.ids'
+
+_MAGIC = 'CRUMBIDS'
+_VERSION = 1
+# magic, version, number of hashes, bloom filter bits and hash functions
+_HEADER = struct.Struct('<8sIQQI')
+_HASH = struct.Struct('<Q')
+_HASHES_PER_READ = 65536
+_MASK_32 = 0xffffffff
+
+
+def _get_bloom_positions(hash_, num_bits, num_functions):
+    'It returns the bits of a hash, a double hashing of its two halves'
+    low, high = hash_ & _MASK_32, hash_ >> 32
+    return [(low + index * high) % num_bits for index in range(num_functions)]
+
+
+def _set_bloom_bits(bits, hashes, num_bits, num_functions):
+    'It sets the bits of the hashes in the bloom filter bytearray'
+    if numpy is not None:
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        lows = hashes & numpy.uint64(_MASK_32)
+        highs = hashes >> numpy.uint64(32)
+        array = numpy.frombuffer(bits, dtype=numpy.uint8)
+        for index in range(num_functions):
+            positions = (lows + numpy.uint64(index) * highs) % \
+                                                        numpy.uint64(num_bits)
+            shifts = (positions & numpy.uint64(7)).astype(numpy.uint8)
+            numpy.bitwise_or.at(array, positions >> numpy.uint64(3),
+                                numpy.left_shift(numpy.uint8(1), shifts))
+        return
+    for hash_ in hashes:
+        for position in _get_bloom_positions(hash_, num_bits, num_functions):
+            bits[position >> 3] |= 1 << (position & 7)
+
+
+def _pack_hashes(hashes):
+    'It returns the hashes as little endian 64 bit integers'
+    if numpy is not None:
+        return numpy.asarray(hashes, dtype='<u8').tostring()
+    return struct.pack('<{:d}Q'.format(len(hashes)), *hashes)
+
+
+def _read_hashes(fhand, offset=0, num_hashes=None):
+    'It yields the hashes written in the file from the offset'
+    fhand.seek(offset)
+    while num_hashes is None or num_hashes > 0:
+        to_read = _HASHES_PER_READ
+        if num_hashes is not None:
+            to_read = min(to_read, num_hashes)
+            num_hashes -= to_read
+        chunk = fhand.read(to_read * _HASH.size)
+        if not chunk:
+            break
+        for hash_ in struct.unpack('<{:d}Q'.format(len(chunk) // _HASH.size),
+                                   chunk):
+            yield hash_
+
+
+def _sort_hashes(hashes):
+    '''It yields the hashes sorted.
+
+    The hashes are sorted in chunks that fit in memory, MAX_IDS_IN_MEMORY
+    with NumPy and DEFAULT_SEQS_IN_MEM_LIMIT without it, written to disk
+    and merged.
+    '''
+    if numpy is not None:
+        chunk_size = get_setting('MAX_IDS_IN_MEMORY')
+    else:
+        chunk_size = get_setting('DEFAULT_SEQS_IN_MEM_LIMIT')
+    chunk_size = max(chunk_size, 1)
+    hashes = iter(hashes)
+    chunk_fhands = []
+    while True:
+        if numpy is not None:
+            chunk = numpy.fromiter(islice(hashes, chunk_size),
+                                   dtype=numpy.uint64)
+            chunk.sort()
+        else:
+            chunk = sorted(islice(hashes, chunk_size))
+        if not len(chunk):
+            break
+        chunk_fhand = TemporaryFile(suffix=ID_INDEX_EXTENSION)
+        chunk_fhand.write(_pack_hashes(chunk))
+        chunk_fhands.append(chunk_fhand)
+        del chunk
+    for hash_ in merge(*[_read_hashes(fhand) for fhand in chunk_fhands]):
+        yield hash_
+    for chunk_fhand in chunk_fhands:
+        chunk_fhand.close()
+
+
+def _write_id_index(sorted_hashes, fhand, bits_per_id=None):
+    '''It writes the id index with the given sorted hashes.
+
+    The repeated hashes are written once. A bloom filter with bits_per_id
+    bits per hash is added after them, if bits_per_id is not 0.
+    '''
+    if bits_per_id is None:
+        bits_per_id = get_setting('ID_BLOOM_BITS_PER_ID')
+    # the optimal number of hash functions is bits_per_id * ln(2)
+    num_functions = max(1, int(round(bits_per_id * 0.693)))
+    fhand.write(_HEADER.pack(_MAGIC, _VERSION, 0, 0, 0))
+    num_hashes = 0
+    previous = None
+    unique_hashes = []
+    for hash_ in sorted_hashes:
+        if hash_ != previous:
+            unique_hashes.append(hash_)
+            previous = hash_
+            if len(unique_hashes) >= _HASHES_PER_READ:
+                fhand.write(_pack_hashes(unique_hashes))
+                num_hashes += len(unique_hashes)
+                unique_hashes = []
+    fhand.write(_pack_hashes(unique_hashes))
+    num_hashes += len(unique_hashes)
+
+    num_bits = bits_per_id * num_hashes
+    if num_bits:
+        # a bloom filter of whole bytes
+        num_bits += -num_bits % 8
+        bits = bytearray(num_bits // 8)
+        hashes = _read_hashes(fhand, _HEADER.size, num_hashes)
+        for chunk in group_in_packets(hashes, _HASHES_PER_READ):
+            _set_bloom_bits(bits, chunk, num_bits, num_functions)
+        fhand.seek(0, os.SEEK_END)
+        fhand.write(bits)
+    else:
+        num_functions = 0
+    # the header is completed once everything has been written
+    fhand.seek(0)
+    fhand.write(_HEADER.pack(_MAGIC, _VERSION, num_hashes, num_bits,
+                             num_functions))
+    fhand.flush()
+
+
+def write_id_index(names, index_fpath, bits_per_id=None):
+    '''It writes an id index file with the hashes of the names.
+
+    The hashes are sorted on disk if there are too many to be sorted in
+    memory. A Bloom filter with bits_per_id bits per name is added
+    (default ID_BLOOM_BITS_PER_ID, 0 for no filter).
+    '''
+    hashes = _sort_hashes(_hash_name(name) for name in names)
+    with open(index_fpath, 'w+b') as fhand:
+        _write_id_index(hashes, fhand, bits_per_id=bits_per_id)
+    return index_fpath
+
+
+class HashedIdSet(object):
+    'A set of names kept as their sorted 64 bit hashes in a NumPy array'
+    def __init__(self, hashes):
+        'hashes should be an array of uint64 hashes, it is sorted in place'
+        hashes.sort()
+        if len(hashes) > 1:
+            hashes = hashes[numpy.concatenate(([True],
+                                               hashes[1:] != hashes[:-1]))]
+        self._hashes = hashes
+
+    @classmethod
+    def from_names(cls, names):
+        'It creates the set with the hashes of the names'
+        hashes = [numpy.fromiter((_hash_name(name) for name in chunk),
+                                 dtype=numpy.uint64, count=len(chunk))
+                  for chunk in group_in_packets(names, _HASHES_PER_READ)]
+        if not hashes:
+            return cls(numpy.array([], dtype=numpy.uint64))
+        return cls(numpy.concatenate(hashes))
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def contains_hash(self, hash_):
+        hash_ = numpy.uint64(hash_)
+        index = self._hashes.searchsorted(hash_)
+        return index < len(self._hashes) and self._hashes[index] == hash_
+
+    def __contains__(self, name):
+        return self.contains_hash(_hash_name(name))
+
+
+class _MappedHashes(object):
+    'The hashes of an index file, as a sequence, for bisect'
+    def __init__(self, mapped_file, num_hashes):
+        self._mapped_file = mapped_file
+        self._num_hashes = num_hashes
+
+    def __len__(self):
+        return self._num_hashes
+
+    def __getitem__(self, index):
+        return _HASH.unpack_from(self._mapped_file,
+                                 _HEADER.size + index * _HASH.size)[0]
+
+
+class MappedIdSet(object):
+    '''A set of names kept as sorted 64 bit hashes in a memory mapped file.
+
+    If the file has a bloom filter it is checked before the hashes.
+    '''
+    def __init__(self, index_fpath, _temp_index=None):
+        self.index_fpath = index_fpath
+        self._temp_index = _temp_index
+        fhand = open(index_fpath, 'rb')
+        header = fhand.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise MalformedFile('Truncated id index: ' + index_fpath)
+        magic, version, num_hashes, num_bits, num_functions = \
+                                                        _HEADER.unpack(header)
+        index_size = os.fstat(fhand.fileno()).st_size
+        if (magic != _MAGIC or version != _VERSION or index_size !=
+                _HEADER.size + num_hashes * _HASH.size + num_bits // 8):
+            raise MalformedFile('Not a valid id index: ' + index_fpath)
+        self._num_hashes = num_hashes
+        self._num_bits = num_bits
+        self._num_functions = num_functions
+        # the index has at least the header, so it can always be mapped
+        self._mapped_file = mmap.mmap(fhand.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        fhand.close()
+        if not num_hashes:
+            self._hashes = []
+        elif numpy is not None:
+            self._hashes = numpy.frombuffer(self._mapped_file, dtype='<u8',
+                                            count=num_hashes,
+                                            offset=_HEADER.size)
+        else:
+            self._hashes = _MappedHashes(self._mapped_file, num_hashes)
+        self._bloom_start = _HEADER.size + num_hashes * _HASH.size
+
+    def __reduce__(self):
+        # the file is mapped again by the other processes
+        return (MappedIdSet, (self.index_fpath,))
+
+    def __len__(self):
+        return self._num_hashes
+
+    def _in_bloom_filter(self, hash_):
+        mapped_file = self._mapped_file
+        start = self._bloom_start
+        for position in _get_bloom_positions(hash_, self._num_bits,
+                                             self._num_functions):
+            if not ord(mapped_file[start + (position >> 3)]) & \
+                                                        1 << (position & 7):
+                return False
+        return True
+
+    def contains_hash(self, hash_):
+        if self._num_bits and not self._in_bloom_filter(hash_):
+            return False
+        if numpy is not None:
+            hash_ = numpy.uint64(hash_)
+            index = self._hashes.searchsorted(hash_)
+        else:
+            index = bisect_left(self._hashes, hash_)
+        return index < self._num_hashes and self._hashes[index] == hash_
+
+    def __contains__(self, name):
+        return self.contains_hash(_hash_name(name))
+
+    def close(self):
+        self._mapped_file.close()
+        if self._temp_index is not None:
+            self._temp_index.close()
+
+
+def create_id_set(names, index_fpath=None):
+    '''It returns a set with the names, the kind depends on their number.
+
+    Up to MAX_IDS_IN_SET names it is a python set, up to MAX_IDS_IN_MEMORY,
+    if NumPy is installed, a HashedIdSet and otherwise a MappedIdSet with
+    its id index in a temporary file. If index_fpath is given the id index
+    is written there and a MappedIdSet is always returned.
+    '''
+    if index_fpath is not None:
+        write_id_index(names, index_fpath)
+        return MappedIdSet(index_fpath)
+
+    names = iter(names)
+    id_set = set(islice(names, get_setting('MAX_IDS_IN_SET') + 1))
+    if len(id_set) <= get_setting('MAX_IDS_IN_SET'):
+        return id_set
+    hashes = (_hash_name(name) for name in chain(id_set, names))
+    del id_set
+    if numpy is not None:
+        max_ids = get_setting('MAX_IDS_IN_MEMORY')
+        chunks = []
+        num_hashes = 0
+        for chunk in group_in_packets(hashes, _HASHES_PER_READ):
+            chunks.append(numpy.fromiter(chunk, dtype=numpy.uint64,
+                                         count=len(chunk)))
+            num_hashes += len(chunk)
+            if num_hashes > max_ids:
+                break
+        else:
+            return HashedIdSet(numpy.concatenate(chunks))
+        hashes = chain(chain.from_iterable(chunks), hashes)
+
+    temp_index = NamedTemporaryFile(suffix=ID_INDEX_EXTENSION)
+    _write_id_index(_sort_hashes(hashes), temp_index)
+    return MappedIdSet(temp_index.name, _temp_index=temp_index)
@@ -14,7 +14,11 @@
 
 import os.path
 import shutil
+import Queue
+import warnings
+from time import time
 from subprocess import PIPE
+from threading import Thread, Event
 from tempfile import NamedTemporaryFile
 import tempfile
 
@@ -26,10 +30,11 @@ from crumbs.settings import get_setting
 from crumbs.utils.file_utils import TemporaryDir
 
 from crumbs.utils.file_formats import get_format
-from crumbs.seq import SeqItem, SeqWrapper, get_str_seq, get_name
+from crumbs.seq import (SeqItem, SeqWrapper, get_str_seq, get_name,
+                        compact_seqs)
 from crumbs.utils.tags import SEQITEM
 from crumbs.iterutils import sorted_items
-from crumbs.seqio import read_seqs
+from crumbs.seqio import read_seqs, write_seqs
 
 
 def _bwa_index_exists(index_path):
@@ -74,6 +79,28 @@ def get_or_create_bwa_index(fpath, directory=None):
     return index_fpath
 
 
+def _create_bwamem_cmd(index_fpath, in_fpaths, interleave=False,
+                       threads=None, extra_params=None, readgroup=None):
+    'It returns the bwa mem command line'
+    extra_params = [] if extra_params is None else list(extra_params)
+
+    if '-p' in extra_params:
+        extra_params.remove('-p')
+
+    if interleave:
+        extra_params.append('-p')
+
+    if readgroup is not None:
+        rg_str = '@RG\tID:{ID}\tSM:{SM}\tPL:{PL}\tLB:{LB}'.format(**readgroup)
+        extra_params.extend(['-R', rg_str])
+
+    binary = get_binary_path('bwa')
+    cmd = [binary, 'mem', '-t', str(get_num_threads(threads)), index_fpath]
+    cmd.extend(extra_params)
+    cmd.extend(in_fpaths)
+    return cmd
+
+
 def map_with_bwamem(index_fpath, unpaired_fpath=None, paired_fpaths=None,
                     interleave_fpath=None, threads=None, log_fpath=None,
                     extra_params=None, readgroup=None):
@@ -98,23 +125,9 @@ def map_with_bwamem(index_fpath, unpaired_fpath=None, paired_fpaths=None,
         msg = 'Bwa can not map unpaired and unpaired reads together'
         raise RuntimeError(msg)
 
-    if extra_params is None:
-        extra_params = []
-
-    if '-p' in extra_params:
-        extra_params.remove('-p')
-
-    if interleave:
-        extra_params.append('-p')
-
-    if readgroup is not None:
-        rg_str = '@RG\tID:{ID}\tSM:{SM}\tPL:{PL}\tLB:{LB}'.format(**readgroup)
-        extra_params.extend(['-R', rg_str])
-
-    binary = get_binary_path('bwa')
-    cmd = [binary, 'mem', '-t', str(get_num_threads(threads)), index_fpath]
-    cmd.extend(extra_params)
-    cmd.extend(in_fpaths)
+    cmd = _create_bwamem_cmd(index_fpath, in_fpaths, interleave=interleave,
+                             threads=threads, extra_params=extra_params,
+                             readgroup=readgroup)
 
     if log_fpath is None:
         stderr = NamedTemporaryFile(suffix='.stderr')
@@ -144,24 +157,16 @@ def get_or_create_bowtie2_index(fpath, directory=None):
     return index_fpath
 
 
-def map_with_bowtie2(index_fpath, paired_fpaths=None,
-                     unpaired_fpath=None, readgroup=None, threads=None,
-                     log_fpath=None, preset='very-sensitive-local',
-                     extra_params=None):
-    '''It maps with bowtie2.
-
-    paired_seqs is a list of tuples, in which each tuple are paired seqs
-    unpaired_seqs is a list of files
-    '''
+def _create_bowtie2_cmd(index_fpath, paired_fpaths=None,
+                        unpaired_fpath=None, readgroup=None, threads=None,
+                        preset='very-sensitive-local', extra_params=None):
+    'It returns the bowtie2 command line'
     if readgroup is None:
         readgroup = {}
 
     if extra_params is None:
         extra_params = []
 
-    if paired_fpaths is None and unpaired_fpath is None:
-        raise RuntimeError('At least one file to map is required')
-
     binary = get_binary_path('bowtie2')
     cmd = [binary, '-x', index_fpath, '--{0}'.format(preset),
            '-p', str(get_num_threads(threads))]
@@ -181,6 +186,25 @@ def map_with_bowtie2(index_fpath, paired_fpaths=None,
                 cmd.extend(['--rg-id', value])
             else:
                 cmd.extend(['--rg', '{0}:{1}'.format(key, value)])
+    return cmd
+
+
+def map_with_bowtie2(index_fpath, paired_fpaths=None,
+                     unpaired_fpath=None, readgroup=None, threads=None,
+                     log_fpath=None, preset='very-sensitive-local',
+                     extra_params=None):
+    '''It maps with bowtie2.
+
+    paired_seqs is a list of tuples, in which each tuple are paired seqs
+    unpaired_seqs is a list of files
+    '''
+    if paired_fpaths is None and unpaired_fpath is None:
+        raise RuntimeError('At least one file to map is required')
+
+    cmd = _create_bowtie2_cmd(index_fpath, paired_fpaths=paired_fpaths,
+                              unpaired_fpath=unpaired_fpath,
+                              readgroup=readgroup, threads=threads,
+                              preset=preset, extra_params=extra_params)
 
     if log_fpath is None:
         stderr = NamedTemporaryFile(suffix='.stderr')
@@ -192,6 +216,255 @@ def map_with_bowtie2(index_fpath, paired_fpaths=None,
     return bowtie2
 
 
+# the names of the reads written by the mapping sessions after every packet
+_END_OF_PACKET = 'crumbs_end_of_packet_'
+_FLUSH_READ = 'crumbs_flush_read_'
+
+
+class MappingSession(object):
+    '''A mapper process that maps the packets of reads one after the other.
+
+    The mapper is started once reading the reads from stdin, so the index is
+    loaded once. The reads of every packet are written by a feeder thread
+    followed by an end of packet read and the mapper output is read by a
+    reader thread. The mapper can keep the end of packet read in its
+    buffers, so the feeder goes on writing flush reads made of Ns, a few at
+    a time, until the reader finds it, however big the buffers are. The SAM
+    lines of the packet are the ones before the end of packet read, so the
+    mapper should write the reads in order and a line for every read, mapped
+    or not. If the mapper does not write any line of the packet in timeout
+    seconds it is killed and an error is raised.
+    '''
+    def __init__(self, cmd, file_format='fastq', reads_per_fragment=1,
+                 timeout=None):
+        '''The initiator.
+
+        cmd - The mapper command line, reading from stdin and writing SAM
+        reads_per_fragment - 2 if the mapper reads interleaved pairs
+        timeout - By default the MAPPING_SESSION_TIMEOUT setting
+        '''
+        self._cmd = cmd
+        self.file_format = file_format
+        self._reads_per_fragment = reads_per_fragment
+        if timeout is None:
+            timeout = get_setting('MAPPING_SESSION_TIMEOUT')
+        self._timeout = timeout
+        self.header_lines = []
+        self._num_packets = 0
+        self._feeder_error = None
+        self._packet_mapped = Event()
+        self._stderr = NamedTemporaryFile(suffix='.stderr')
+        self._process = popen(cmd, stdin=PIPE, stdout=PIPE,
+                              stderr=self._stderr, bufsize=-1)
+        self._lines = Queue.Queue()
+        self._reader = Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self):
+        for line in iter(self._process.stdout.readline, ''):
+            self._lines.put(line)
+        # the end of the output
+        self._lines.put(None)
+
+    def _create_fake_reads(self, name, num_fragments):
+        length = get_setting('MAPPING_SESSION_FLUSH_READ_LENGTH')
+        if 'fasta' in self.file_format:
+            read = '>{}\n' + 'N' * length + '\n'
+        else:
+            read = '@{}\n' + 'N' * length + '\n+\n' + 'I' * length + '\n'
+        read = read.format(name)
+        return read * (num_fragments * self._reads_per_fragment)
+
+    def _feed(self, seqs, packet_name):
+        stdin = self._process.stdin
+        flush_reads = self._create_fake_reads(_FLUSH_READ + packet_name,
+                                    get_setting('MAPPING_SESSION_FLUSH_READS'))
+        try:
+            write_seqs(seqs, stdin, file_format=self.file_format)
+            stdin.write(self._create_fake_reads(_END_OF_PACKET + packet_name,
+                                                1))
+            while not self._packet_mapped.is_set():
+                stdin.write(flush_reads)
+                stdin.flush()
+        except IOError, error:
+            # the mapper has died, the reader will report it
+            self._feeder_error = error
+
+    def _wait_for_mapper(self):
+        '''It closes the mapper stdin and waits for the mapper to finish.
+
+        The mapper exit status is checked.
+        '''
+        try:
+            self._process.stdin.close()
+        except IOError:
+            # the mapper has died with reads in the stdin buffer
+            pass
+        self._process.stdin = None
+        self._reader.join()
+        self._process.stdout = None
+        check_process_finishes(self._process, binary=self._cmd[0],
+                               stderr=self._stderr)
+
+    def _stop_feeder(self, feeder):
+        self._packet_mapped.set()
+        feeder.join()
+
+    def map_seqs(self, seqs):
+        'It returns the SAM lines of the seqs, the header lines are not added'
+        self._num_packets += 1
+        packet_name = str(self._num_packets)
+        self._packet_mapped.clear()
+        feeder = Thread(target=self._feed, args=(seqs, packet_name))
+        feeder.daemon = True
+        feeder.start()
+
+        end_of_packet = _END_OF_PACKET + packet_name
+        ends_found = 0
+        sam_lines = []
+        deadline = time() + self._timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(deadline - time(), 0))
+            except Queue.Empty:
+                self._process.kill()
+                self._stop_feeder(feeder)
+                self._process.wait()
+                msg = '{} did not map the reads in {} seconds'
+                raise RuntimeError(msg.format(self._cmd[0], self._timeout))
+            if line is None:
+                self._stop_feeder(feeder)
+                self._wait_for_mapper()
+                msg = '{} finished before mapping all the reads'
+                raise RuntimeError(msg.format(self._cmd[0]))
+            if line[0] == '@':
+                self.header_lines.append(line)
+                continue
+            name = line.split('\t', 1)[0]
+            if name.startswith(_FLUSH_READ):
+                continue
+            deadline = time() + self._timeout
+            if name == end_of_packet:
+                ends_found += 1
+                if ends_found == self._reads_per_fragment:
+                    break
+            else:
+                sam_lines.append(line)
+        self._stop_feeder(feeder)
+        if self._feeder_error is not None:
+            raise self._feeder_error
+        return sam_lines
+
+    def close(self):
+        '''It closes the mapper stdin and it waits for the mapper to finish.
+
+        An error is raised if the mapper fails.
+        '''
+        if self._process.returncode is None:
+            self._wait_for_mapper()
+
+
+def create_bowtie2_session(index_fpath, file_format='fastq', threads=None,
+                           preset='very-sensitive-local', extra_params=None):
+    'It starts a bowtie2 MappingSession for unpaired reads'
+    extra_params = [] if extra_params is None else list(extra_params)
+    if 'fasta' in file_format:
+        extra_params.append('-f')
+    elif 'illumina' in file_format:
+        extra_params.append('--phred64')
+    # with several threads the reads are written in order only if asked for
+    extra_params.append('--reorder')
+    cmd = _create_bowtie2_cmd(index_fpath, unpaired_fpath='-',
+                              threads=threads, preset=preset,
+                              extra_params=extra_params)
+    return MappingSession(cmd, file_format=file_format)
+
+
+class _MappingPerPacket(object):
+    '''It maps every packet of reads with a new mapper process.
+
+    It has the MappingSession interface for the mappers that do not map the
+    reads as they are read.
+    '''
+    def __init__(self, create_cmd, file_format='fastq'):
+        '''The initiator.
+
+        create_cmd - A function that returns the mapper command line for a
+                     reads file
+        '''
+        self._create_cmd = create_cmd
+        self.file_format = file_format
+        self.header_lines = []
+
+    def map_seqs(self, seqs):
+        'It returns the SAM lines of the seqs, the header lines are not added'
+        reads_fhand = NamedTemporaryFile(suffix='.' + self.file_format)
+        write_seqs(seqs, reads_fhand, file_format=self.file_format)
+        reads_fhand.flush()
+        cmd = self._create_cmd(reads_fhand.name)
+        stderr = NamedTemporaryFile(suffix='.stderr')
+        process = popen(cmd, stdout=PIPE, stderr=stderr)
+        header_lines, sam_lines = [], []
+        for line in process.stdout:
+            if line[0] == '@':
+                header_lines.append(line)
+            else:
+                sam_lines.append(line)
+        check_process_finishes(process, binary=cmd[0], stderr=stderr)
+        self.header_lines = header_lines
+        return sam_lines
+
+    def close(self):
+        pass
+
+
+# the bwa binaries that can set the batch size of bwa mem
+_BWAMEM_HAS_BATCH_SIZE = {}
+
+
+def _bwamem_has_batch_size():
+    'It checks if bwa mem can set the number of bases of its batches (-K)'
+    binary = get_binary_path('bwa')
+    if binary not in _BWAMEM_HAS_BATCH_SIZE:
+        process = popen([binary, 'mem'], stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate()
+        _BWAMEM_HAS_BATCH_SIZE[binary] = '-K INT' in stdout + stderr
+    return _BWAMEM_HAS_BATCH_SIZE[binary]
+
+
+def create_bwamem_session(index_fpath, file_format='fastq', interleave=False,
+                          threads=None, extra_params=None):
+    '''It starts a bwa mem MappingSession for unpaired or interleaved reads.
+
+    bwa mem maps the reads in batches of a fixed number of bases, so after
+    every packet the session writes flush reads up to the end of the batch.
+    The batch has the bases of a packet of PACKET_SIZE flush reads, so the
+    flush reads of a packet are at most as many. The bwa mem versions that
+    can not set the batch size, like the bundled one, use batches of
+    millions of bases, so they are run once per packet and a warning is
+    given.
+    '''
+    extra_params = [] if extra_params is None else list(extra_params)
+    if not _bwamem_has_batch_size():
+        msg = 'bwa mem can not set its batch size (-K), so it is run for '
+        msg += 'every packet'
+        warnings.warn(msg, RuntimeWarning)
+
+        def create_cmd(fpath):
+            return _create_bwamem_cmd(index_fpath, [fpath],
+                                      interleave=interleave, threads=threads,
+                                      extra_params=extra_params)
+        return _MappingPerPacket(create_cmd, file_format=file_format)
+    batch_size = (get_setting('PACKET_SIZE') *
+                  get_setting('MAPPING_SESSION_FLUSH_READ_LENGTH'))
+    extra_params.extend(['-K', str(batch_size)])
+    cmd = _create_bwamem_cmd(index_fpath, ['-'], interleave=interleave,
+                             threads=threads, extra_params=extra_params)
+    return MappingSession(cmd, file_format=file_format,
+                          reads_per_fragment=2 if interleave else 1)
+
+
 def map_process_to_bam(map_process, bam_fpath, log_fpath=None,
                        tempdir=None):
     ''' It receives a mapping process that has a sam file in stdout and
@@ -295,7 +568,7 @@ def sort_by_position_in_ref(in_fhand, index_fpath, directory=None,
 def sort_fastx_files(in_fhands, key, index_fpath=None, directory=None,
                      max_items_in_memory=None, tempdir=None):
     if key == 'seq':
-        reads = read_seqs(in_fhands)
+        reads = compact_seqs(read_seqs(in_fhands))
         return sorted_items(reads, key=get_str_seq, tempdir=tempdir,
                             max_items_in_memory=max_items_in_memory)
     elif key == 'coordinate':
@@ -303,7 +576,7 @@ def sort_fastx_files(in_fhands, key, index_fpath=None, directory=None,
                                        directory=directory,
                                        tempdir=tempdir)
     elif key == 'name':
-        reads = read_seqs(in_fhands)
+        reads = compact_seqs(read_seqs(in_fhands))
         return sorted_items(reads, key=get_name, tempdir=tempdir,
                             max_items_in_memory=max_items_in_memory)
     else:
@@ -0,0 +1,320 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It looks for a few short oligos, like adaptors, in the reads.
+
+It is an in process replacement of the blastn-short search done by
+BlasterForFewSubjects. The oligos are seeded with the words of blastn-short
+and every seed diagonal is aligned with a banded local alignment with the
+blastn-short scores. The alignments are filtered by the expect value, the
+identity and the length like the blast ones.
+'''
+
+from __future__ import division
+
+from math import log
+from string import maketrans
+
+from crumbs.seq import get_str_seq, get_name, get_length
+from crumbs.alignment_result import (QUERY, covered_segments_from_match_parts,
+                                     elongate_match_parts_till_global)
+from crumbs.blast import get_read_matched_segments
+
+# the blastn-short word size and scores
+WORD_SIZE = 7
+MATCH_SCORE = 1
+MISMATCH_SCORE = -3
+GAP_OPEN = 5
+GAP_EXTEND = 2
+
+# the Karlin-Altschul parameters used by blast for the 1/-3 scores
+_LAMBDA = 1.374
+_K = 0.711
+_H = 1.31
+
+# like in blast, only the seeds with an ungapped alignment with this score
+# (22 bits) are aligned with gaps
+_GAP_TRIGGER = int((22 * log(2) + log(_K)) / _LAMBDA + 0.5)
+
+# the diagonals that an alignment can move away from its seeds
+_BAND = 3
+
+_COMPLEMENT = maketrans('ACGTN', 'TGCAN')
+
+
+def _reverse_complement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def _get_search_space(oligo_length, db_length, num_seqs):
+    '''It returns the search space of an oligo in the reads.
+
+    The lengths are corrected by the expected length of an alignment like
+    blast does.
+    '''
+    length_adjustment = 0
+    for _ in range(5):
+        oligo_eff_length = oligo_length - length_adjustment
+        db_eff_length = db_length - num_seqs * length_adjustment
+        if oligo_eff_length < 1 or db_eff_length < 1:
+            break
+        new_adjustment = int(log(_K * oligo_eff_length * db_eff_length) / _H)
+        if new_adjustment == length_adjustment:
+            break
+        length_adjustment = min(new_adjustment, oligo_length - 1)
+    oligo_eff_length = max(oligo_length - length_adjustment, 1)
+    db_eff_length = max(db_length - num_seqs * length_adjustment, 1)
+    return oligo_eff_length * db_eff_length
+
+
+def _extend_gap(cell):
+    gap = (cell[0] - GAP_EXTEND,) + cell[1:4] + (cell[4] + 1,)
+    return gap if gap[0] > 0 else None
+
+
+def _open_gap(cell, gap):
+    'It returns the best gap, opened from the cell or extending the gap'
+    if cell is not None and cell[0] > 0:
+        opened = cell[0] - GAP_OPEN - GAP_EXTEND
+        if opened > 0 and (gap is None or opened >= gap[0] - GAP_EXTEND):
+            return (opened,) + cell[1:4] + (cell[4] + 1,)
+    return None if gap is None else _extend_gap(gap)
+
+
+def _align_in_band(query, subject, min_diagonal, max_diagonal):
+    '''It returns the best local alignment between the diagonals.
+
+    The diagonal of a cell is its subject position minus its query
+    position. The gaps have an affine cost. It returns the score, the query
+    and subject starts and ends and the identical and total columns.
+    '''
+    # every cell has the score, the starts, the identities and the columns of
+    # the best alignment that ends in it
+    best = None
+    prev_row, prev_gaps_in_subject = {}, {}
+    for q_idx, q_base in enumerate(query):
+        row, gaps_in_subject = {}, {}
+        gap_in_query = None
+        first = max(q_idx + min_diagonal, 0)
+        last = min(q_idx + max_diagonal, len(subject) - 1)
+        for s_idx in xrange(first, last + 1):
+            if subject[s_idx] == q_base:
+                score, ident = MATCH_SCORE, 1
+            else:
+                score, ident = MISMATCH_SCORE, 0
+            diagonal = prev_row.get(s_idx - 1)
+            if diagonal is not None and diagonal[0] > 0:
+                cell = (diagonal[0] + score, diagonal[1], diagonal[2],
+                        diagonal[3] + ident, diagonal[4] + 1)
+            else:
+                cell = (score, q_idx, s_idx, ident, 1)
+            # the alignments can only end with a match
+            if ident and (best is None or cell[0] > best[0]):
+                best = cell + (q_idx, s_idx)
+
+            # a gap in the subject comes from the previous query base and a
+            # gap in the query from the previous subject base
+            up_gap = _open_gap(prev_row.get(s_idx),
+                               prev_gaps_in_subject.get(s_idx))
+            if up_gap is not None:
+                gaps_in_subject[s_idx] = up_gap
+                if up_gap[0] > cell[0]:
+                    cell = up_gap
+            gap_in_query = _open_gap(row.get(s_idx - 1), gap_in_query)
+            if gap_in_query is not None and gap_in_query[0] > cell[0]:
+                cell = gap_in_query
+            row[s_idx] = cell
+        prev_row, prev_gaps_in_subject = row, gaps_in_subject
+    if best is None:
+        return None
+    score, q_start, s_start, identities, columns, q_end, s_end = best
+    return score, q_start, q_end, s_start, s_end, identities, columns
+
+
+def _ungapped_score(query, subject, diagonal):
+    'It returns the score of the best ungapped alignment in the diagonal'
+    best, score = 0, 0
+    for q_idx in xrange(max(-diagonal, 0),
+                        min(len(query), len(subject) - diagonal)):
+        if query[q_idx] == subject[q_idx + diagonal]:
+            score += MATCH_SCORE
+            if score > best:
+                best = score
+        else:
+            score += MISMATCH_SCORE
+            if score < 0:
+                score = 0
+    return best
+
+
+def _cluster_diagonals(diagonals):
+    'It groups the seed diagonals that can be covered by the same band'
+    diagonals = sorted(diagonals)
+    cluster = [diagonals[0], diagonals[0]]
+    for diagonal in diagonals[1:]:
+        if diagonal - cluster[1] > 2 * _BAND:
+            yield cluster
+            cluster = [diagonal, diagonal]
+        else:
+            cluster[1] = diagonal
+    yield cluster
+
+
+class OligoMatcher(object):
+    '''It looks for the oligos in the reads without running blast.
+
+    It has the same interface and filters as the BlasterForFewSubjects
+    used with the blastn-short task.
+    '''
+    def __init__(self, oligos, max_expect=0.0001, min_identity=87,
+                 min_length=13, elongate_for_global=False):
+        '''It inits the class.
+
+        oligos - The SeqWrappers to look for
+        max_expect - The expect of the alignments is calculated like in a
+                     blast with the oligos as queries and the reads as
+                     database
+        min_identity - The minimum identity percentage of every alignment
+        min_length - The minimum number of residues of the read covered by
+                     the alignments of an oligo
+        elongate_for_global - The alignments are elongated to cover the
+                              whole oligo
+        '''
+        self.max_expect = max_expect
+        self.min_identity = min_identity
+        self.min_length = min_length
+        self.elongate_for_global = elongate_for_global
+        self._oligos = []
+        self._words = {}
+        for oligo in oligos:
+            self._add_oligo(get_str_seq(oligo).upper())
+        self._match_parts = {}
+
+    def _add_oligo(self, oligo):
+        oligo_index = len(self._oligos)
+        self._oligos.append(oligo)
+        for strand, seq in ((1, oligo), (-1, _reverse_complement(oligo))):
+            for position in range(len(seq) - WORD_SIZE + 1):
+                word = seq[position:position + WORD_SIZE]
+                self._words.setdefault(word, []).append((oligo_index, strand,
+                                                         position))
+
+    def _find_seeds(self, read):
+        'It returns the diagonals of the seeds of every oligo and strand'
+        seeds = {}
+        words = self._words
+        for position in xrange(len(read) - WORD_SIZE + 1):
+            hits = words.get(read[position:position + WORD_SIZE])
+            if hits is None:
+                continue
+            for oligo_index, strand, oligo_position in hits:
+                key = oligo_index, strand
+                diagonal = position - oligo_position
+                try:
+                    seeds[key].add(diagonal)
+                except KeyError:
+                    seeds[key] = set([diagonal])
+        return seeds
+
+    def _create_match_part(self, alignment, oligo_length, strand):
+        'It returns a match part with the blast coordinates'
+        score, q_start, q_end, s_start, s_end, identities, columns = alignment
+        scores = {'identity': identities / columns * 100, 'score': score}
+        if strand == 1:
+            return {'query_start': q_start, 'query_end': q_end,
+                    'subject_start': s_start, 'subject_end': s_end,
+                    'scores': scores}
+        # blast gives the coordinates in the forward oligo and the reversed
+        # read ones
+        return {'query_start': oligo_length - 1 - q_end,
+                'query_end': oligo_length - 1 - q_start,
+                'subject_start': s_end, 'subject_end': s_start,
+                'scores': scores}
+
+    def _match_read(self, read, min_scores):
+        'It returns the match parts of every oligo in the read'
+        matches = {}
+        for (oligo_index, strand), diagonals in self._find_seeds(read).items():
+            oligo = self._oligos[oligo_index]
+            if strand == -1:
+                oligo = _reverse_complement(oligo)
+            min_score = min_scores[oligo_index]
+            diagonals = [diagonal for diagonal in diagonals
+                         if _ungapped_score(oligo, read,
+                                            diagonal) >= _GAP_TRIGGER]
+            if not diagonals:
+                continue
+            for min_diagonal, max_diagonal in _cluster_diagonals(diagonals):
+                alignment = _align_in_band(oligo, read, min_diagonal - _BAND,
+                                           max_diagonal + _BAND)
+                if alignment is None or alignment[0] < min_score:
+                    continue
+                match_part = self._create_match_part(alignment, len(oligo),
+                                                     strand)
+                if match_part['scores']['identity'] < self.min_identity:
+                    continue
+                match_parts = matches.setdefault(oligo_index, [])
+                if match_part not in match_parts:
+                    match_parts.append(match_part)
+        return matches
+
+    def _get_min_scores(self, db_length, num_seqs):
+        'It returns the minimum score of every oligo for the max expect'
+        min_scores = []
+        for oligo in self._oligos:
+            search_space = _get_search_space(len(oligo), db_length, num_seqs)
+            # expect = K * search_space * exp(-lambda * score)
+            min_score = log(_K * search_space / self.max_expect) / _LAMBDA
+            min_scores.append(min_score)
+        return min_scores
+
+    def match_seqs(self, seqs):
+        '''It looks for the oligos in the given reads.
+
+        The matches of the previous reads are forgotten.
+        '''
+        seqs = list(seqs)
+        db_length = sum(get_length(seq) for seq in seqs)
+        min_scores = self._get_min_scores(db_length, len(seqs))
+        indexed_match_parts = {}
+        for seq in seqs:
+            read = get_str_seq(seq).upper()
+            read_match_parts = []
+            for oligo_index, match_parts in self._match_read(read,
+                                                         min_scores).items():
+                segments = covered_segments_from_match_parts(match_parts,
+                                                             in_query=False)
+                length = sum(end - start + 1 for start, end in segments)
+                if length < self.min_length:
+                    continue
+                if self.elongate_for_global:
+                    oligo_length = len(self._oligos[oligo_index])
+                    elongate_match_parts_till_global(match_parts,
+                                                  query_length=oligo_length,
+                                                  subject_length=len(read),
+                                                  align_completely=QUERY)
+                read_match_parts.extend(match_parts)
+            if read_match_parts:
+                indexed_match_parts[get_name(seq)] = read_match_parts
+        self._match_parts = indexed_match_parts
+
+    def get_matched_segments_for_read(self, read_name):
+        'It returns the matched segments for any oligo'
+        try:
+            match_parts = self._match_parts[read_name]
+        except KeyError:
+            # There was no match
+            return None
+        return get_read_matched_segments(match_parts)
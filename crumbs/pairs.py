@@ -20,7 +20,7 @@ from toolz import first
 from crumbs.exceptions import (PairDirectionError, InterleaveError,
                                ItemsNotSortedError)
 from crumbs.seqio import write_seqs
-from crumbs.seq import get_title, get_name
+from crumbs.seq import get_title, get_name, compact_seqs
 from crumbs.utils.tags import FWD, REV
 from crumbs.utils.file_utils import flush_fhand
 from crumbs.iterutils import sorted_items, group_in_packets_fill_last
@@ -55,7 +55,8 @@ def _get_paired_and_orphan(reads, ordered, max_reads_memory, temp_dir):
     else:
         def _key(seq):
             return get_title(seq)
-        sorted_reads = sorted_items(reads, _key, max_reads_memory, temp_dir)
+        sorted_reads = sorted_items(compact_seqs(reads), _key,
+                                    max_reads_memory, temp_dir)
     return group_pairs_by_name(sorted_reads)
 
 
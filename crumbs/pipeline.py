@@ -0,0 +1,298 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''Several filters and trimmers run on the same seq packets.
+
+The seqs are parsed once, every packet goes through all the steps in the
+same process and the passed, filtered out and orphan seqs are written once,
+like piping the crumbs, but without parsing and writing the seqs between
+them.
+'''
+
+import ast
+from time import time
+
+from crumbs import filters, trim
+from crumbs.filters import seq_to_filterpackets
+from crumbs.trim import TrimOrMask
+from crumbs.seqio import read_seq_packets, write_seqs, AdaptivePacketizer
+from crumbs.seq_batch import NUMPY_AVAILABLE
+from crumbs.settings import get_setting
+from crumbs.utils.seq_utils import process_seq_packets, report_packet_sizes
+from crumbs.utils.tags import (SEQS_PASSED, SEQS_FILTERED_OUT, ORPHAN_SEQS,
+                               SEQ_BATCH, PIPELINE_STATS)
+
+# the crumbs that can be used as a step, their classes and the defaults of
+# the crumb arguments that differ from the class ones
+_QUALITY_TRIM_DEFAULTS = {'window': get_setting('DEFAULT_QUALITY_TRIM_WINDOW'),
+                    'threshold': get_setting('DEFAULT_QUALITY_TRIM_TRESHOLD')}
+STEP_CRUMBS = {'filter_by_length': (filters.FilterByLength, {}),
+               'filter_by_quality': (filters.FilterByQuality, {}),
+               'filter_by_complexity': (filters.FilterDustComplexity, {}),
+               'filter_all_ns': (filters.FilterAllNs, {}),
+               'filter_by_bowtie2': (filters.FilterBowtie2Match,
+                              {'min_mapq': get_setting('DEFAULT_MIN_MAPQ')}),
+               'trim_edges': (trim.TrimEdges, {}),
+               'trim_quality': (trim.TrimByQuality, _QUALITY_TRIM_DEFAULTS),
+               'trim_by_case': (trim.TrimLowercasedLetters, {}),
+               'trim_nextera_adapters': (trim.Trim3PrimeAdapters, {}),
+               'trim_or_mask': (TrimOrMask, {})}
+
+
+def _get_step_class(name):
+    '''It returns the filter or trimmer class for a crumb or class name.
+
+    It also returns the default arguments of the crumb.
+    '''
+    if name in STEP_CRUMBS:
+        return STEP_CRUMBS[name]
+    if name.startswith('Filter'):
+        module = filters
+    elif name.startswith('Trim'):
+        module = trim
+    else:
+        module = None
+    klass = getattr(module, name, None)
+    if not isinstance(klass, type):
+        raise ValueError('Unknown filter or trimmer: ' + name)
+    return klass, {}
+
+
+def parse_step(step):
+    '''It returns the name, the class and the keyword arguments of a step.
+
+    The step is written like a python call, e.g. "trim_edges(left=3)" or
+    "FilterByLength(minimum=50)". The arguments should be literals and the
+    parentheses can be omitted if there are no arguments.
+    '''
+    try:
+        expression = ast.parse(step.strip(), mode='eval').body
+    except SyntaxError:
+        raise ValueError('Malformed step: ' + step)
+    if isinstance(expression, ast.Name):
+        name, kwargs = expression.id, {}
+    elif (isinstance(expression, ast.Call) and
+          isinstance(expression.func, ast.Name) and not expression.args and
+          expression.starargs is None and expression.kwargs is None):
+        name = expression.func.id
+        try:
+            kwargs = {keyword.arg: ast.literal_eval(keyword.value)
+                      for keyword in expression.keywords}
+        except ValueError:
+            msg = 'The step arguments should be literals: ' + step
+            raise ValueError(msg)
+    else:
+        msg = 'A step should be a crumb with keyword arguments: ' + step
+        raise ValueError(msg)
+    klass, default_kwargs = _get_step_class(name)
+    default_kwargs = default_kwargs.copy()
+    default_kwargs.update(kwargs)
+    return name, klass, default_kwargs
+
+
+def _is_filter(function):
+    return isinstance(function, filters._BaseFilter)
+
+
+def create_pipeline_steps(steps, mask=False, failed_drags_pair=None):
+    '''It creates the filters and trimmers from the steps.
+
+    Every trimmer is followed by a TrimOrMask, like in the trim crumbs,
+    unless the next step is a trim_or_mask. If failed_drags_pair is given
+    it is used by the filters that do not set it.
+    It returns a list of (name, function) tuples.
+    '''
+    steps = [parse_step(step) for step in steps]
+    pipeline_steps = []
+    for index, (name, klass, kwargs) in enumerate(steps):
+        try:
+            function = klass(**kwargs)
+        except TypeError, error:
+            raise ValueError('Wrong arguments for {}: {}'.format(name, error))
+        if (failed_drags_pair is not None and _is_filter(function) and
+                'failed_drags_pair' not in kwargs):
+            function.failed_drags_pair = failed_drags_pair
+        pipeline_steps.append((name, function))
+        next_class = steps[index + 1][1] if index + 1 < len(steps) else None
+        if (not _is_filter(function) and klass is not TrimOrMask and
+                next_class is not TrimOrMask):
+            pipeline_steps.append(('trim_or_mask', TrimOrMask(mask=mask)))
+    return pipeline_steps
+
+
+def seq_to_pipeline_packets(seq_packets, group_paired_reads=False):
+    'It yields packets suitable for a Pipeline'
+    for packet in seq_to_filterpackets(seq_packets,
+                                       group_paired_reads=group_paired_reads):
+        packet[ORPHAN_SEQS] = []
+        yield packet
+
+
+def _count_seqs(pairs):
+    return sum(len(pair) for pair in pairs)
+
+
+class Pipeline(object):
+    '''It runs the filters and trimmers one after the other on a packet.
+
+    The packet has the seqs passed, the pairs filtered out and the orphan
+    seqs of all the steps. Every step only gets the seqs passed by the
+    previous one. The seqs in, passed, filtered out and orphaned and the
+    seconds taken by every step are added to the packet PIPELINE_STATS.
+    '''
+    def __init__(self, steps):
+        'steps should be a list of (name, filter or trimmer) tuples'
+        self.steps = steps
+
+    def uses_seq_batches(self):
+        'It returns True if some filter can check the packets as SeqBatches'
+        return any(getattr(function, '_do_check_batch', None) is not None
+                   for _, function in self.steps)
+
+    def __call__(self, packet):
+        seqs_passed = packet[SEQS_PASSED]
+        filtered_out = packet[SEQS_FILTERED_OUT][:]
+        orphans = packet[ORPHAN_SEQS][:]
+        batch = packet.get(SEQ_BATCH)
+        stats = []
+        for _, function in self.steps:
+            start = time()
+            seqs_in = _count_seqs(seqs_passed)
+            if _is_filter(function):
+                step_packet = {SEQS_PASSED: seqs_passed,
+                               SEQS_FILTERED_OUT: []}
+                if batch is not None:
+                    step_packet[SEQ_BATCH] = batch
+                step_packet = function(step_packet)
+                # a filter with a batch implementation returns the new one
+                batch = step_packet.get(SEQ_BATCH)
+                step_filtered = _count_seqs(step_packet[SEQS_FILTERED_OUT])
+                filtered_out.extend(step_packet[SEQS_FILTERED_OUT])
+                step_orphans = 0
+            else:
+                step_packet = function({SEQS_PASSED: seqs_passed,
+                                        ORPHAN_SEQS: []})
+                # the trimmed seqs are not the ones in the batch
+                batch = None
+                step_filtered = 0
+                step_orphans = len(step_packet[ORPHAN_SEQS])
+                orphans.extend(step_packet[ORPHAN_SEQS])
+            seqs_passed = step_packet[SEQS_PASSED]
+            stats.append((seqs_in, _count_seqs(seqs_passed), step_filtered,
+                          step_orphans, time() - start))
+        packet = {SEQS_PASSED: seqs_passed, SEQS_FILTERED_OUT: filtered_out,
+                  ORPHAN_SEQS: orphans, PIPELINE_STATS: stats}
+        if batch is not None:
+            packet[SEQ_BATCH] = batch
+        return packet
+
+    def close(self):
+        'It closes the steps that run external programs'
+        for _, function in self.steps:
+            if hasattr(function, 'close'):
+                function.close()
+
+
+class PipelineReport(object):
+    'It adds the stats of every step for all the processed packets'
+    _fields = ('seqs_in', 'seqs_passed', 'seqs_filtered_out',
+               'seqs_orphaned', 'seconds')
+
+    def __init__(self, step_names):
+        self.step_names = step_names
+        self.stats = [[0] * len(self._fields) for _ in step_names]
+
+    def add_packet_stats(self, packet_stats):
+        'It adds the stats of a processed packet'
+        for step_stats, packet_step_stats in zip(self.stats, packet_stats):
+            for index, value in enumerate(packet_step_stats):
+                step_stats[index] += value
+
+    def get_step_stats(self):
+        'It returns a list of (name, stats dict) tuples'
+        return [(name, dict(zip(self._fields, stats)))
+                for name, stats in zip(self.step_names, self.stats)]
+
+    def get_report(self):
+        'It returns a table with the stats of every step'
+        width = max([len(name) for name in self.step_names] + [4])
+        header = '{:<{}}  {:>10}  {:>10}  {:>10}  {:>10}  {:>10}  {:>9}\n'
+        line = '{:<{}}  {:>10}  {:>10}  {:>10}  {:>10}  {:>10}  {:>9.2f}\n'
+        report = header.format('step', width, 'seqs in', 'passed',
+                               'removed', 'filtered', 'orphaned', 'seconds')
+        for name, stats in self.get_step_stats():
+            removed = stats['seqs_in'] - stats['seqs_passed']
+            report += line.format(name, width, stats['seqs_in'],
+                                  stats['seqs_passed'], removed,
+                                  stats['seqs_filtered_out'],
+                                  stats['seqs_orphaned'], stats['seconds'])
+        return report
+
+
+def write_pipeline_packets(passed_fhand, filtered_fhand, orphan_fhand,
+                           packets, file_format='fastq', workers=None,
+                           report=None):
+    '''It writes the passed, filtered out and orphan seqs of the packets.
+
+    If a PipelineReport is given the stats of the packets are added to it.
+    '''
+    flatten_pairs = lambda pairs: (seq for pair in pairs for seq in pair)
+    try:
+        for packet in packets:
+            write_seqs(flatten_pairs(packet[SEQS_PASSED]), fhand=passed_fhand,
+                       file_format=file_format)
+            if filtered_fhand is not None:
+                write_seqs(flatten_pairs(packet[SEQS_FILTERED_OUT]),
+                           fhand=filtered_fhand, file_format=file_format)
+            if orphan_fhand is not None:
+                write_seqs(packet[ORPHAN_SEQS], fhand=orphan_fhand,
+                           file_format=file_format)
+            if report is not None:
+                report.add_packet_stats(packet[PIPELINE_STATS])
+    except BaseException:
+        if workers is not None:
+            workers.terminate()
+        raise
+
+
+def process_pipeline(in_fhands, pipeline, passed_fhand, filtered_fhand=None,
+                     orphan_fhand=None, out_format=None, processes=1,
+                     paired_reads=False, packet_size=None):
+    '''It reads the seqs once, it runs the pipeline and it writes them once.
+
+    The packets are processed in this process or sent to a pool of workers
+    like in process_seq_files. It returns a PipelineReport.
+    '''
+    if packet_size is None:
+        packet_size = get_setting('PACKET_SIZE')
+    packetizer = None
+    if get_setting('ADAPTIVE_PACKET_SIZE'):
+        packetizer = AdaptivePacketizer(seqs_multiple=2 if paired_reads
+                                                                      else 1)
+    batches = (NUMPY_AVAILABLE and get_setting('BATCH_FILTERS') and
+               pipeline.uses_seq_batches())
+    seq_packets = read_seq_packets(in_fhands, size=packet_size,
+                                   packetizer=packetizer, batches=batches)
+    packets = seq_to_pipeline_packets(seq_packets,
+                                      group_paired_reads=paired_reads)
+    packets, workers = process_seq_packets(packets, [pipeline],
+                                           processes=processes,
+                                           packetizer=packetizer)
+    report = PipelineReport([name for name, _ in pipeline.steps])
+    write_pipeline_packets(passed_fhand, filtered_fhand, orphan_fhand,
+                           packets, out_format, workers=workers,
+                           report=report)
+    report_packet_sizes(packetizer)
+    return report
@@ -14,7 +14,8 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 from copy import deepcopy
-from collections import namedtuple
+from collections import namedtuple, Counter
+from array import array
 
 from crumbs.utils.optional_modules import SeqRecord
 from crumbs.utils.tags import (SEQITEM, SEQRECORD, ILLUMINA_QUALITY,
@@ -36,6 +37,202 @@ class SeqItem(_SeqItem):
         # add default values
         return super(SeqItem, cls).__new__(cls, name, lines, annotations)
 
+    @property
+    def derived_views(self):
+        '''A cache for the values derived from the record.
+
+        The instance dict is used, so it is not pickled.
+        '''
+        return self.__dict__
+
+
+class MappedSeqLines(object):
+    '''The lines of a record stored in a memory mapped file or a string.
+
+    The lines are offsets into the shared mmap and they are only copied into
+    strings when they are requested. The record can be written without
+    copying it with get_buffer.
+    '''
+    __slots__ = ('_mmap', '_offsets')
+
+    def __init__(self, mmap_, offsets):
+        '''The initiator.
+
+        offsets - the start of every line and the end of the last one
+        '''
+        self._mmap = mmap_
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[idx] for idx in range(*index.indices(len(self)))]
+        offsets = self._offsets
+        if index < 0:
+            index += len(offsets) - 1
+        if index < 0 or index >= len(offsets) - 1:
+            raise IndexError('line index out of range')
+        return self._mmap[offsets[index]:offsets[index + 1]]
+
+    def __iter__(self):
+        mmap_ = self._mmap
+        offsets = self._offsets
+        for index in range(len(offsets) - 1):
+            yield mmap_[offsets[index]:offsets[index + 1]]
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __reduce__(self):
+        # The mmap can not be pickled, the lines are copied into a list
+        return (list, (list(self),))
+
+    def get_buffer(self):
+        'It returns a buffer with the whole record'
+        start = self._offsets[0]
+        return buffer(self._mmap, start, self._offsets[-1] - start)
+
+
+class CompactSeqItem(object):
+    '''A SeqItem that stores its record in one string.
+
+    The annotations dict is only created when it is used, so a read held in
+    memory takes much less space than with a SeqItem.
+    '''
+    __slots__ = ('name', '_record', '_offsets', '_annotations')
+
+    def __init__(self, name, record, offsets=None, annotations=None):
+        '''The initiator.
+
+        offsets - the start of every line and the end of the last one. They
+        are not required if every line ends with its only newline.
+        '''
+        self.name = name
+        self._record = record
+        self._offsets = offsets
+        self._annotations = annotations if annotations else None
+
+    @classmethod
+    def from_seqitem(cls, seqitem):
+        'It creates a CompactSeqItem with the lines of a SeqItem'
+        lines = seqitem.lines
+        record = ''.join(lines)
+        if (record.count('\n') == len(lines) and record[-1:] == '\n' and
+                '\r' not in record):
+            # the lines can be found splitting the record
+            offsets = None
+        else:
+            offsets = [0]
+            for line in lines:
+                offsets.append(offsets[-1] + len(line))
+            offsets = tuple(offsets)
+        return cls(seqitem.name, record, offsets, seqitem.annotations)
+
+    @property
+    def lines(self):
+        if self._offsets is None:
+            return self._record.splitlines(True)
+        return MappedSeqLines(self._record, self._offsets)
+
+    @property
+    def annotations(self):
+        if self._annotations is None:
+            self._annotations = {}
+        return self._annotations
+
+    def get_buffer(self):
+        'It returns the whole record'
+        return self._record
+
+    # The derived values are not cached to keep the item compact
+    derived_views = None
+
+    def __eq__(self, other):
+        try:
+            return (self.name == other.name and self.lines == other.lines and
+                    self.annotations == other.annotations)
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CompactSeqItem(name=%r, lines=%r, annotations=%r)' % \
+                                    (self.name, self.lines, self.annotations)
+
+    def __reduce__(self):
+        return (CompactSeqItem, (self.name, self._record, self._offsets,
+                                 self._annotations))
+
+
+def compact_seqs(seqs):
+    '''It yields the seqs with their SeqItems replaced by CompactSeqItems.
+
+    It is useful to hold many reads in memory. Other seqs are not modified.
+    '''
+    for seq in seqs:
+        if seq.kind == SEQITEM and not isinstance(seq.object, CompactSeqItem):
+            seq = SeqWrapper(SEQITEM, CompactSeqItem.from_seqitem(seq.object),
+                             seq.file_format)
+        yield seq
+
+
+_VIEW_CACHE_HITS = Counter()
+_VIEW_CACHE_MISSES = Counter()
+
+
+def get_derived_view(seq, view, derive, key=None):
+    '''It returns a value derived from a SeqItem computing it only once.
+
+    The value is cached in the SeqItem, so copy_seq and slice_seq, that
+    create new SeqItems, invalidate it. The cached values should not be
+    modified. It is worth it only for the values expensive to compute, a
+    cache lookup costs as much as stripping the sequence line.
+    key - the other arguments the value depends on
+    '''
+    views = seq.object.derived_views if seq.kind == SEQITEM else None
+    if views is None:
+        return derive(seq)
+    cached = views.get(view)
+    if cached is None or cached[0] != key:
+        _VIEW_CACHE_MISSES[view] += 1
+        cached = views[view] = key, derive(seq)
+    else:
+        _VIEW_CACHE_HITS[view] += 1
+    return cached[1]
+
+
+def get_view_cache_stats():
+    'It returns the hits, misses and hit rate of every cached view'
+    stats = {}
+    for view in set(_VIEW_CACHE_HITS) | set(_VIEW_CACHE_MISSES):
+        hits = _VIEW_CACHE_HITS[view]
+        misses = _VIEW_CACHE_MISSES[view]
+        stats[view] = {'hits': hits, 'misses': misses,
+                       'hit_rate': hits / float(hits + misses)}
+    return stats
+
+
+def reset_view_cache_stats():
+    _VIEW_CACHE_HITS.clear()
+    _VIEW_CACHE_MISSES.clear()
+
 
 def get_title(seq):
     'Given a seq it returns the title'
@@ -124,6 +321,52 @@ def get_length(seq):
 
 SANGER_QUALS = {chr(i): i - 33 for i in range(33, 127)}
 ILLUMINA_QUALS = {chr(i): i - 64 for i in range(64, 127)}
+SANGER_STRS = {i - 33: chr(i) for i in range(33, 127)}
+ILLUMINA_STRS = {i - 64: chr(i) for i in range(64, 127)}
+
+# The qualities are encoded and decoded with str.translate tables.
+# The characters or integers not valid for a format are translated to
+# _INVALID_QUAL, that is not a valid encoded or decoded quality.
+_INVALID_QUAL = '\xff'
+
+
+def _build_translate_table(first, last, shift):
+    'It translates the characters from first to last - 1 adding shift'
+    table = [_INVALID_QUAL] * 256
+    for code in range(first, last):
+        table[code] = chr(code + shift)
+    return ''.join(table)
+
+_ENCODED_TO_INT = {SANGER_QUALITY: _build_translate_table(33, 127, -33),
+                   ILLUMINA_QUALITY: _build_translate_table(64, 127, -64)}
+_INT_TO_ENCODED = {SANGER_QUALITY: _build_translate_table(0, 94, 33),
+                   ILLUMINA_QUALITY: _build_translate_table(0, 63, 64)}
+_REENCODE = {(SANGER_QUALITY, ILLUMINA_QUALITY):
+             _build_translate_table(33, 96, 31),
+             (ILLUMINA_QUALITY, SANGER_QUALITY):
+             _build_translate_table(64, 127, -31)}
+
+
+def _get_quality_format(file_format):
+    if file_format in SANGER_FASTQ_FORMATS:
+        return SANGER_QUALITY
+    elif file_format in ILLUMINA_FASTQ_FORMATS:
+        return ILLUMINA_QUALITY
+    return file_format
+
+
+def _translate_quals(quals, table, what):
+    translated = quals.translate(table)
+    if _INVALID_QUAL in translated:
+        raise ValueError('Quality not valid for the ' + what)
+    return translated
+
+
+def _decode_quals(encoded_quals, qual_format):
+    'It returns the integer qualities as an array of unsigned chars'
+    return array('B', _translate_quals(encoded_quals,
+                                       _ENCODED_TO_INT[qual_format],
+                                       qual_format + ' format'))
 
 
 def _get_seqitem_qualities(seqwrap):
@@ -132,20 +375,28 @@ def _get_seqitem_qualities(seqwrap):
         raise AttributeError('A fasta file has no qualities')
     elif 'fastq' in fmt:
         if 'illumina' in fmt:
-            quals_map = ILLUMINA_QUALS
+            qual_format = ILLUMINA_QUALITY
         else:
-            quals_map = SANGER_QUALS
+            qual_format = SANGER_QUALITY
         encoded_quals = seqwrap.object.lines[3].rstrip()
-        quals = [quals_map[qual] for qual in encoded_quals]
+        quals = _decode_quals(encoded_quals, qual_format)
     else:
         raise RuntimeError('Qualities requested for an unknown SeqItem format')
     return quals
 
 
 def get_int_qualities(seq):
+    '''It returns the phred qualities.
+
+    For SeqItems they are returned in a compact array('B'). It can be used as
+    a NumPy uint8 array with numpy.frombuffer. It is cached, so it should not
+    be modified.
+    '''
     seq_class = seq.kind
     if seq_class == SEQITEM:
-        return _get_seqitem_qualities(seq)
+        # the same SeqItem could be wrapped with another fastq format
+        return get_derived_view(seq, 'int_qualities', _get_seqitem_qualities,
+                                key=seq.file_format)
     elif seq_class == SEQRECORD:
         try:
             quals = seq.object.letter_annotations['phred_quality']
@@ -155,53 +406,128 @@ def get_int_qualities(seq):
         return quals
 
 
-SANGER_STRS = {i - 33: chr(i)  for i in range(33, 127)}
-ILLUMINA_STRS = {i - 64: chr(i) for i in range(64, 127)}
-
-
 def _int_quals_to_str_quals(int_quals, out_format):
-    if out_format == SANGER_QUALITY:
-        quals_map = SANGER_STRS
-    elif out_format == ILLUMINA_QUALITY:
-        quals_map = ILLUMINA_STRS
-    else:
+    if out_format not in _INT_TO_ENCODED:
         msg = 'Unknown or not supported quality format'
         raise ValueError(msg)
-    return ''.join([quals_map[int_quality] for int_quality in int_quals])
+    if not isinstance(int_quals, array) or int_quals.typecode != 'B':
+        try:
+            int_quals = array('B', int_quals)
+        except OverflowError:
+            raise ValueError('Quality not valid for the ' + out_format +
+                             ' format')
+    return _translate_quals(int_quals.tostring(), _INT_TO_ENCODED[out_format],
+                            out_format + ' format')
+
+
+def _get_seqitem_str_qualities(seq, out_format):
+    in_format = seq.file_format
+    if 'fasta' in in_format:
+        raise ValueError('A fasta file has no qualities')
+    in_format = _get_quality_format(in_format)
+    if in_format not in _ENCODED_TO_INT:
+        msg = 'Unknown or not supported quality format: '
+        msg += in_format
+        raise ValueError(msg)
+    quals = seq.object.lines[3].rstrip()
+    if in_format != out_format:
+        try:
+            table = _REENCODE[in_format, out_format]
+        except KeyError:
+            raise ValueError('Unknown or not supported quality format')
+        quals = _translate_quals(quals, table, out_format + ' format')
+    return quals
 
 
 def get_str_qualities(seq, out_format=None):
     if out_format is None:
         out_format = seq.file_format
-    if out_format in SANGER_FASTQ_FORMATS:
-        out_format = SANGER_QUALITY
-    elif out_format in ILLUMINA_FASTQ_FORMATS:
-        out_format = ILLUMINA_QUALITY
+    out_format = _get_quality_format(out_format)
 
     seq_class = seq.kind
     if seq_class == SEQITEM:
-        in_format = seq.file_format
-        if 'fasta' in in_format:
-            raise ValueError('A fasta file has no qualities')
-        if in_format in SANGER_FASTQ_FORMATS:
-            in_format = SANGER_QUALITY
-        elif in_format in ILLUMINA_FASTQ_FORMATS:
-            in_format = ILLUMINA_QUALITY
-        else:
-            msg = 'Unknown or not supported quality format: '
-            msg += in_format
-            raise ValueError(msg)
-        if in_format == out_format:
-            quals = seq.object.lines[3].rstrip()
-        else:
-            int_quals = get_int_qualities(seq)
-            quals = _int_quals_to_str_quals(int_quals, out_format)
+        quals = _get_seqitem_str_qualities(seq, out_format)
     elif seq_class == SEQRECORD:
         int_quals = get_int_qualities(seq)
         quals = _int_quals_to_str_quals(int_quals, out_format)
     return quals
 
 
+def _group_by_format(seqs):
+    '''It yields the indexes and the qual format of the SeqItems in seqs.
+
+    Consecutive SeqItems with the same file format are grouped together.
+    Other seqs are yielded alone with a None qual format.
+    '''
+    group = []
+    group_format = None
+    for index, seq in enumerate(seqs):
+        if seq.kind == SEQITEM and 'fastq' in seq.file_format:
+            qual_format = _get_quality_format(seq.file_format)
+        else:
+            qual_format = None
+        if group and (qual_format != group_format or qual_format is None):
+            yield group, group_format
+            group = []
+        group.append(index)
+        group_format = qual_format
+    if group:
+        yield group, group_format
+
+
+def get_packet_int_qualities(seqs):
+    '''It returns the phred qualities of all seqs in a packet.
+
+    The qualities of the consecutive SeqItems with the same format are decoded
+    at once.
+    '''
+    qualities = []
+    for indexes, qual_format in _group_by_format(seqs):
+        if qual_format not in _ENCODED_TO_INT:
+            qualities.extend(get_int_qualities(seqs[idx]) for idx in indexes)
+            continue
+        encoded = [seqs[idx].object.lines[3].rstrip() for idx in indexes]
+        decoded = _decode_quals(''.join(encoded), qual_format)
+        start = 0
+        for quals in encoded:
+            end = start + len(quals)
+            qualities.append(decoded[start:end])
+            start = end
+    return qualities
+
+
+def get_packet_str_qualities(seqs, out_format=None):
+    '''It returns the encoded qualities of all seqs in a packet.
+
+    The qualities of the consecutive SeqItems with the same format are
+    re-encoded at once.
+    '''
+    qualities = []
+    for indexes, qual_format in _group_by_format(seqs):
+        if out_format is None:
+            seq_out_format = _get_quality_format(seqs[indexes[0]].file_format)
+        else:
+            seq_out_format = _get_quality_format(out_format)
+        if (qual_format not in _ENCODED_TO_INT or
+            qual_format == seq_out_format):
+            qualities.extend(get_str_qualities(seqs[idx], out_format)
+                             for idx in indexes)
+            continue
+        try:
+            table = _REENCODE[qual_format, seq_out_format]
+        except KeyError:
+            raise ValueError('Unknown or not supported quality format')
+        encoded = [seqs[idx].object.lines[3].rstrip() for idx in indexes]
+        reencoded = _translate_quals(''.join(encoded), table,
+                                     seq_out_format + ' format')
+        start = 0
+        for quals in encoded:
+            end = start + len(quals)
+            qualities.append(reencoded[start:end])
+            start = end
+    return qualities
+
+
 def get_annotations(seq):
     return seq.object.annotations
 
@@ -0,0 +1,124 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''Packets of seqs with their sequences and qualities in NumPy columns.
+
+A SeqBatch is a list of seqs, so it can be used as any other packet, but it
+also holds all its sequences in one uint8 array, all its qualities in
+another one and the offsets of every seq in them. The columns are created
+when they are first required and they are not pickled.
+NumPy is an optional requirement, without it there are no batches.
+'''
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # This is an optional requirement
+    numpy = None
+
+from crumbs.seq import get_str_seq, get_packet_int_qualities
+
+NUMPY_AVAILABLE = numpy is not None
+
+
+class SeqBatch(list):
+    'A packet of seqs with their sequences and qualities in columns'
+    def __init__(self, seqs=(), columns=None):
+        super(SeqBatch, self).__init__(seqs)
+        self._columns = {} if columns is None else columns
+
+    def __reduce__(self):
+        # the columns are not sent to the other processes
+        return (SeqBatch, (list(self),))
+
+    def _get_column(self, name, create):
+        column = self._columns.get(name)
+        if column is None:
+            column = self._columns[name] = create()
+        return column
+
+    def _create_seqs(self):
+        str_seqs = [get_str_seq(seq) for seq in self]
+        lengths = numpy.fromiter((len(str_seq) for str_seq in str_seqs),
+                                 dtype=numpy.int64, count=len(str_seqs))
+        offsets = numpy.zeros(len(str_seqs) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        self._columns['offsets'] = offsets
+        return numpy.frombuffer(''.join(str_seqs), dtype=numpy.uint8)
+
+    @property
+    def seqs(self):
+        'All the sequences, one after the other, as an uint8 array'
+        return self._get_column('seqs', self._create_seqs)
+
+    @property
+    def offsets(self):
+        'The start of every seq in the columns and the end of the last one'
+        if 'offsets' not in self._columns:
+            self.seqs
+        return self._columns['offsets']
+
+    @property
+    def lengths(self):
+        return numpy.diff(self.offsets)
+
+    def _create_quals(self):
+        quals = []
+        for seq_quals in get_packet_int_qualities(self):
+            if not isinstance(seq_quals, array) or seq_quals.typecode != 'B':
+                seq_quals = array('B', seq_quals)
+            quals.append(seq_quals.tostring())
+        quals = numpy.frombuffer(''.join(quals), dtype=numpy.uint8)
+        if len(quals) != self.offsets[-1]:
+            raise ValueError('Sequence and quality lengths do not match')
+        return quals
+
+    @property
+    def quals(self):
+        '''All the phred qualities as an uint8 array.
+
+        It raises an AttributeError if some seq has no qualities.
+        '''
+        return self._get_column('quals', self._create_quals)
+
+    def sum_per_seq(self, values):
+        'It returns the sum of the values (one per residue) of every seq'
+        offsets = self.offsets
+        cumsum = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+        numpy.cumsum(values, out=cumsum[1:])
+        return cumsum[offsets[1:]] - cumsum[offsets[:-1]]
+
+    def take(self, mask):
+        'It returns a SeqBatch with the seqs selected by the boolean mask'
+        seqs = [seq for seq, selected in zip(self, mask) if selected]
+        columns = {}
+        if 'offsets' in self._columns:
+            lengths = self.lengths
+            residue_mask = numpy.repeat(mask, lengths)
+            offsets = numpy.zeros(len(seqs) + 1, dtype=numpy.int64)
+            numpy.cumsum(lengths[mask], out=offsets[1:])
+            columns['offsets'] = offsets
+            for name in ('seqs', 'quals'):
+                if name in self._columns:
+                    columns[name] = self._columns[name][residue_mask]
+        return SeqBatch(seqs, columns)
+
+
+def create_seq_batches(seq_packets):
+    'It yields every seq packet as a SeqBatch'
+    for packet in seq_packets:
+        yield SeqBatch(packet)
@@ -0,0 +1,292 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''Persistent on-disk indexes of the records of fasta and fastq files.
+
+The index is a binary file stored next to the sequence file (with the
+.crumbs.idx extension). After a header with the size and modification time
+of the indexed file it holds one entry per record (name hash, byte offset,
+record length) sorted by hash, so a name can be found with a binary search
+on the memory mapped index. The index is rebuilt when the sequence file
+changes.
+'''
+
+import os
+import mmap
+import struct
+import hashlib
+from tempfile import NamedTemporaryFile
+import cStringIO
+
+from crumbs.exceptions import MalformedFile, UnknownFormatError
+from crumbs.iterutils import sorted_items
+from crumbs.settings import get_setting
+from crumbs.seq import SeqWrapper
+from crumbs.seqio import _itemize_fastx
+from crumbs.utils.file_formats import get_format
+from crumbs.utils.tags import SEQITEM
+
+INDEX_EXTENSION = '.crumbs.idx'
+
+_MAGIC = 'CRUMBIDX'
+_VERSION = 1
+# magic, version, indexed file size and mtime, number of records
+_HEADER = struct.Struct('<8sIQdQ')
+# name hash, record offset and record length
+_ENTRY = struct.Struct('<QQQ')
+
+_BETWEEN_RECORDS = 0
+_IN_FASTA = 1
+_IN_FASTQ_SEQ = 2
+_IN_FASTQ_QUAL = 3
+
+
+def _hash_name(name):
+    'It returns a 64 bit hash, stable across runs and platforms'
+    return struct.unpack('<Q', hashlib.md5(name).digest()[:8])[0]
+
+
+def _get_name_from_title(title):
+    return title[1:].rstrip('\r\n').partition(' ')[0]
+
+
+def _scan_fastx_records(fhand):
+    'It yields the name, offset and length of every fasta or fastq record'
+    offset = 0
+    state = _BETWEEN_RECORDS
+    name = start = seq_len = qual_len = None
+    for line in fhand:
+        if state == _IN_FASTQ_QUAL:
+            qual_len += len(line.rstrip())
+            if qual_len >= seq_len:
+                if qual_len != seq_len:
+                    msg = 'Malformed fastq file: seq and quality lines have '
+                    msg += 'different lengths for ' + name
+                    raise MalformedFile(msg)
+                yield name, start, offset + len(line) - start
+                state = _BETWEEN_RECORDS
+        elif state == _IN_FASTQ_SEQ:
+            if line[0] == '+':
+                state = _IN_FASTQ_QUAL
+                qual_len = 0
+                if not seq_len:
+                    yield name, start, offset + len(line) - start
+                    state = _BETWEEN_RECORDS
+            else:
+                seq_len += len(line.rstrip())
+        elif state == _IN_FASTA and line[0] != '>':
+            pass
+        elif line[0] in '>@':
+            if state == _IN_FASTA:
+                yield name, start, offset - start
+            start = offset
+            name = _get_name_from_title(line)
+            state = _IN_FASTA if line[0] == '>' else _IN_FASTQ_SEQ
+            seq_len = 0
+        elif not line.isspace():
+            msg = 'Malformed file, a line is out of any record: ' + line[:30]
+            raise MalformedFile(msg)
+        offset += len(line)
+    if state == _IN_FASTA:
+        yield name, start, offset - start
+    elif state != _BETWEEN_RECORDS:
+        msg = 'Malformed fastq file: the last record is truncated'
+        raise MalformedFile(msg)
+
+
+def _write_index(seq_fpath, index_fhand):
+    'It indexes the given sequence file'
+    stat = os.stat(seq_fpath)
+    records = _scan_fastx_records(open(seq_fpath, 'rb'))
+    entries = ((_hash_name(name), start, length)
+                                            for name, start, length in records)
+    max_entries_in_mem = get_setting('DEFAULT_SEQS_IN_MEM_LIMIT')
+    entries = sorted_items(entries, max_items_in_memory=max_entries_in_mem)
+    index_fhand.write(_HEADER.pack(_MAGIC, _VERSION, 0, 0, 0))
+    num_records = 0
+    pack = _ENTRY.pack
+    write = index_fhand.write
+    for entry in entries:
+        write(pack(*entry))
+        num_records += 1
+    # the header is completed once every record has been written
+    index_fhand.seek(0)
+    index_fhand.write(_HEADER.pack(_MAGIC, _VERSION, stat.st_size,
+                                   stat.st_mtime, num_records))
+    index_fhand.flush()
+
+
+def _index_is_valid(seq_fpath, index_fpath):
+    'It checks that the index exists and that it corresponds to the seq file'
+    try:
+        fhand = open(index_fpath, 'rb')
+    except IOError:
+        return False
+    header = fhand.read(_HEADER.size)
+    if len(header) != _HEADER.size:
+        return False
+    magic, version, size, mtime, num_records = _HEADER.unpack(header)
+    stat = os.stat(seq_fpath)
+    index_size = os.fstat(fhand.fileno()).st_size
+    return (magic == _MAGIC and version == _VERSION and
+            size == stat.st_size and mtime == stat.st_mtime and
+            index_size == _HEADER.size + num_records * _ENTRY.size)
+
+
+class SeqFileIndex(object):
+    '''An on-disk index to get the records of a fasta or fastq file by name.
+
+    The index is created, or updated, if required. If it can not be written
+    next to the sequence file a temporary one is used.
+    '''
+    def __init__(self, seq_fpath, index_fpath=None):
+        if index_fpath is None:
+            index_fpath = seq_fpath + INDEX_EXTENSION
+        self.seq_fpath = seq_fpath
+        self._seq_fhand = open(seq_fpath, 'rb')
+        file_format = get_format(self._seq_fhand)
+        if 'fasta' not in file_format and 'fastq' not in file_format:
+            msg = 'Only fasta and fastq files can be indexed, not: '
+            raise UnknownFormatError(msg + file_format)
+        self.file_format = file_format
+        self._temp_index = None
+        if not _index_is_valid(seq_fpath, index_fpath):
+            index_fpath = self._create_index(seq_fpath, index_fpath)
+        self.index_fpath = index_fpath
+        index_fhand = open(index_fpath, 'rb')
+        self._num_records = _HEADER.unpack(index_fhand.read(_HEADER.size))[4]
+        if self._num_records:
+            self._index = mmap.mmap(index_fhand.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        else:
+            self._index = None
+        index_fhand.close()
+
+    def _create_index(self, seq_fpath, index_fpath):
+        'It writes the index and it returns its path'
+        index_dir, index_fname = os.path.split(os.path.abspath(index_fpath))
+        try:
+            index_fhand = NamedTemporaryFile(dir=index_dir,
+                                             prefix=index_fname,
+                                             delete=False)
+        except (IOError, OSError):
+            # the sequence file directory could be read only
+            self._temp_index = NamedTemporaryFile(suffix=INDEX_EXTENSION)
+            _write_index(seq_fpath, self._temp_index)
+            return self._temp_index.name
+        try:
+            _write_index(seq_fpath, index_fhand)
+            index_fhand.close()
+            os.rename(index_fhand.name, index_fpath)
+        except:
+            index_fhand.close()
+            os.remove(index_fhand.name)
+            raise
+        return index_fpath
+
+    def __len__(self):
+        return self._num_records
+
+    def _get_entry(self, index):
+        return _ENTRY.unpack_from(self._index,
+                                  _HEADER.size + index * _ENTRY.size)
+
+    def _get_candidate_locations(self, name):
+        'It returns the offsets and lengths of the records with name hash'
+        if not self._num_records:
+            return []
+        hash_ = _hash_name(name)
+        # bisect left on the sorted hashes
+        low, high = 0, self._num_records
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_entry(middle)[0] < hash_:
+                low = middle + 1
+            else:
+                high = middle
+        locations = []
+        while low < self._num_records:
+            entry_hash, offset, length = self._get_entry(low)
+            if entry_hash != hash_:
+                break
+            locations.append((offset, length))
+            low += 1
+        return locations
+
+    def _read_record(self, offset, length):
+        self._seq_fhand.seek(offset)
+        return self._seq_fhand.read(length)
+
+    def get_record_locations(self, name):
+        'It returns the offsets and lengths of the records named name'
+        locations = []
+        for offset, length in self._get_candidate_locations(name):
+            # different names could share the hash
+            title = self._read_record(offset, min(length, len(name) + 2048))
+            if _get_name_from_title(title.split('\n', 1)[0]) == name:
+                locations.append((offset, length))
+        return locations
+
+    def __contains__(self, name):
+        return bool(self.get_record_locations(name))
+
+    def _build_seq(self, offset, length):
+        record = cStringIO.StringIO(self._read_record(offset, length))
+        seqitem = next(_itemize_fastx(record))
+        return SeqWrapper(SEQITEM, seqitem, self.file_format)
+
+    def get_seqs(self, name):
+        'It returns the seqs with the given name'
+        locations = self.get_record_locations(name)
+        return [self._build_seq(start, length) for start, length in locations]
+
+    def __getitem__(self, name):
+        seqs = self.get_seqs(name)
+        if not seqs:
+            raise KeyError(name)
+        return seqs[0]
+
+    def get_seqs_by_name(self, names):
+        '''It yields the seqs found with the given names.
+
+        The seqs are yielded in the file order and missing names are
+        ignored.
+        '''
+        locations = set()
+        for name in names:
+            locations.update(self.get_record_locations(name))
+        for offset, length in sorted(locations):
+            yield self._build_seq(offset, length)
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+        self._seq_fhand.close()
+        if self._temp_index is not None:
+            self._temp_index.close()
+
+
+def get_seqs_by_name(seq_fpath, names, index_fpath=None):
+    '''It yields the seqs of a fasta or fastq file with the given names.
+
+    It uses, and creates if required, the .crumbs.idx index of the file, so
+    only the requested records are read. The seqs are yielded in file order.
+    '''
+    index = SeqFileIndex(seq_fpath, index_fpath=index_fpath)
+    try:
+        for seq in index.get_seqs_by_name(names):
+            yield seq
+    finally:
+        index.close()
@@ -14,7 +14,13 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 
-from itertools import chain, tee, ifilter
+import os
+import math
+import mmap
+from stat import S_ISREG
+from itertools import chain, tee, ifilter, izip, islice
+from collections import deque
+from operator import itemgetter
 from shutil import copyfileobj
 from tempfile import NamedTemporaryFile
 import cStringIO
@@ -31,14 +37,18 @@ from crumbs.exceptions import (MalformedFile, error_quality_disagree,
                                UnknownFormatError, IncompatibleFormatError,
                                FileIsEmptyError, IsSingleLineFastqError)
 from crumbs.iterutils import group_in_packets, group_in_packets_fill_last
-from crumbs.utils.file_utils import rel_symlink, flush_fhand
+from crumbs.utils.file_utils import (rel_symlink, flush_fhand,
+                                     fhand_is_seekable)
 from crumbs.utils.file_formats import get_format, peek_chunk_from_file
 
 from crumbs.utils.tags import (GUESS_FORMAT, SEQS_PASSED, SEQS_FILTERED_OUT,
                                SEQITEM, SEQRECORD, ORPHAN_SEQS,
-                               SANGER_FASTQ_FORMATS, ILLUMINA_FASTQ_FORMATS)
+                               SANGER_FASTQ_FORMATS, ILLUMINA_FASTQ_FORMATS,
+                               LINE_READER, BLOCK_READER, MMAP_READER)
 from crumbs.settings import get_setting
-from crumbs.seq import SeqItem, get_str_seq, assing_kind_to_seqs
+from crumbs.seq_batch import create_seq_batches
+from crumbs.seq import (SeqItem, MappedSeqLines, CompactSeqItem, get_str_seq,
+                        get_str_qualities, assing_kind_to_seqs)
 
 # pylint: disable=C0111
 
@@ -155,12 +165,196 @@ def title2ids(title):
     return id_, name, desc
 
 
+def _get_seq_weight(seq):
+    'It returns the size of the record in bytes, about twice the seq length'
+    if seq.kind == SEQITEM:
+        if isinstance(seq.object, CompactSeqItem):
+            return len(seq.object.get_buffer())
+        return sum(map(len, seq.object.lines))
+    return 2 * len(seq.object)
+
+
+_SEQS_TO_WEIGHT = 100
+
+
+class AdaptivePacketizer(object):
+    '''It groups the seqs in packets with an adaptive size in bytes.
+
+    The processing time of every packet, including the time spent sending
+    it to the worker, should be recorded with record_cost. A fixed cost per
+    packet (e.g. running an external program) and a cost per byte are fitted
+    with the recent packets. The packets grow from initial_bytes until the
+    fixed cost is at most max_overhead of their time, but they are not made
+    bigger than what can be processed in target_secs, so they are small
+    enough to balance the load between processes, unless that is required
+    to amortize the fixed cost. The packet size is always kept between
+    min_bytes and max_bytes.
+    The number of seqs in a packet will be a multiple of seqs_multiple (2
+    for interleaved pairs).
+    '''
+    def __init__(self, target_secs=None, min_bytes=None, max_bytes=None,
+                 initial_bytes=None, max_overhead=None, seqs_multiple=1):
+        if target_secs is None:
+            target_secs = get_setting('PACKET_TARGET_SECONDS')
+        if min_bytes is None:
+            min_bytes = get_setting('PACKET_MIN_BYTES')
+        if max_bytes is None:
+            max_bytes = get_setting('PACKET_MAX_BYTES')
+        if initial_bytes is None:
+            initial_bytes = get_setting('PACKET_INITIAL_BYTES')
+        if max_overhead is None:
+            max_overhead = get_setting('PACKET_MAX_OVERHEAD')
+        self.target_secs = target_secs
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.max_overhead = max_overhead
+        self.seqs_multiple = seqs_multiple
+        self.initial_bytes = max(min_bytes, min(initial_bytes, max_bytes))
+        self.budget = self.initial_bytes
+        self.fixed_secs = None
+        self.secs_per_byte = None
+        self._packet_bytes = {}
+        self._costs = deque(maxlen=32)
+        self.stats = {'packets': 0, 'seqs': 0, 'bytes': 0,
+                      'min_seqs': None, 'max_seqs': None,
+                      'min_bytes': None, 'max_bytes': None}
+
+    def _register_packet(self, num_seqs, num_bytes):
+        stats = self.stats
+        self._packet_bytes[stats['packets']] = num_bytes
+        stats['packets'] += 1
+        stats['seqs'] += num_seqs
+        stats['bytes'] += num_bytes
+        for key, value in (('seqs', num_seqs), ('bytes', num_bytes)):
+            if stats['min_' + key] is None or value < stats['min_' + key]:
+                stats['min_' + key] = value
+            if stats['max_' + key] is None or value > stats['max_' + key]:
+                stats['max_' + key] = value
+
+    def _get_budget(self):
+        if self.stats['packets'] == 1:
+            # the second packet is bigger to fit the fixed cost
+            return min(self.budget * 2, self.max_bytes)
+        return self.budget
+
+    def _get_first_packet(self, seqs):
+        'It returns the first packet and the mean size of its seqs'
+        budget = self._get_budget()
+        packet, packet_bytes = [], 0
+        for seq in seqs:
+            packet.append(seq)
+            packet_bytes += _get_seq_weight(seq)
+            if (packet_bytes >= budget and
+                    not len(packet) % self.seqs_multiple):
+                break
+        return packet, packet_bytes / float(len(packet)) if packet else None
+
+    def group(self, seqs):
+        '''It yields the seqs in packets.
+
+        The size of the seqs is measured in a sample of every packet and the
+        next packet is created with the number of seqs that fits the budget.
+        '''
+        seqs = iter(seqs)
+        multiple = self.seqs_multiple
+        packet, bytes_per_seq = self._get_first_packet(seqs)
+        while packet:
+            num_seqs = len(packet)
+            self._register_packet(num_seqs, int(num_seqs * bytes_per_seq))
+            yield packet
+            sample = packet[::max(num_seqs // _SEQS_TO_WEIGHT, 1)]
+            bytes_per_seq = sum(map(_get_seq_weight, sample)) / \
+                                                            float(len(sample))
+            num_seqs = int(math.ceil(self._get_budget() / bytes_per_seq))
+            num_seqs += -num_seqs % multiple
+            packet = list(islice(seqs, num_seqs))
+
+    def record_cost(self, packet_index, secs):
+        'It records the processing time of a packet and it updates the size'
+        self._costs.append((self._packet_bytes.pop(packet_index), secs))
+        self._fit_costs()
+        self._update_budget()
+
+    def _fit_costs(self):
+        'It fits the fixed and per byte costs by least squares'
+        num = len(self._costs)
+        sum_x = float(sum(size for size, _ in self._costs))
+        sum_y = sum(secs for _, secs in self._costs)
+        sum_xx = sum(size ** 2 for size, _ in self._costs)
+        sum_xy = sum(size * secs for size, secs in self._costs)
+        variance = num * sum_xx - sum_x ** 2
+        fixed, rate = None, None
+        # there should be packets of quite different sizes
+        if num > 1 and variance > (0.1 * sum_x) ** 2:
+            rate = (num * sum_xy - sum_x * sum_y) / variance
+            fixed = (sum_y - rate * sum_x) / num
+            if fixed < 0 or rate <= 0:
+                fixed, rate = None, None
+        if rate is None:
+            # the last fixed cost is kept while the sizes do not change
+            fixed = self.fixed_secs if self.fixed_secs is not None else 0
+            rate = (sum_y - num * fixed) / sum_x if sum_x else 0
+            if rate <= 0:
+                fixed = 0
+                rate = sum_y / sum_x if sum_x else 0
+        self.fixed_secs = fixed
+        self.secs_per_byte = rate
+
+    def _update_budget(self):
+        fixed, rate = self.fixed_secs, self.secs_per_byte
+        if rate <= 0:
+            self.budget = self.initial_bytes
+            return
+        overhead = self.max_overhead
+        # the smallest packet with an acceptable fixed cost
+        amortized = fixed * (1 - overhead) / (overhead * rate)
+        lower = max(amortized, self.min_bytes)
+        # the biggest packet processed in the target time
+        balanced = (self.target_secs - fixed) / rate
+        upper = min(balanced, self.max_bytes)
+        if lower > upper:
+            budget = min(lower, self.max_bytes)
+        else:
+            budget = max(lower, min(self.initial_bytes, upper))
+        self.budget = int(budget)
+
+    def get_report(self):
+        'It returns a text with the sizes of the created packets'
+        stats = self.stats
+        if not stats['packets']:
+            return 'No seq packets created\n'
+        report = 'Seq packets: {packets}, seqs per packet: {min_seqs}-'
+        report += '{max_seqs} (mean {mean_seqs:.1f}), bytes per packet: '
+        report += '{min_bytes}-{max_bytes} (mean {mean_bytes:.0f}), last '
+        report += 'size: {budget} bytes'
+        num_packets = float(stats['packets'])
+        report = report.format(mean_seqs=stats['seqs'] / num_packets,
+                               mean_bytes=stats['bytes'] / num_packets,
+                               budget=self.budget, **stats)
+        if self.secs_per_byte is not None:
+            report += ', fixed cost: {:.4f} s, cost per MB: {:.4f} s'.format(
+                            self.fixed_secs, self.secs_per_byte * 1024 * 1024)
+        return report + '\n'
+
+
 def read_seq_packets(fhands, size=get_setting('PACKET_SIZE'), out_format=None,
-                     prefered_seq_classes=None):
-    '''It yields SeqItems in packets of the given size.'''
+                     prefered_seq_classes=None, seqitem_reader=None,
+                     packetizer=None, batches=False):
+    '''It yields SeqItems in packets of the given size.
+
+    If an AdaptivePacketizer is given it creates the packets and the size
+    is ignored. With batches the packets are SeqBatches (NumPy required).
+    '''
     seqs = read_seqs(fhands, out_format=out_format,
-                     prefered_seq_classes=prefered_seq_classes)
-    return group_in_packets(seqs, size)
+                     prefered_seq_classes=prefered_seq_classes,
+                     seqitem_reader=seqitem_reader)
+    if packetizer is not None:
+        packets = packetizer.group(seqs)
+    else:
+        packets = group_in_packets(seqs, size)
+    if batches:
+        packets = create_seq_batches(packets)
+    return packets
 
 
 def _read_seqrecord_packets(fhands, size=get_setting('PACKET_SIZE')):
@@ -193,8 +387,46 @@ def _read_seqrecords(fhands):
     return chain.from_iterable(seq_iters)
 
 
+_SEQITEM_CONVERSION_FORMATS = ('fasta',) + SANGER_FASTQ_FORMATS + \
+                                                        ILLUMINA_FASTQ_FORMATS
+
+
+def _copy_seq_file(in_fhand, out_fhand):
+    'It copies the file making sure that the last record ends with a new line'
+    block_size = get_setting('SEQITEM_READER_BLOCK_SIZE')
+    last_block = ''
+    while True:
+        block = in_fhand.read(block_size)
+        if not block:
+            break
+        out_fhand.write(block)
+        last_block = block
+    if last_block and not last_block.endswith('\n'):
+        out_fhand.write('\n')
+
+
+def _seqitem_seqio(in_fhands, in_formats, out_fhand, out_format):
+    '''It converts between fasta, fastq and fastq-illumina using SeqItems.
+
+    The files already in the output format are just copied.
+    '''
+    for in_fhand, in_format in zip(in_fhands, in_formats):
+        if in_format == out_format:
+            _copy_seq_file(in_fhand, out_fhand)
+            continue
+        if 'fasta' in in_format:
+            msg = 'No qualities available to write output file'
+            raise IncompatibleFormatError(msg)
+        seqs = read_seqs([in_fhand], prefered_seq_classes=[SEQITEM])
+        write_seqs(seqs, out_fhand, out_format)
+
+
 def seqio(in_fhands, out_fhand, out_format, copy_if_same_format=True):
-    'It converts sequence files between formats'
+    '''It converts sequence files between formats.
+
+    fasta, fastq and fastq-illumina files are converted using SeqItems, the
+    other formats are parsed by Biopython.
+    '''
     if out_format not in get_setting('SUPPORTED_OUTPUT_FORMATS'):
         raise IncompatibleFormatError("This output format is not supported")
 
@@ -205,6 +437,9 @@ def seqio(in_fhands, out_fhand, out_format, copy_if_same_format=True):
             copyfileobj(in_fhands[0], out_fhand)
         else:
             rel_symlink(in_fhands[0].name, out_fhand.name)
+    elif all(in_format in _SEQITEM_CONVERSION_FORMATS
+                                               for in_format in in_formats):
+        _seqitem_seqio(in_fhands, in_formats, out_fhand, out_format)
     else:
         seqs = _read_seqrecords(in_fhands)
         try:
@@ -313,6 +548,11 @@ def _itemize_fastx_multiline(fhand):  # this is a generator function
                 if line[0] in '@>':  # fasta/q header line
                     last_line = line  # save this line
                     break
+                elif not line.isspace():
+                    # usually a quality line after the complete quality
+                    msg = 'Lengths of sequence and quality values differ or '
+                    msg += 'a line is out of any record: ' + line[:30]
+                    raise MalformedFile(msg)
         if not last_line:
             break
         title = last_line
@@ -361,12 +601,305 @@ def _itemize_fastx_multiline(fhand):  # this is a generator function
         raise FileIsEmptyError('File is empty')
 
 
-def _read_seqitems(fhands):
+def _fallback_to_line_itemizer(buf, fhand, is_empty):
+    'It parses the rest of the file with the line by line itemizer'
+    # we have to complete the last, partially read, line
+    if buf and not buf.endswith('\n'):
+        buf += fhand.readline()
+    lines = chain(cStringIO.StringIO(buf), fhand)
+    try:
+        for seq in _itemize_fastx(lines):
+            yield seq
+    except FileIsEmptyError:
+        if is_empty:
+            raise
+
+
+def _split_block_in_lines(buf):
+    '''It returns the lines of the block and the number of complete ones.
+
+    It returns None if the lines would require any cleaning.
+    '''
+    if '\r' in buf:
+        return None
+    lines = buf.splitlines(True)
+    num_complete_lines = len(lines)
+    if lines and not lines[-1].endswith('\n'):
+        num_complete_lines -= 1
+    return lines, num_complete_lines
+
+
+def _itemize_fastq_block_4lines(buf):
+    '''It itemizes a block composed only by four line fastq records.
+
+    It returns the SeqItems and the incomplete trailing record or None if
+    the block has any other layout.
+    '''
+    split_block = _split_block_in_lines(buf)
+    if split_block is None:
+        return None
+    lines, num_complete_lines = split_block
+    num_lines = num_complete_lines - num_complete_lines % 4
+    titles = lines[0:num_lines:4]
+    seqs = lines[1:num_lines:4]
+    pluses = lines[2:num_lines:4]
+    quals = lines[3:num_lines:4]
+    first_char = itemgetter(0)
+    try:
+        # if the sequence had trailing spaces the lengths would not match
+        # because there are no spaces in the qualities
+        if (set(map(first_char, titles)) - set('@') or
+            set(map(first_char, pluses)) - set('+') or
+            map(len, seqs) != map(len, quals)):
+            return None
+    except IndexError:
+        # There's an empty line
+        return None
+    # The SeqItems are created lazily, holding the ones of a whole block in
+    # memory would trigger too many garbage collections.
+    # SeqItem.__new__ is bypassed because it is too slow for this loop
+    new_tuple = tuple.__new__
+    seqitems = (new_tuple(SeqItem, (title[1:-1].partition(' ')[0],
+                                    [title, seq, '+\n', qual], {}))
+                for title, seq, qual in izip(titles, seqs, quals))
+    return seqitems, ''.join(lines[num_lines:])
+
+
+def _itemize_fasta_block_2lines(buf, eof):
+    '''It itemizes a block composed only by two line fasta records.
+
+    It returns the SeqItems and the incomplete trailing record or None if
+    the block has any other layout.
+    '''
+    if ' \n' in buf:
+        return None
+    split_block = _split_block_in_lines(buf)
+    if split_block is None:
+        return None
+    lines, num_complete_lines = split_block
+    num_lines = num_complete_lines - num_complete_lines % 2
+    if not eof:
+        # the sequence of the last record could continue in the next block
+        num_lines -= 2
+    if num_lines <= 0:
+        return None
+    titles = lines[0:num_lines:2]
+    seqs = lines[1:num_lines:2]
+    first_char = itemgetter(0)
+    try:
+        if (set(map(first_char, titles)) - set('>') or
+            '>' in set(map(first_char, seqs)) or
+            (num_lines < num_complete_lines and lines[num_lines][0] != '>')):
+            return None
+    except IndexError:
+        # There's an empty line
+        return None
+    new_tuple = tuple.__new__
+    seqitems = (new_tuple(SeqItem, (title[1:-1].partition(' ')[0],
+                                    [title, seq], {}))
+                for title, seq in izip(titles, seqs))
+    return seqitems, ''.join(lines[num_lines:])
+
+
+def _itemize_fastx_blocks(fhand, block_size=None):
+    '''It yields SeqItems reading the file in big blocks.
+
+    The blocks with only two line fasta or four line fastq records are split
+    with str.splitlines, otherwise the record boundaries are looked for with
+    str.find. The incomplete trailing record is carried over to the next
+    block. Odd multiline fastq files are parsed by the line by line itemizer.
+    '''
+    if block_size is None:
+        block_size = get_setting('SEQITEM_READER_BLOCK_SIZE')
+    read = fhand.read
+    buf = ''
+    is_empty = True
+    is_fastq = None
+    fallback = False
+    eof = False
+    while not eof and not fallback:
+        block = read(block_size)
+        if block:
+            buf += block
+        else:
+            eof = True
+            if buf and not buf.endswith('\n'):
+                buf += '\n'
+        if is_fastq is None:
+            first_char = buf.lstrip()[:1]
+            if not first_char:
+                continue
+            is_fastq = first_char == '@'
+
+        if buf:
+            if is_fastq:
+                parsed_block = _itemize_fastq_block_4lines(buf)
+            else:
+                parsed_block = _itemize_fasta_block_2lines(buf, eof)
+            if parsed_block is not None:
+                seqitems, buf = parsed_block
+                for seqitem in seqitems:
+                    yield seqitem
+                    is_empty = False
+                if not eof:
+                    continue
+
+        len_buf = len(buf)
+        find = buf.find
+        pos = 0
+        while True:
+            # empty lines between records
+            while pos < len_buf and buf[pos] == '\n':
+                pos += 1
+            if pos >= len_buf:
+                break
+            if is_fastq:
+                end_title = find('\n', pos)
+                end_seq = find('\n', end_title + 1) if end_title != -1 else -1
+                end_plus = find('\n', end_seq + 1) if end_seq != -1 else -1
+                end_qual = find('\n', end_plus + 1) if end_plus != -1 else -1
+                if end_qual == -1:
+                    # incomplete record, we need the next block
+                    fallback = eof
+                    break
+                seq = buf[end_title + 1:end_seq].rstrip()
+                qual = buf[end_plus + 1:end_qual].rstrip()
+                if (buf[pos] != '@' or buf[end_seq + 1] != '+' or
+                    len(seq) != len(qual)):
+                    # this is a multiline fastq or a malformed one
+                    fallback = True
+                    break
+                title = buf[pos:end_title + 1]
+                name = title[1:-1].partition(' ')[0]
+                yield SeqItem(name, [title, seq + '\n', '+\n', qual + '\n'])
+                pos = end_qual + 1
+            else:
+                if buf[pos] != '>':
+                    fallback = True
+                    break
+                end = find('\n>', pos)
+                if end == -1:
+                    if not eof:
+                        break
+                    end = len_buf - 1
+                end_title = find('\n', pos)
+                title = buf[pos:end_title + 1]
+                seq_lines = buf[end_title + 1:end + 1].splitlines()
+                seq = ''.join([line.rstrip() for line in seq_lines])
+                name = title[1:-1].partition(' ')[0]
+                yield SeqItem(name, [title, seq + '\n'])
+                pos = end + 1
+            is_empty = False
+        buf = buf[pos:]
+
+    if fallback:
+        for seq in _fallback_to_line_itemizer(buf, fhand, is_empty):
+            yield seq
+    elif is_empty:
+        raise FileIsEmptyError('File is empty')
+
+
+def _fhand_can_be_mapped(fhand):
+    'It returns True if the file is a seekable uncompressed regular file'
+    if not isinstance(fhand, file) or not fhand_is_seekable(fhand):
+        return False
+    try:
+        stat = os.fstat(fhand.fileno())
+    except (IOError, OSError):
+        return False
+    return S_ISREG(stat.st_mode) and stat.st_size > fhand.tell()
+
+
+def _itemize_fastx_mmap(fhand):
+    '''It yields SeqItems with their lines stored in a memory mapped file.
+
+    Only the two line fasta and four line fastq records are mapped, once a
+    record with any other layout is found the rest of the file is parsed by
+    the block itemizer.
+    '''
+    if not _fhand_can_be_mapped(fhand):
+        for seq in _itemize_fastx_blocks(fhand):
+            yield seq
+        return
+    start = fhand.tell()
+    mmap_ = mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ)
+    size = mmap_.size()
+    find = mmap_.find
+    # the lines with carriage returns or trailing spaces require cleaning
+    if find('\r', start) != -1 or find(' \n', start) != -1:
+        fallback_pos = start
+    else:
+        fallback_pos = None
+    pos = start
+    is_fastq = None
+    is_empty = True
+    new_tuple = tuple.__new__
+    while fallback_pos is None and pos < size:
+        first_char = mmap_[pos]
+        if first_char == '\n':
+            # empty line
+            pos += 1
+            continue
+        if is_fastq is None:
+            is_fastq = first_char == '@'
+        end_title = find('\n', pos)
+        end_seq = find('\n', end_title + 1) if end_title != -1 else -1
+        if end_seq == -1:
+            fallback_pos = pos
+            break
+        if is_fastq:
+            end_plus = end_seq + 2
+            end_qual = find('\n', end_plus + 1)
+            if (first_char != '@' or end_qual == -1 or
+                mmap_[end_seq + 1:end_plus + 1] != '+\n' or
+                end_seq - end_title != end_qual - end_plus):
+                fallback_pos = pos
+                break
+            offsets = (pos, end_title + 1, end_seq + 1, end_plus + 1,
+                       end_qual + 1)
+            next_pos = end_qual + 1
+        else:
+            next_pos = end_seq + 1
+            if first_char != '>' or (next_pos < size and
+                                     mmap_[next_pos] != '>'):
+                fallback_pos = pos
+                break
+            offsets = (pos, end_title + 1, end_seq + 1)
+        name = mmap_[pos + 1:end_title].partition(' ')[0]
+        lines = MappedSeqLines(mmap_, offsets)
+        # SeqItem.__new__ is bypassed because it is too slow for this loop
+        yield new_tuple(SeqItem, (name, lines, {}))
+        is_empty = False
+        pos = next_pos
+
+    if fallback_pos is not None:
+        fhand.seek(fallback_pos)
+        try:
+            for seq in _itemize_fastx_blocks(fhand):
+                yield seq
+        except FileIsEmptyError:
+            if is_empty:
+                raise
+    elif is_empty:
+        raise FileIsEmptyError('File is empty')
+
+
+def _read_seqitems(fhands, reader=None):
     'it returns an iterator of seq items (tuples of name and chunk)'
+    if reader is None:
+        reader = get_setting('SEQITEM_READER')
+    if reader == MMAP_READER:
+        itemize = _itemize_fastx_mmap
+    elif reader == BLOCK_READER:
+        itemize = _itemize_fastx_blocks
+    elif reader == LINE_READER:
+        itemize = _itemize_fastx
+    else:
+        raise ValueError('Unknown SeqItem reader: ' + str(reader))
     seq_iters = []
     for fhand in fhands:
         file_format = get_format(fhand)
-        seq_iter = _itemize_fastx(fhand)
+        seq_iter = itemize(fhand)
         seq_iter = assing_kind_to_seqs(SEQITEM, seq_iter, file_format)
         seq_iters.append(seq_iter)
     return chain.from_iterable(seq_iters)
@@ -384,14 +917,35 @@ def _write_seqitems(items, fhand, file_format):
                 # The pipe could be already closed
                 if not 'Broken pipe' in str(error):
                     raise
+        elif (file_format and 'fastq' in seqitems_fmt and
+              'fastq' in file_format and seqitems_fmt != file_format):
+            # the qualities are re-encoded with a translate table
+            seq_lines = seq.object.lines
+            quals = get_str_qualities(seq, file_format)
+            try:
+                fhand.write(seq_lines[0] + seq_lines[1] + '+\n' + quals +
+                            '\n')
+            except IOError, error:
+                # The pipe could be already closed
+                if not 'Broken pipe' in str(error):
+                    raise
         elif file_format and seqitems_fmt != file_format:
             msg = 'Input and output file formats do not match, you should not '
             msg += 'use SeqItems: ' + str(seq.file_format) + ' '
             msg += str(file_format)
             raise RuntimeError(msg)
         else:
+            if isinstance(seq.object, CompactSeqItem):
+                lines = seq.object.get_buffer()
+            else:
+                lines = seq.object.lines
+                if isinstance(lines, MappedSeqLines):
+                    # the record is written straight from the mapped file
+                    lines = lines.get_buffer()
+                else:
+                    lines = ''.join(lines)
             try:
-                fhand.write(''.join(seq.object.lines))
+                fhand.write(lines)
             except IOError, error:
                 # The pipe could be already closed
                 if not 'Broken pipe' in str(error):
@@ -421,8 +975,13 @@ def write_seqs(seqs, fhand=None, file_format=None):
     return fhand
 
 
-def read_seqs(fhands, out_format=None, prefered_seq_classes=None):
-    'It returns a stream of seqs in different codings: seqrecords, seqitems...'
+def read_seqs(fhands, out_format=None, prefered_seq_classes=None,
+              seqitem_reader=None):
+    '''It returns a stream of seqs in different codings: seqrecords, seqitems
+
+    seqitem_reader selects the engine used to parse SeqItems: LINE_READER,
+    BLOCK_READER or MMAP_READER (default: the SEQITEM_READER setting).
+    '''
 
     if not prefered_seq_classes:
         prefered_seq_classes = [SEQITEM, SEQRECORD]
@@ -445,7 +1004,7 @@ def read_seqs(fhands, out_format=None, prefered_seq_classes=None):
     for seq_class in prefered_seq_classes:
         if seq_class == SEQITEM:
             try:
-                return _read_seqitems(fhands)
+                return _read_seqitems(fhands, reader=seqitem_reader)
             except NotImplementedError:
                 continue
         elif seq_class == SEQRECORD:
@@ -22,6 +22,62 @@ _SUPPORTED_OUTPUT_FORMATS = ['fasta', 'fastq', 'fastq-illumina']
 # hold in memory
 _PACKET_SIZE = 1000
 
+# engine used to parse fasta and fastq files into SeqItems (line_reader or
+# block_reader) and size of the blocks read by the block_reader
+_SEQITEM_READER = 'block_reader'
+_SEQITEM_READER_BLOCK_SIZE = 8 * 1024 * 1024
+
+# gzip input is decompressed in background threads (0 to do it in the main
+# thread). BGZF blocks are decompressed in parallel by this number of threads.
+# The decompressed data is kept in a queue of a limited number of blocks
+_DECOMPRESSION_THREADS = 4
+_DECOMPRESSION_BLOCK_SIZE = 1024 * 1024
+_DECOMPRESSION_BLOCKS_IN_FLIGHT = 8
+
+# the compressed output is written in blocks of this size compressed in
+# parallel by this number of threads (0 to compress in the main thread)
+_COMPRESSION_THREADS = 4
+_COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+# The filters and trimmers process the seqs in packets of a size in bytes
+# adjusted with the measured processing cost (False to use PACKET_SIZE seqs).
+# The packets grow from the initial size until the fixed cost of a packet
+# (e.g. an external program startup) is at most the max overhead fraction of
+# its time, but they should not take more than the target seconds to be
+# processed unless that is required to amortize the fixed cost. The chosen
+# sizes are reported in the standard error if REPORT_PACKET_SIZES is True
+_ADAPTIVE_PACKET_SIZE = True
+_PACKET_TARGET_SECONDS = 0.5
+_PACKET_MAX_OVERHEAD = 0.1
+_PACKET_INITIAL_BYTES = 256 * 1024
+_PACKET_MIN_BYTES = 16 * 1024
+_PACKET_MAX_BYTES = 16 * 1024 * 1024
+_REPORT_PACKET_SIZES = False
+
+# The filters with a batch implementation check all the seqs of a packet at
+# once with NumPy arrays (if NumPy is installed)
+_BATCH_FILTERS = True
+
+# FilterById keeps up to MAX_IDS_IN_SET ids in a python set, up to
+# MAX_IDS_IN_MEMORY as their sorted 64 bit hashes in a NumPy array and more
+# in a sorted hash file on disk, with a Bloom filter of this number of bits
+# per id (0 for no filter) checked before looking for the hash in the file
+_MAX_IDS_IN_SET = 1000000
+_MAX_IDS_IN_MEMORY = 100000000
+_ID_BLOOM_BITS_PER_ID = 10
+
+# number of packets sent to each worker process that can be waiting to be
+# processed or to be written. The reading stops while they are all in flight
+_PACKETS_IN_FLIGHT_PER_PROCESS = 2
+
+# with several processes the uncompressed fasta and fastq input files are
+# split in record aligned byte ranges parsed, processed and written by the
+# workers (False to parse every seq in the main process). Each process gets
+# this number of ranges, but no range is smaller than the minimum size
+_SCATTER_INPUT_FILES = True
+_SCATTER_RANGES_PER_PROCESS = 4
+_SCATTER_MIN_RANGE_SIZE = 1024 * 1024
+
 # number of sequences to analyze in the fastq version guessing of a seekable
 # file
 _SEQS_TO_GUESS_FASTQ_VERSION = 1000
@@ -95,6 +151,22 @@ _TEMP_DIR = None
 # min_mapq to use as a filter for maped reads
 _DEFAULT_MIN_MAPQ = 0
 
+# the mapping sessions write these reads made of Ns after every packet, a few
+# at a time, until the packet has been pushed through the mapper buffers. A
+# mapper that does not write any read of a packet in the timeout seconds is
+# killed. The bwa mem sessions map the reads in batches of the bases of
+# PACKET_SIZE flush reads
+_MAPPING_SESSION_FLUSH_READS = 64
+_MAPPING_SESSION_FLUSH_READ_LENGTH = 100
+_MAPPING_SESSION_TIMEOUT = 600
+
+# maximum number of threads used by the blasts of all the processes of a
+# command (None for the number of CPUs)
+_BLAST_MAX_THREADS = None
+
+# maximum size in bytes of the alignment results stored in an alignment cache
+_ALIGNMENT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
 # buffer size and memory limit for match_pairs
 _MAX_READS_IN_MEMORY = 1000000
 _CHECK_ORDER_BUFFER_SIZE = 100000
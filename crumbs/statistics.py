@@ -17,9 +17,16 @@
 
 from __future__ import division
 from collections import Counter
+from itertools import izip
 import operator
 import re
 
+try:
+    import numpy
+except ImportError:
+    # This is an optional requirement
+    pass
+
 from crumbs.settings import get_setting
 from crumbs.iterutils import rolling_window
 from crumbs.utils import approx_equal
@@ -573,15 +580,59 @@ class KmerCounter(object):
         return self._counter.most_common(num_items)
 
 
-def _calculate_rawscore(string):
-    'It returns a non-normalized dustscore'
-    triplet_counts = Counter()
-    for triplet in rolling_window(string, 3):
-        # It should do something with non ATCG, but we sacrifice purity for
-        # speed. Maybe we should reconsider this
-        triplet_counts[triplet.upper()] += 1
+def _create_dust_codes():
+    '''It returns a translation table with the dust code of every residue.
+
+    A, C, G and T, in any case, are coded 0 to 3 and any other residue by
+    the ord of its uppercase.
+    '''
+    codes = []
+    for code in range(256):
+        residue = chr(code).upper()
+        codes.append(chr('ACGT'.index(residue)) if residue in 'ACGT'
+                     else residue)
+    return ''.join(codes)
+
+_DUST_CODES = _create_dust_codes()
+
+
+def _encode_triplets(seq):
+    '''It returns the triplets of the seq coded as integers.
 
-    return sum(tc * (tc - 1) * 0.5 for tc in triplet_counts.viewvalues())
+    If the seq only has ACGT the triplets are coded from 0 to 63, the
+    returned counts are a list, otherwise they are a Counter.
+    '''
+    codes = bytearray(seq.translate(_DUST_CODES))
+    if max(codes) < 4:
+        shift, counts = 2, [0] * 64
+    else:
+        shift, counts = 8, Counter()
+    pairs = [(code1 << shift) | code2 for code1, code2 in izip(codes,
+                                                              codes[1:])]
+    triplets = [(pair << shift) | code for pair, code in izip(pairs,
+                                                              codes[2:])]
+    return triplets, counts
+
+
+def _calculate_rawscores(triplets, counts, segments):
+    '''It yields the non-normalized dustscores of the segments.
+
+    The segments are the (start, end) ranges of the triplets and they should
+    overlap and advance. The triplet counts and the score are updated
+    with the triplets that enter and leave the segment, a triplet with c
+    copies adds c * (c - 1) / 2 to the score.
+    '''
+    score = 0
+    start = end = 0
+    for segment_start, segment_end in segments:
+        for triplet in triplets[end:segment_end]:
+            score += counts[triplet]
+            counts[triplet] += 1
+        for triplet in triplets[start:segment_start]:
+            counts[triplet] -= 1
+            score -= counts[triplet]
+        start, end = segment_start, segment_end
+        yield score
 
 
 def calculate_dust_score(seq):
@@ -603,28 +654,100 @@ def calculate_dust_score(seq):
     windowsize = get_setting('DUST_WINDOWSIZE')
     windowstep = get_setting('DUST_WINDOWSTEP')
 
-    dustscores = []
+    # the triplet ranges of the windows and of the remaining seq
+    segments = []
     if length > windowsize:
-        windows = 0
-        for seq_in_win in rolling_window(seq, windowsize, windowstep):
-            score = _calculate_rawscore(seq_in_win)
-            dustscores.append(score / (windowsize - 2))
-            windows += 1
-        remaining_seq = seq[windows * windowstep:]
+        windows = (length - windowsize) // windowstep + 1
+        segments.extend((start, start + windowsize - 2)
+                        for start in range(0, windows * windowstep,
+                                           windowstep))
     else:
-        remaining_seq = seq
+        windows = 0
+    segments.append((windows * windowstep, length - 2))
 
-    if remaining_seq > 5:
-        length = len(remaining_seq)
-        score = _calculate_rawscore(remaining_seq)
-        dustscore = score / (length - 3) * (windowsize - 2) / (length - 2)
-        dustscores.append(dustscore)
+    triplets, counts = _encode_triplets(seq)
+    dustscores = []
+    for score in _calculate_rawscores(triplets, counts, segments):
+        dustscores.append(score / (windowsize - 2))
+    # the remaining seq
+    length = length - windows * windowstep
+    dustscores[-1] = score / (length - 3) * (windowsize - 2) / (length - 2)
 
     # max score should be 100 not 31
     dustscore = sum(dustscores) / len(dustscores) * 100 / 31
     return dustscore
 
 
+def _repeat_ranges(starts, lengths):
+    'It returns the concatenated ranges of the given starts and lengths'
+    firsts = numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+    return firsts + numpy.arange(lengths.sum())
+
+
+def calculate_dust_scores(batch):
+    '''It returns the dust scores of all the seqs of a SeqBatch.
+
+    They are the calculate_dust_score scores computed with NumPy. The seqs
+    that can not be scored (too short) get NaN.
+    '''
+    windowsize = get_setting('DUST_WINDOWSIZE')
+    windowstep = get_setting('DUST_WINDOWSTEP')
+    lengths = batch.lengths
+    offsets = batch.offsets[:-1]
+    num_seqs = len(lengths)
+    residues = batch.seqs
+    lowercase = (residues >= ord('a')) & (residues <= ord('z'))
+    residues = numpy.where(lowercase, residues - 32, residues)
+    symbols, residues = numpy.unique(residues, return_inverse=True)
+    num_symbols = max(len(symbols), 1)
+
+    # the windows and the remaining segment of every seq
+    scored = lengths > 5
+    num_windows = numpy.where(lengths > windowsize,
+                              (lengths - windowsize) // windowstep + 1, 0)
+    num_windows[~scored] = 0
+    window_seqs = numpy.repeat(numpy.arange(num_seqs), num_windows)
+    window_ranks = _repeat_ranges(numpy.zeros(num_seqs, dtype=numpy.int64),
+                                  num_windows)
+    window_starts = offsets[window_seqs] + window_ranks * windowstep
+    remaining_seqs = numpy.flatnonzero(scored)
+    remaining_starts = num_windows[remaining_seqs] * windowstep
+    remaining_lengths = lengths[remaining_seqs] - remaining_starts
+    segment_seqs = numpy.concatenate((window_seqs, remaining_seqs))
+    segment_starts = numpy.concatenate((window_starts,
+                                        offsets[remaining_seqs] +
+                                        remaining_starts))
+    segment_lengths = numpy.concatenate((numpy.repeat(windowsize,
+                                                      len(window_seqs)),
+                                         remaining_lengths))
+
+    # the triplet counts of every segment
+    num_triplets = segment_lengths - 2
+    positions = _repeat_ranges(segment_starts, num_triplets)
+    triplets = ((residues[positions] * num_symbols +
+                 residues[positions + 1]) * num_symbols +
+                residues[positions + 2])
+    segment_ids = numpy.repeat(numpy.arange(len(segment_seqs)), num_triplets)
+    keys = segment_ids * num_symbols ** 3 + triplets
+    keys, counts = numpy.unique(keys, return_counts=True)
+    rawscores = numpy.bincount(keys // num_symbols ** 3,
+                               weights=counts * (counts - 1) * 0.5,
+                               minlength=len(segment_seqs))
+
+    num_all_windows = len(window_seqs)
+    scores = numpy.empty(len(segment_seqs))
+    scores[:num_all_windows] = rawscores[:num_all_windows] / (windowsize - 2)
+    scores[num_all_windows:] = (rawscores[num_all_windows:] /
+                                (remaining_lengths - 3) *
+                                (windowsize - 2) / (remaining_lengths - 2))
+    dustscores = numpy.bincount(segment_seqs, weights=scores,
+                                minlength=num_seqs)
+    dustscores = dustscores / (num_windows + 1) * 100 / 31
+    dustscores[~scored] = numpy.nan
+    dustscores[lengths == 3] = 0
+    return dustscores
+
+
 def calculate_nx(int_counter, percentage):
     '''It calcalutes N50, N90 etc.
 
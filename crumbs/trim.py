@@ -13,33 +13,34 @@
 # You should have received a copy of the GNU General Public License
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 from operator import itemgetter
-from tempfile import NamedTemporaryFile
 
-from pysam import Samfile
+from pysam import AlignedSegment, AlignmentHeader
 
 from crumbs.utils.optional_modules import Seq
 from crumbs.utils.tags import (TRIMMING_RECOMMENDATIONS, QUALITY, OTHER,
                                VECTOR, TRIMMING_KINDS, SEQS_PASSED,
                                ORPHAN_SEQS)
-from crumbs.utils.seq_utils import get_uppercase_segments
+from crumbs.utils.seq_utils import get_seq_uppercase_segments
 from crumbs.seq import (copy_seq, get_str_seq, get_annotations, get_length,
-                        slice_seq, get_int_qualities, get_name)
+                        slice_seq, get_int_qualities, get_name,
+                        get_file_format)
 from crumbs.utils.segments_utils import (get_longest_segment, get_all_segments,
                                          get_longest_complementary_segment,
                                          merge_overlaping_segments)
 from crumbs.utils.tags import SEQRECORD
 from crumbs.iterutils import rolling_window
-from crumbs.blast import BlasterForFewSubjects
-from crumbs.seqio import write_seqs
+from crumbs.blast import create_blast_short_blaster
+from crumbs.oligo_matcher import OligoMatcher
+from crumbs.adapters import find_adapter_starts, NEXTERA_ADAPTERS
 from crumbs.pairs import group_pairs_by_name, group_pairs
 from crumbs.settings import get_setting
 from crumbs.mate_chimeras import (_split_mates, _get_primary_alignment,
                                   _read_is_totally_mapped, _get_qstart,
                                   _get_qend,
                                   _group_alignments_reads_by_qname, _5end_mapped)
-from crumbs.mapping import (alignedread_to_seqitem, map_with_bwamem,
-                            map_process_to_sortedbam)
+from crumbs.mapping import alignedread_to_seqitem, create_bwamem_session
 # pylint: disable=R0903
 
 
@@ -81,7 +82,7 @@ class TrimLowercasedLetters(_BaseTrim):
 
     def _do_trim(self, seq):
         str_seq = get_str_seq(seq)
-        unmasked_segments = get_uppercase_segments(str_seq)
+        unmasked_segments = get_seq_uppercase_segments(seq)
         segment = get_longest_segment(unmasked_segments)
         if segment is not None:
             segments = []
@@ -308,25 +309,29 @@ class TrimByQuality(_BaseTrim):
 
 
 class TrimWithBlastShort(_BaseTrim):
-    'It trims adaptors with the blast short algorithm'
-    def __init__(self, oligos):
-        'The initiator'
+    '''It trims adaptors with the blast short algorithm.
+
+    By default the oligos are looked for with an OligoMatcher, with the same
+    filters as the blastn-short search, that is used if use_blast is True.
+    '''
+    def __init__(self, oligos, use_blast=False, blast_threads=1):
+        '''The initiator
+
+        blast_threads - The threads used by every blast
+        '''
         self.oligos = oligos
+        self.use_blast = use_blast
+        if use_blast:
+            self._matcher = create_blast_short_blaster(oligos,
+                                          elongate_for_global=True,
+                                          num_threads=blast_threads)
+        else:
+            self._matcher = OligoMatcher(oligos, elongate_for_global=True)
         super(TrimWithBlastShort, self).__init__()
 
     def _pre_trim(self, trim_packet):
         seqs = [s for seqs in trim_packet[SEQS_PASSED]for s in seqs]
-        db_fhand = write_seqs(seqs, file_format='fasta')
-        db_fhand.flush()
-        params = {'task': 'blastn-short', 'expect': '0.0001'}
-        filters = [{'kind': 'score_threshold', 'score_key': 'identity',
-                    'min_score': 87},
-                   {'kind': 'min_length', 'min_num_residues': 13,
-                    'length_in_query': False}]
-        self._matcher = BlasterForFewSubjects(db_fhand.name, self.oligos,
-                                             program='blastn', filters=filters,
-                                             params=params,
-                                             elongate_for_global=True)
+        self._matcher.match_seqs(seqs)
 
     def _do_trim(self, seq):
         'It trims the masked segments of the SeqWrappers.'
@@ -358,21 +363,53 @@ class TrimMatePairChimeras(_BaseTrim):
             self.max_clipping = max_clipping
         else:
             self.max_clipping = get_setting('CHIMERAS_SETTINGS')['MAX_CLIPPING']
+        self._session = None
+        self._session_pid = None
+        self._header = None
+
+    def __getstate__(self):
+        # every worker starts its own bwa
+        state = self.__dict__.copy()
+        state['_session'] = None
+        state['_header'] = None
+        return state
+
+    def _get_session(self, file_format):
+        'It returns the bwa session, bwa is started only once'
+        session = self._session
+        if (session is not None and self._session_pid == os.getpid() and
+                session.file_format == file_format):
+            return session
+        if session is not None and self._session_pid == os.getpid():
+            session.close()
+        self._session = create_bwamem_session(self._index_fpath,
+                                              file_format=file_format,
+                                              interleave=True)
+        self._session_pid = os.getpid()
+        self._header = None
+        return self._session
+
+    def close(self):
+        'It stops bwa, an error is raised if it has failed'
+        session = self._session
+        self._session = None
+        if session is not None and self._session_pid == os.getpid():
+            session.close()
 
     def _pre_trim(self, trim_packet):
         seqs = [s for seqs in trim_packet[SEQS_PASSED]for s in seqs]
-        reads_fhand = NamedTemporaryFile(dir=self._tempdir, suffix='.trimming')
-
-        write_seqs(seqs, reads_fhand)
-        reads_fhand.flush()
-        bwa = map_with_bwamem(self._index_fpath,
-                              interleave_fpath=reads_fhand.name)
-        bam_fhand = NamedTemporaryFile(dir=self._tempdir)
-        map_process_to_sortedbam(bwa, bam_fhand.name, key='queryname',
-                                 tempdir=self._tempdir)
-
-        self._bam_fhand = bam_fhand
-        reads_fhand.close()
+        self._alignments = []
+        if not seqs:
+            return
+        session = self._get_session(get_file_format(seqs[0]) or 'fastq')
+        # the mates are mapped in order, so their alignments are together
+        sam_lines = session.map_seqs(seqs)
+        if self._header is None:
+            self._header = AlignmentHeader.from_text(''.join(
+                                                        session.header_lines))
+        self._alignments = [AlignedSegment.fromstring(line.rstrip('\n'),
+                                                      self._header)
+                            for line in sam_lines]
 
     def _do_trim(self, aligned_reads):
         max_clipping = self.max_clipping
@@ -395,67 +432,58 @@ class TrimMatePairChimeras(_BaseTrim):
         'It trims the seqs'
         self._pre_trim(trim_packet)
         trimmed_seqs = []
-        bamfile = Samfile(self._bam_fhand.name)
-        for grouped_mates in _group_alignments_reads_by_qname(bamfile):
-            for aligned_reads in _split_mates(grouped_mates):
-                trimmed_seqs.append([self._do_trim(aligned_reads)])
+        if self._alignments:
+            alignments = self._alignments
+            for grouped_mates in _group_alignments_reads_by_qname(alignments):
+                for aligned_reads in _split_mates(grouped_mates):
+                    trimmed_seqs.append([self._do_trim(aligned_reads)])
         self._post_trim()
         return {SEQS_PASSED: trimmed_seqs,
                 ORPHAN_SEQS: trim_packet[ORPHAN_SEQS]}
 
     def _post_trim(self):
-        self._bam_fhand.close()
-
-# class TrimNexteraAdapters(_BaseTrim):
-#     "It trims from Nextera adaptors found with blast short algorithm to 3'end"
-#     "If adapter is at one end and it is not complete, it trims more bases"
-#     def __init__(self, oligos):
-#         'The initiator'
-#         self.oligos = oligos
-#         super(TrimNexteraAdapters, self).__init__()
-#
-#     def _pre_trim(self, trim_packet):
-#         seqs = [s for seqs in trim_packet[SEQS_PASSED]for s in seqs]
-#         db_fhand = write_seqs(seqs, file_format='fasta')
-#         db_fhand.flush()
-#         params = {'task': 'blastn-short', 'expect': '0.0001'}
-#         filters = [{'kind': 'score_threshold', 'score_key': 'identity',
-#                     'min_score': 87},
-#                    {'kind': 'min_length', 'min_num_residues': 13,
-#                     'length_in_query': False}]
-#         self._matcher = BlasterForFewSubjects(db_fhand.name, self.oligos,
-#                                              program='blastn', filters=filters,
-#                                              params=params,
-#                                              elongate_for_global=True)
-#
-#     def _do_trim(self, seq):
-#         'It trims the masked segments of the SeqWrappers.'
-#         segments = self._matcher.get_matched_segments_for_read(get_name(seq))
-#         if segments is not None:
-#             segments = [(segment[0], get_length(seq) - 1) for segment in segments[0]]
-#             _add_trim_segments(segments, seq, kind=OTHER)
-#         return seq
-
-#CUTADAPT = '/home/carlos/devel/bin/cutadapt'
-#cutadapt bin should be included somewhere else
-#_5END = '5end'
-#_3END = '3end'
-#ANYWHERE = 'anywhere'
-
-# def trim_with_cutadapt(in_fpath, out_fpath, oligos, error_rate=None,
-#                        summary_fpath=None):
-#     #TODO: include cutadapt in the code or remove this function
-#     # This functionallity is not throughly tested
-#     options = {_3END: '-a', ANYWHERE: '-b', _5END: '-g'}
-#     cmd = [CUTADAPT, in_fpath, '-o', out_fpath]
-#     for kind, oligo_seqs in oligos.items():
-#         for oligo_seq in oligo_seqs:
-#             cmd.extend([options[kind], oligo_seq])
-#     if error_rate is not None:
-#         cmd.append(str(error_rate))
-#     if summary_fpath is None:
-#         summary_fhand = sys.stdout
-#     else:
-#         summary_fhand = open(summary_fpath, 'w')
-#     cutadapt = subprocess.Popen(cmd, stdout=summary_fhand)
-#     cutadapt.wait()
+        self._alignments = None
+
+
+class Trim3PrimeAdapters(_BaseTrim):
+    '''It trims the 3' adapters and everything after them.
+
+    The adapters are looked for allowing errors and they can be cut by the
+    read 3' end.
+    '''
+    def __init__(self, adapters=None, error_rate=0.1, min_overlap=3):
+        '''The initiator.
+
+        adapters - The adapter SeqWrappers or str seqs. By default the
+                   Nextera ones
+        error_rate - The maximum edit distance per adapter residue
+        min_overlap - The minimum adapter residues at the read 3' end
+        '''
+        if adapters is None:
+            adapters = NEXTERA_ADAPTERS
+        self.adapters = [adapter if isinstance(adapter, basestring)
+                         else get_str_seq(adapter) for adapter in adapters]
+        self.error_rate = error_rate
+        self.min_overlap = min_overlap
+        self._adapter_starts = None
+        super(Trim3PrimeAdapters, self).__init__()
+
+    def _pre_trim(self, trim_packet):
+        seqs = [get_str_seq(s) for seqs in trim_packet[SEQS_PASSED]
+                for s in seqs]
+        # the paired seqs can have the same name
+        starts = find_adapter_starts(seqs, self.adapters,
+                                     error_rate=self.error_rate,
+                                     min_overlap=self.min_overlap)
+        self._adapter_starts = iter(starts)
+
+    def _do_trim(self, seq):
+        'It trims from the adapter start to the 3\' end'
+        start = next(self._adapter_starts)
+        if start is not None:
+            _add_trim_segments([(start, get_length(seq) - 1)], seq,
+                               kind=VECTOR)
+        return seq
+
+    def _post_trim(self):
+        self._adapter_starts = None
@@ -273,6 +273,13 @@ def create_basic_argparse(**kwargs):
                        help='Compress the output in bgzf format')
     group.add_argument('-B ', '--bzip2', action='store_true',
                        help='Compress the output in bzip2 format')
+    hlp = 'Compression level, 1 (fastest) to 9 (smallest) (default: 9 for '
+    hlp += 'gzip and bzip2, 6 for bgzf)'
+    parser.add_argument('--compression_level', type=int, help=hlp,
+                        choices=range(1, 10), metavar='{1-9}')
+    hlp = 'Num. of threads used to compress the output (default: %(default)s)'
+    parser.add_argument('--compression_threads', type=int, help=hlp,
+                        default=get_setting('COMPRESSION_THREADS'))
     return parser
 
 
@@ -353,6 +360,16 @@ def get_requested_compression(parsed_args):
     return comp_kind
 
 
+def get_requested_compression_args(parsed_args):
+    'It returns the compression kind, level and threads for compress_fhand'
+    comp_args = {'compression_kind': get_requested_compression(parsed_args)}
+    comp_args['compression_level'] = getattr(parsed_args,
+                                             'compression_level', None)
+    comp_args['num_threads'] = getattr(parsed_args, 'compression_threads',
+                                       None)
+    return comp_args
+
+
 def parse_basic_args(parser):
     'It parses the command line and it returns a dict with the arguments.'
     parsed_args = parser.parse_args()
@@ -391,12 +408,12 @@ def parse_basic_args(parser):
 
     out_fhand = getattr(parsed_args, OUTFILE)
 
-    comp_kind = get_requested_compression(parsed_args)
+    comp_args = get_requested_compression_args(parsed_args)
     if isinstance(out_fhand, list):
         new_out_fhands = []
         for out_f in out_fhand:
             try:
-                out_f = compress_fhand(out_f, compression_kind=comp_kind)
+                out_f = compress_fhand(out_f, **comp_args)
             except RuntimeError, error:
                 parser.error(error)
 
@@ -404,7 +421,7 @@ def parse_basic_args(parser):
         out_fhand = new_out_fhands
     else:
         try:
-            out_fhand = compress_fhand(out_fhand, compression_kind=comp_kind)
+            out_fhand = compress_fhand(out_fhand, **comp_args)
         except RuntimeError, error:
             parser.error(error)
 
@@ -56,8 +56,13 @@ def _get_some_qual_and_lengths(fhand, force_file_as_non_seek):
             if seqs_analyzed > seqs_to_peek:
                 break
     except ValueError:
-        msg = 'The file is Fastq, but the version is difficult to guess'
-        raise UndecidedFastqVersionError(msg)
+        # the last record of a full peeked chunk can be truncated, the parser
+        # fails on it once it has read the whole chunk
+        truncated = (fmt_fhand is not fhand and len(chunk) == chunk_size and
+                     fmt_fhand.tell() == len(chunk))
+        if not seqs_analyzed or not truncated:
+            msg = 'The file is Fastq, but the version is difficult to guess'
+            raise UndecidedFastqVersionError(msg)
     finally:
         fhand.seek(0)
     return lengths, None, chunk  # don't know if it's sanger
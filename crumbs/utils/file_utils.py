@@ -16,11 +16,21 @@
 import tempfile
 import shutil
 import io
+import sys
+import zlib
+import struct
+import bz2
+import threading
+import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from gzip import GzipFile
 import os.path
 
 from crumbs.utils.optional_modules import BgzfWriter
 from crumbs.utils.tags import BGZF, GZIP, BZIP2
+from crumbs.settings import get_setting
+from crumbs.iterutils import group_in_packets
 try:
     from crumbs.utils import BZ2File
 except ImportError:
@@ -67,7 +77,8 @@ def peek_chunk_from_file(fhand, chunk_size):
         chunk = fhand.read(chunk_size)
         fhand.seek(0)
     else:
-        chunk = fhand.peek(chunk_size)
+        # peek can return more bytes than requested
+        chunk = fhand.peek(chunk_size)[:chunk_size]
     return chunk
 
 
@@ -75,11 +86,232 @@ BZIP_ERROR = 'bz2file (Python < 3.3) or bz2 module is required to work with '
 BZIP_ERROR += 'bzip2 files'
 
 
+_GZIP_MAGIC = '\037\213'
+_BGZF_MAGIC = '\037\213\010\004'
+_END_OF_BLOCKS = object()
+
+
+def _inflate_gzip_members(fhand, chunk_size):
+    'It yields the decompressed chunks of a, maybe multi-member, gzip file'
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_started = False
+    while True:
+        chunk = fhand.read(chunk_size)
+        if not chunk:
+            break
+        while chunk:
+            member_started = True
+            inflated = decompressor.decompress(chunk)
+            if inflated:
+                yield inflated
+            chunk = decompressor.unused_data
+            if chunk:
+                # a member has finished, another one could follow
+                # (gzip files can be padded with zeroes)
+                chunk = chunk.lstrip('\x00')
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                member_started = False
+    if member_started:
+        # python 2 decompress objects lack an eof attribute, a finished
+        # stream returns any further input as unused_data
+        try:
+            decompressor.decompress('\x00')
+        except zlib.error:
+            pass
+        if not decompressor.unused_data:
+            raise EOFError('Compressed file ended before the end of stream')
+
+
+def _read_bgzf_blocks(fhand):
+    'It yields the compressed data, crc and size of every BGZF block'
+    while True:
+        header = fhand.read(12)
+        if not header:
+            break
+        if len(header) < 12 or not header.startswith(_BGZF_MAGIC):
+            raise IOError('Malformed BGZF block header')
+        xlen = struct.unpack('<H', header[10:])[0]
+        extra = fhand.read(xlen)
+        block_size = None
+        pos = 0
+        while pos + 4 <= len(extra):
+            subfield_len = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == 'BC' and subfield_len == 2:
+                block_size = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+            pos += 4 + subfield_len
+        if block_size is None:
+            raise IOError('BGZF block without block size')
+        # BSIZE is the total block size minus one
+        block = fhand.read(block_size - xlen - 11)
+        if len(block) != block_size - xlen - 11:
+            raise EOFError('Compressed file ended before the end of a block')
+        yield block
+
+
+def _inflate_bgzf_blocks(blocks):
+    'It decompresses a batch of BGZF blocks'
+    inflated = []
+    for block in blocks:
+        data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(block[:-8])
+        crc, size = struct.unpack('<II', block[-8:])
+        if size != len(data) or zlib.crc32(data) & 0xffffffff != crc:
+            raise IOError('CRC check failed in a BGZF block')
+        inflated.append(data)
+    return ''.join(inflated)
+
+
+def _inflate_bgzf_in_parallel(fhand, num_threads, max_batches_in_flight,
+                              blocks_per_batch):
+    '''It yields the decompressed BGZF blocks in the file order.
+
+    Batches of blocks are decompressed by a pool of threads, zlib releases
+    the GIL while inflating.
+    '''
+    pool = ThreadPool(num_threads)
+    try:
+        batches = group_in_packets(_read_bgzf_blocks(fhand), blocks_per_batch)
+        results = deque()
+        for batch in batches:
+            results.append(pool.apply_async(_inflate_bgzf_blocks, (batch,)))
+            if len(results) >= max_batches_in_flight:
+                yield results.popleft().get()
+        while results:
+            yield results.popleft().get()
+    finally:
+        pool.terminate()
+
+
+class _BackgroundIterator(object):
+    'It consumes an iterator in a thread keeping a bounded queue of items'
+    def __init__(self, iterator, max_items):
+        self._queue = Queue.Queue(max_items)
+        self._stopped = threading.Event()
+        thread = threading.Thread(target=self._fill_queue, args=(iterator,))
+        thread.daemon = True
+        thread.start()
+
+    def _fill_queue(self, iterator):
+        'It runs in the background thread'
+        try:
+            for item in iterator:
+                if self._stopped.is_set():
+                    return
+                self._queue.put((True, item))
+        except Exception:
+            self._queue.put((False, sys.exc_info()))
+        else:
+            self._queue.put((True, _END_OF_BLOCKS))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        is_ok, item = self._queue.get()
+        if not is_ok:
+            raise item[0], item[1], item[2]
+        if item is _END_OF_BLOCKS:
+            # the iterator will keep on ending
+            self._queue.put((True, _END_OF_BLOCKS))
+            raise StopIteration
+        return item
+
+    def stop(self):
+        'It stops the background thread'
+        self._stopped.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+class _InflatedBlocksReader(io.RawIOBase):
+    '''A raw non-seekable reader that returns the inflated blocks.
+
+    It is meant to be wrapped in an io.BufferedReader.
+    '''
+    def __init__(self, blocks, name=None):
+        super(_InflatedBlocksReader, self).__init__()
+        self._blocks = blocks
+        self._block = ''
+        self._block_pos = 0
+        self._pos = 0
+        if name is not None:
+            self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buff):
+        size = len(buff)
+        written = 0
+        while written < size:
+            if self._block_pos >= len(self._block):
+                try:
+                    self._block = next(self._blocks)
+                except StopIteration:
+                    break
+                self._block_pos = 0
+                continue
+            chunk = self._block[self._block_pos:
+                                self._block_pos + size - written]
+            buff[written:written + len(chunk)] = chunk
+            self._block_pos += len(chunk)
+            written += len(chunk)
+        self._pos += written
+        return written
+
+    def close(self):
+        if hasattr(self._blocks, 'stop'):
+            self._blocks.stop()
+        elif hasattr(self._blocks, 'close'):
+            self._blocks.close()
+        super(_InflatedBlocksReader, self).close()
+
+
+def open_threaded_gzip(fhand, num_threads=None):
+    '''It returns a reader that decompresses the gzip fhand in the background.
+
+    Decompression overlaps with the parsing done in the main thread, the
+    inflated blocks are kept in a bounded queue. BGZF files, made of
+    independent blocks, are decompressed by num_threads threads.
+    The returned file is not seekable, but it can be peeked.
+    '''
+    if num_threads is None:
+        num_threads = get_setting('DECOMPRESSION_THREADS')
+    max_blocks = get_setting('DECOMPRESSION_BLOCKS_IN_FLIGHT')
+    block_size = get_setting('DECOMPRESSION_BLOCK_SIZE')
+    header = peek_chunk_from_file(fhand, 16)
+    if header.startswith(_BGZF_MAGIC) and header[12:14] == 'BC':
+        # BGZF blocks hold up to 64 KB of compressed data
+        blocks_per_batch = max(block_size // 65536, 1)
+        blocks = _inflate_bgzf_in_parallel(fhand, num_threads, max_blocks,
+                                           blocks_per_batch)
+    else:
+        blocks = _BackgroundIterator(_inflate_gzip_members(fhand, block_size),
+                                     max_blocks)
+    raw = _InflatedBlocksReader(blocks, name=getattr(fhand, 'name', None))
+    return io.BufferedReader(raw, buffer_size=block_size)
+
+
 def uncompress_if_required(fhand):
-    'It returns a uncompressed handle if required'
+    '''It returns a uncompressed handle if required.
+
+    gzip and BGZF files are decompressed in background threads unless the
+    DECOMPRESSION_THREADS setting is 0.
+    '''
     magic = peek_chunk_from_file(fhand, 2)
-    if magic == '\037\213':
-        fhand = GzipFile(fileobj=fhand)
+    if magic == _GZIP_MAGIC:
+        if get_setting('DECOMPRESSION_THREADS'):
+            fhand = open_threaded_gzip(fhand)
+        else:
+            fhand = GzipFile(fileobj=fhand)
     elif magic == 'BZ':
         try:
             fhand = BZ2File(fhand)
@@ -88,19 +320,154 @@ def uncompress_if_required(fhand):
     return fhand
 
 
-def compress_fhand(fhand, compression_kind=None):
-    'Compresses the file if required'
+# BGZF blocks can hold up to 64 KB, the uncompressed data is split in chunks
+# small enough to fit even if they were not compressible
+_BGZF_MAX_BLOCK_DATA = 65280
+_BGZF_HEADER = '\037\213\010\004\000\000\000\000\000\377\006\000BC\002\000'
+_BGZF_EOF = _BGZF_HEADER + '\033\000\003\000\000\000\000\000\000\000\000\000'
+_DEFAULT_COMPRESSION_LEVELS = {GZIP: 9, BGZF: 6, BZIP2: 9}
+
+
+def _compress_gzip_member(data, level):
+    'It compresses the data in an independent gzip member'
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_bgzf_blocks(data, level):
+    'It compresses the data in BGZF blocks'
+    blocks = []
+    for start in range(0, len(data), _BGZF_MAX_BLOCK_DATA):
+        chunk = data[start:start + _BGZF_MAX_BLOCK_DATA]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(chunk) + compressor.flush()
+        blocks.append(_BGZF_HEADER)
+        # BSIZE is the total block size minus one
+        blocks.append(struct.pack('<H', len(compressed) + 25))
+        blocks.append(compressed)
+        blocks.append(struct.pack('<II', zlib.crc32(chunk) & 0xffffffff,
+                                  len(chunk)))
+    return ''.join(blocks)
+
+
+def _compress_bzip2_stream(data, level):
+    'It compresses the data in an independent bzip2 stream'
+    return bz2.compress(data, level)
+
+
+_BLOCK_COMPRESSORS = {GZIP: _compress_gzip_member,
+                      BGZF: _compress_bgzf_blocks,
+                      BZIP2: _compress_bzip2_stream}
+
+
+class _ParallelBlockWriter(io.RawIOBase):
+    '''A writer that compresses independent blocks in a pool of threads.
+
+    The compressed blocks, gzip members, BGZF blocks or bzip2 streams, are
+    written in order. Concatenated they form a valid compressed file.
+    '''
+    def __init__(self, fhand, compression_kind, level, num_threads,
+                 block_size=None, max_blocks_in_flight=None):
+        super(_ParallelBlockWriter, self).__init__()
+        if block_size is None:
+            block_size = get_setting('COMPRESSION_BLOCK_SIZE')
+        if max_blocks_in_flight is None:
+            max_blocks_in_flight = 2 * num_threads
+        self._fhand = fhand
+        self._compression_kind = compression_kind
+        self._compress = _BLOCK_COMPRESSORS[compression_kind]
+        self._level = level
+        self._block_size = block_size
+        self._max_blocks_in_flight = max_blocks_in_flight
+        self._pool = ThreadPool(num_threads)
+        self._results = deque()
+        self._buffer = []
+        self._buffer_len = 0
+        if hasattr(fhand, 'name'):
+            self.name = fhand.name
+        self.mode = 'wb'
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_len += len(data)
+        if self._buffer_len >= self._block_size:
+            self._submit_buffer()
+        return len(data)
+
+    def _submit_buffer(self):
+        'It sends the buffered data to be compressed'
+        if not self._buffer_len:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffer_len = 0
+        self._results.append(self._pool.apply_async(self._compress,
+                                                    (data, self._level)))
+        self._write_compressed(wait_for_all=False)
+
+    def _write_compressed(self, wait_for_all):
+        'It writes the compressed blocks in order'
+        results = self._results
+        while results:
+            if (not wait_for_all and not results[0].ready() and
+                len(results) < self._max_blocks_in_flight):
+                break
+            self._fhand.write(results.popleft().get())
+
+    def flush(self):
+        if self.closed:
+            return
+        self._submit_buffer()
+        self._write_compressed(wait_for_all=True)
+        self._fhand.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            if self._compression_kind == BGZF:
+                self._fhand.write(_BGZF_EOF)
+                self._fhand.flush()
+        finally:
+            self._pool.terminate()
+            super(_ParallelBlockWriter, self).close()
+
+
+def compress_fhand(fhand, compression_kind=None, compression_level=None,
+                   num_threads=None):
+    '''Compresses the file if required.
+
+    When writing, blocks are compressed in parallel by num_threads threads
+    (default COMPRESSION_THREADS setting), 0 compresses in the main thread.
+    '''
+    if compression_kind is None:
+        return fhand
+    if compression_level is None:
+        compression_level = _DEFAULT_COMPRESSION_LEVELS[compression_kind]
+    if num_threads is None:
+        num_threads = get_setting('COMPRESSION_THREADS')
+    mode = getattr(fhand, 'mode', 'w')
+
+    if compression_kind == BGZF and not fhand_is_seekable(fhand):
+        raise RuntimeError('bgzf is only available for seekable files')
+    if num_threads and 'w' in mode:
+        return _ParallelBlockWriter(fhand, compression_kind,
+                                    level=compression_level,
+                                    num_threads=num_threads)
+
     if compression_kind == BGZF:
-        if fhand_is_seekable(fhand):
-            fhand = BgzfWriter(fileobj=fhand)
-        else:
-            raise RuntimeError('bgzf is only available for seekable files')
+        fhand = BgzfWriter(fileobj=fhand, compresslevel=compression_level)
     elif compression_kind == GZIP:
-        fhand = GzipFile(fileobj=fhand)
+        fhand = GzipFile(fileobj=fhand, compresslevel=compression_level)
     elif compression_kind == BZIP2:
-        mode = 'w' if 'w' in fhand.mode else 'r'
+        mode = 'w' if 'w' in mode else 'r'
         try:
-            fhand = BZ2File(fhand, mode=mode)
+            fhand = BZ2File(fhand, mode=mode,
+                            compresslevel=compression_level)
         except NameError:
             raise OptionalRequirementError(BZIP_ERROR)
     return fhand
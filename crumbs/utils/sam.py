@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import re
 import subprocess
 from operator import or_
 
@@ -57,3 +58,42 @@ def index_bam(bam_fpath):
     'It indexes a bam file'
     samtools_binary = get_binary_path('samtools')
     subprocess.check_call([samtools_binary, 'index', bam_fpath])
+
+
+def iter_sam_mapped_names(sam_lines, min_mapq=None):
+    '''It yields the names of the mapped reads of a SAM text stream.
+
+    A read with several alignments is yielded once per alignment. With
+    min_mapq only the alignments with a greater mapq are taken into account.
+    '''
+    for line in sam_lines:
+        if line[0] == '@':
+            continue
+        fields = line.split('\t', 5)
+        if int(fields[1]) & IS_UNMAPPED:
+            continue
+        if min_mapq and int(fields[4]) <= min_mapq:
+            continue
+        yield fields[0]
+
+
+_DIGIT_RUNS = re.compile(r'(\d+)')
+
+
+def natural_name_key(name):
+    '''It returns a key to order the names like samtools sort -n does.
+
+    The runs of digits are compared as numbers, if the numbers are equal
+    the run with more leading zeros goes first, and any other character by
+    its code.
+    '''
+    parts = _DIGIT_RUNS.split(name)
+    # the runs of up to 255 digits are encoded as a '0', that compares with
+    # the other characters like any digit, the number length, the number and
+    # the number of leading zeros
+    for index in xrange(1, len(parts), 2):
+        digits = parts[index]
+        number = digits.lstrip('0')
+        parts[index] = '0%c%s%c' % (len(number), number,
+                                    255 - len(digits) + len(number))
+    return ''.join(parts)
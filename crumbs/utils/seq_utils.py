@@ -14,11 +14,26 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import os
+import sys
 import itertools
+from time import time
+from collections import deque
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
 from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from tempfile import mkdtemp
+from shutil import copyfileobj, rmtree
 
-from crumbs.utils.tags import UPPERCASE, LOWERCASE, SWAPCASE
-from crumbs.seq import get_description, get_name, get_str_seq, copy_seq
+from crumbs.utils.tags import (UPPERCASE, LOWERCASE, SWAPCASE,
+                               SANGER_FASTQ_FORMATS, ILLUMINA_FASTQ_FORMATS)
+from crumbs.seq import (get_description, get_name, get_str_seq, copy_seq,
+                        get_derived_view)
+from crumbs.seqio import read_seq_packets, AdaptivePacketizer
+from crumbs.seq_batch import NUMPY_AVAILABLE
+from crumbs.utils.file_utils import fhand_is_seekable
+from crumbs.utils.file_formats import get_format, set_format
+from crumbs.settings import get_setting
 
 
 # pylint: disable=R0903
@@ -30,17 +45,28 @@ def uppercase_length(string):
     return len(re.findall("[A-Z]", string))
 
 
+_UPPERCASE_SEGMENT_RE = re.compile('[A-Z]+')
+
+
 def get_uppercase_segments(string):
     '''It detects the unmasked regions of a sequence
 
     It returns a list of (start, end) tuples'''
-    start = 0
-    for is_upper, group in itertools.groupby(string, lambda x: x.isupper()):
-        group = list(group)
-        end = start + len(group) - 1
-        if is_upper:
-            yield start, end
-        start = end + 1
+    for match in _UPPERCASE_SEGMENT_RE.finditer(string):
+        yield match.start(), match.end() - 1
+
+
+def _get_seq_uppercase_segments(seq):
+    return tuple(get_uppercase_segments(get_str_seq(seq)))
+
+
+def get_seq_uppercase_segments(seq):
+    '''It returns the unmasked regions of a seq as (start, end) tuples.
+
+    They are cached in the SeqItems.
+    '''
+    return get_derived_view(seq, 'uppercase_segments',
+                            _get_seq_uppercase_segments)
 
 
 class ChangeCase(object):
@@ -94,18 +120,447 @@ class _FunctionRunner(object):
             processed_packet = map_function(processed_packet)
         return processed_packet
 
+    def close(self):
+        '''It closes the map_functions that have a close method.
+
+        They are the ones that keep an external program running, like a
+        mapper, that should be stopped once all packets have been processed.
+        '''
+        for map_function in self.map_functions:
+            if hasattr(map_function, 'close'):
+                map_function.close()
+
+
+# The functions run by every worker of the pool. They are installed once
+# when the worker starts, so only the packets are sent to the workers. They
+# are closed when the worker exits
+_WORKER_FUNCTIONS = None
+
+
+def _install_worker_functions(map_functions):
+    'It stores the functions to run in the worker process'
+    global _WORKER_FUNCTIONS
+    _WORKER_FUNCTIONS = _FunctionRunner(map_functions)
+    Finalize(_WORKER_FUNCTIONS, _WORKER_FUNCTIONS.close, exitpriority=10)
+
+
+def _run_worker_functions(pickled_packet):
+    '''It runs the functions installed in the worker for the packet.
+
+    The packets are pickled by the parent and the worker, so the time spent
+    pickling and unpickling them is known. It returns the pickled processed
+    packet and the seconds spent unpickling, processing and pickling it.
+    '''
+    start = time()
+    seq_packet = _WORKER_FUNCTIONS(loads(pickled_packet))
+    pickled_packet = dumps(seq_packet, HIGHEST_PROTOCOL)
+    return pickled_packet, time() - start
+
+
+def _run_timed_functions(run_functions, seq_packets, packetizer):
+    'It processes the packets and it records their cost in the packetizer'
+    for index, seq_packet in enumerate(seq_packets):
+        start = time()
+        seq_packet = run_functions(seq_packet)
+        packetizer.record_cost(index, time() - start)
+        yield seq_packet
+
+
+def _run_functions(run_functions, seq_packets, packetizer=None):
+    'It processes the packets in this process'
+    if packetizer is None:
+        return itertools.imap(run_functions, seq_packets)
+    return _run_timed_functions(run_functions, seq_packets, packetizer)
+
+
+def _run_and_close_functions(run_functions, seq_packets, packetizer=None):
+    'It processes the packets in this process and then it closes the runner'
+    for seq_packet in _run_functions(run_functions, seq_packets, packetizer):
+        yield seq_packet
+    run_functions.close()
+
+
+def _create_worker_pool(map_functions, processes):
+    'It returns a pool whose workers have the map functions installed'
+    return Pool(processes=processes, initializer=_install_worker_functions,
+                initargs=(map_functions,))
+
+
+class PacketScheduler(object):
+    '''It sends the packets to the pool workers and it yields the results.
+
+    At most max_in_flight packets are being processed or waiting to be
+    consumed, a new packet is only read from the input once a processed
+    one has been yielded. So a slow consumer, like the writing of a
+    compressed file, stops the reading instead of piling up packets in
+    memory. The stats hold the number of packets sent, the current and
+    maximum queue depth, the time waiting for the workers with the queue
+    full or empty (worker_wait_time) and the time during which the reading
+    was stopped by the consumer (consumer_time).
+    The time spent processing and pickling every packet is recorded in the
+    packetizer, if given.
+    '''
+    def __init__(self, workers, packets, max_in_flight, keep_order=True,
+                 packetizer=None):
+        if max_in_flight < 1:
+            raise ValueError('At least a packet should be in flight')
+        self._workers = workers
+        self._packets = packets
+        self._packetizer = packetizer
+        self.max_in_flight = max_in_flight
+        self.keep_order = keep_order
+        self.stats = {'packets_sent': 0, 'queue_depth': 0,
+                      'max_queue_depth': 0, 'worker_wait_time': 0.0,
+                      'consumer_time': 0.0}
+
+    def _pop_result(self, pending):
+        'It waits for a processed packet and removes it from the queue'
+        item = None
+        if not self.keep_order:
+            for item in pending:
+                if item[1].ready():
+                    break
+            else:
+                item = None
+        if item is None:
+            item = pending[0]
+        index, result, pickling_secs = item
+        start = time()
+        pickled_packet, secs = result.get()
+        self.stats['worker_wait_time'] += time() - start
+        pending.remove(item)
+        self.stats['queue_depth'] = len(pending)
+        start = time()
+        packet = loads(pickled_packet)
+        if self._packetizer is not None:
+            secs += pickling_secs + time() - start
+            self._packetizer.record_cost(index, secs)
+        return packet
+
+    def _yield_result(self, pending):
+        'It yields a processed packet and it times the consumer'
+        packet = self._pop_result(pending)
+        start = time()
+        yield packet
+        self.stats['consumer_time'] += time() - start
+
+    def __iter__(self):
+        stats = self.stats
+        pending = deque()
+        for index, packet in enumerate(self._packets):
+            start = time()
+            packet = dumps(packet, HIGHEST_PROTOCOL)
+            pickling_secs = time() - start
+            result = self._workers.apply_async(_run_worker_functions,
+                                               (packet,))
+            pending.append((index, result, pickling_secs))
+            stats['packets_sent'] += 1
+            stats['queue_depth'] = len(pending)
+            stats['max_queue_depth'] = max(stats['max_queue_depth'],
+                                           len(pending))
+            if len(pending) >= self.max_in_flight:
+                for processed_packet in self._yield_result(pending):
+                    yield processed_packet
+        while pending:
+            for processed_packet in self._yield_result(pending):
+                yield processed_packet
+        # the workers close their functions when they exit
+        self._workers.close()
+        self._workers.join()
+
 
 def process_seq_packets(seq_packets, map_functions, processes=1,
-                        keep_order=True):
-    'It processes the SeqRecord packets'
+                        keep_order=True, max_packets_in_flight=None,
+                        packetizer=None):
+    '''It processes the SeqRecord packets
+
+    With several processes the packets are processed by a pool of workers
+    with a bounded number of packets in flight (by default
+    PACKETS_IN_FLIGHT_PER_PROCESS per process), see PacketScheduler.
+    If the packets have been created by an AdaptivePacketizer it should be
+    given to record the processing time of every packet.
+    '''
     if processes > 1:
-        workers = Pool(processes=processes)
-        mapper = workers.imap if keep_order else workers.imap_unordered
+        if max_packets_in_flight is None:
+            max_packets_in_flight = processes * \
+                                get_setting('PACKETS_IN_FLIGHT_PER_PROCESS')
+        workers = _create_worker_pool(map_functions, processes)
+        seq_packets = PacketScheduler(workers, seq_packets,
+                                      max_packets_in_flight,
+                                      keep_order=keep_order,
+                                      packetizer=packetizer)
     else:
         workers = None
-        mapper = itertools.imap
-    run_functions = _FunctionRunner(map_functions)
-
-    seq_packets = mapper(run_functions, seq_packets)
+        run_functions = _FunctionRunner(map_functions)
+        seq_packets = _run_and_close_functions(run_functions, seq_packets,
+                                               packetizer)
 
     return seq_packets, workers
+
+
+def _find_fasta_record_start(fhand):
+    'It returns the offset of the next fasta title line'
+    while True:
+        offset = fhand.tell()
+        line = fhand.readline()
+        if not line or line[0] == '>':
+            return offset
+
+
+def _is_fastq_record_start(lines, index):
+    'It checks that the line is the title of a four line fastq record'
+    if index + 3 >= len(lines):
+        return False
+    return (lines[index][0] == '@' and lines[index + 2][0] == '+' and
+            len(lines[index + 1].rstrip()) == len(lines[index + 3].rstrip()))
+
+
+def _find_fastq_record_start(fhand):
+    '''It returns the offset of the next four line fastq record.
+
+    The quality lines can start with @, so a title line is the one followed,
+    two lines later, by the + line.
+    '''
+    offsets, lines = [], []
+    # in any four consecutive lines there is a title
+    for _ in range(7):
+        offsets.append(fhand.tell())
+        line = fhand.readline()
+        if not line:
+            break
+        lines.append(line)
+    for index in range(len(lines)):
+        if _is_fastq_record_start(lines, index):
+            return offsets[index]
+    return offsets[-1]
+
+
+def _is_four_line_fastq(fpath):
+    'It checks if the first fastq records are four line records'
+    fhand = open(fpath, 'rb')
+    lines = [fhand.readline() for _ in range(8)]
+    fhand.close()
+    lines = [line for line in lines if line]
+    return (_is_fastq_record_start(lines, 0) and
+            (len(lines) < 5 or _is_fastq_record_start(lines, 4)))
+
+
+def get_record_aligned_ranges(fpath, file_format, num_ranges,
+                              min_range_size=None):
+    '''It splits a fasta or fastq file in byte ranges with whole records.
+
+    It returns a list of (start, end) tuples. Only four line fastq files
+    are supported.
+    '''
+    if min_range_size is None:
+        min_range_size = get_setting('SCATTER_MIN_RANGE_SIZE')
+    size = os.path.getsize(fpath)
+    if min_range_size:
+        num_ranges = min(num_ranges, size // min_range_size)
+    num_ranges = max(min(num_ranges, size), 1)
+    if 'fastq' in file_format:
+        find_record_start = _find_fastq_record_start
+    else:
+        find_record_start = _find_fasta_record_start
+    fhand = open(fpath, 'rb')
+    starts = [0]
+    for index in range(1, num_ranges):
+        # we look for the record from the beginning of a line
+        fhand.seek(size * index // num_ranges - 1)
+        fhand.readline()
+        start = find_record_start(fhand)
+        if starts[-1] < start < size:
+            starts.append(start)
+    fhand.close()
+    return zip(starts, starts[1:] + [size])
+
+
+class _FileRange(object):
+    'A read only file-like view of a byte range of a file'
+    def __init__(self, fpath, start, end):
+        self._fhand = open(fpath, 'rb')
+        self._fhand.seek(start)
+        self._left = end - start
+        self.name = '{}:{}-{}'.format(fpath, start, end)
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._fhand.read(size)
+        self._left -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        if not size:
+            return ''
+        line = self._fhand.readline(size)
+        self._left -= len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self._fhand.close()
+
+
+def _process_byte_range(job):
+    '''It parses, processes and writes the seqs of a byte range of a file.
+
+    The seqs are processed by the functions installed in the worker. It
+    returns the paths of the files with the passed and diverted seqs.
+    '''
+    (index, fpath, file_format, start, end, to_packets, write_packets,
+     read_kwargs, out_format, write_diverted, out_dir) = job
+    in_fhand = _FileRange(fpath, start, end)
+    set_format(in_fhand, file_format)
+    prefix = os.path.join(out_dir, str(index))
+    passed_fhand = open(prefix + '.passed', 'wb')
+    if write_diverted:
+        diverted_fhand = open(prefix + '.diverted', 'wb')
+    else:
+        diverted_fhand = None
+
+    packets = to_packets(read_seq_packets([in_fhand], **read_kwargs))
+    packetizer = read_kwargs.get('packetizer')
+    packets = _run_functions(_WORKER_FUNCTIONS, packets, packetizer)
+    write_packets(passed_fhand, diverted_fhand, packets, out_format)
+    report_packet_sizes(packetizer, in_fhand.name)
+
+    in_fhand.close()
+    passed_fhand.close()
+    if diverted_fhand is None:
+        return passed_fhand.name, None
+    diverted_fhand.close()
+    return passed_fhand.name, diverted_fhand.name
+
+
+def _get_scatterable_files(in_fhands):
+    '''It returns the paths and formats of the files if they can be scattered
+
+    All files should be uncompressed fasta or four line fastq regular files.
+    '''
+    scatterable_formats = ('fasta',) + SANGER_FASTQ_FORMATS + \
+                                                        ILLUMINA_FASTQ_FORMATS
+    seq_files = []
+    for fhand in in_fhands:
+        if not isinstance(fhand, file) or not fhand_is_seekable(fhand):
+            return None
+        fpath = fhand.name
+        if not os.path.isfile(fpath) or not os.path.getsize(fpath):
+            return None
+        file_format = get_format(fhand)
+        if file_format not in scatterable_formats:
+            return None
+        if 'fastq' in file_format and not _is_four_line_fastq(fpath):
+            return None
+        seq_files.append((fpath, file_format))
+    return seq_files
+
+
+def _copy_part(part_fpath, fhand):
+    part_fhand = open(part_fpath, 'rb')
+    copyfileobj(part_fhand, fhand)
+    part_fhand.close()
+    os.remove(part_fpath)
+
+
+def _scatter_seq_files(seq_files, map_functions, to_packets, write_packets,
+                       out_fhand, diverted_fhand, out_format, processes,
+                       read_kwargs, ranges_per_process=None,
+                       min_range_size=None):
+    '''It processes the byte ranges of the files in a pool of workers.
+
+    The seqs written by every worker are copied, in the file order, to the
+    output files.
+    '''
+    if ranges_per_process is None:
+        ranges_per_process = get_setting('SCATTER_RANGES_PER_PROCESS')
+    ranges = []
+    for fpath, file_format in seq_files:
+        for start, end in get_record_aligned_ranges(fpath, file_format,
+                                               processes * ranges_per_process,
+                                               min_range_size=min_range_size):
+            ranges.append((fpath, file_format, start, end))
+    out_dir = mkdtemp(prefix='crumbs_scatter_')
+    jobs = ((index,) + range_ + (to_packets, write_packets, read_kwargs,
+                                 out_format, diverted_fhand is not None,
+                                 out_dir)
+            for index, range_ in enumerate(ranges))
+
+    workers = _create_worker_pool(map_functions, processes)
+    try:
+        for passed_fpath, diverted_fpath in workers.imap(_process_byte_range,
+                                                         jobs):
+            _copy_part(passed_fpath, out_fhand)
+            if diverted_fpath is not None:
+                _copy_part(diverted_fpath, diverted_fhand)
+        workers.close()
+    except BaseException:
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
+        rmtree(out_dir, ignore_errors=True)
+
+
+def report_packet_sizes(packetizer, input_name=None):
+    'It writes the packet sizes in the standard error if requested'
+    if packetizer is None or not get_setting('REPORT_PACKET_SIZES'):
+        return
+    report = packetizer.get_report()
+    if input_name is not None:
+        report = input_name + ': ' + report
+    sys.stderr.write(report)
+
+
+def process_seq_files(in_fhands, map_functions, to_packets, write_packets,
+                      out_fhand, diverted_fhand=None, out_format=None,
+                      processes=1, paired_reads=False, packet_size=None,
+                      prefered_seq_classes=None):
+    '''It reads, processes and writes the seqs for the filters and trimmers.
+
+    to_packets creates the filter or trim packets from the seq packets and
+    write_packets writes the passed and the filtered out, or orphan, seqs.
+    With several processes the uncompressed fasta and fastq files are split
+    in record aligned byte ranges and every worker parses, processes and
+    writes its ranges. Otherwise, or for paired reads, the seqs are parsed
+    in this process and sent to the workers in packets.
+    The packets are sized by an AdaptivePacketizer unless the
+    ADAPTIVE_PACKET_SIZE setting is False, then they have packet_size seqs
+    (default PACKET_SIZE). They are SeqBatches if some filter can check them.
+    '''
+    if packet_size is None:
+        packet_size = get_setting('PACKET_SIZE')
+    packetizer = None
+    if get_setting('ADAPTIVE_PACKET_SIZE'):
+        packetizer = AdaptivePacketizer(seqs_multiple=2 if paired_reads
+                                                                      else 1)
+    # the filters that can check a whole SeqBatch get the packets as batches
+    batches = (NUMPY_AVAILABLE and get_setting('BATCH_FILTERS') and
+               any(getattr(function, '_do_check_batch', None) is not None
+                   for function in map_functions))
+    read_kwargs = {'size': packet_size, 'packetizer': packetizer,
+                   'prefered_seq_classes': prefered_seq_classes,
+                   'batches': batches}
+
+    seq_files = None
+    if (processes > 1 and not paired_reads and
+                                        get_setting('SCATTER_INPUT_FILES')):
+        seq_files = _get_scatterable_files(in_fhands)
+    if seq_files:
+        _scatter_seq_files(seq_files, map_functions, to_packets,
+                           write_packets, out_fhand, diverted_fhand,
+                           out_format, processes, read_kwargs)
+        return
+
+    seq_packets = read_seq_packets(in_fhands, **read_kwargs)
+    packets = to_packets(seq_packets, group_paired_reads=paired_reads)
+    packets, workers = process_seq_packets(packets, map_functions,
+                                           processes=processes,
+                                           packetizer=packetizer)
+    write_packets(out_fhand, diverted_fhand, packets, out_format,
+                  workers=workers)
+    report_packet_sizes(packetizer)
@@ -51,11 +51,19 @@ THREE_PRIME = "3'"
 
 SEQS_PASSED = 'seqs_passed'
 SEQS_FILTERED_OUT = 'seqs_filtered_out'
+# the SeqBatch with the seqs passed, in the same order
+SEQ_BATCH = 'seq_batch'
+# the stats of every step of a Pipeline for the seqs of a packet
+PIPELINE_STATS = 'pipeline_stats'
 
 ORPHAN_SEQS = 'orphan_seqs'
 
 SEQITEM = 'seqitem'
 SEQRECORD = 'seqrecord'
+# SeqItem reader engines
+LINE_READER = 'line_reader'
+BLOCK_READER = 'block_reader'
+MMAP_READER = 'mmap_reader'
 SANGER_QUALITY = 'fastq'
 ILLUMINA_QUALITY = 'fastq-illumina'
 SANGER_FASTQ_FORMATS = ('fastq-sanger', 'fastq')
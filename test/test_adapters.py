@@ -0,0 +1,92 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import unittest
+import random
+
+from crumbs import adapters
+from crumbs.adapters import (find_adapter_starts, _search_in_seq,
+                             _search_in_seqs)
+
+ADAPTER = 'AGATGTGTATAAGAGACAG'
+
+
+class AdapterSearchTest(unittest.TestCase):
+    def test_search(self):
+        # match end and last column deltas
+        assert _search_in_seq('CCC' + ADAPTER + 'CC', ADAPTER, 1)[0] == 21
+        assert _search_in_seq('CCC' + ADAPTER[:10], ADAPTER, 1)[0] is None
+        assert _search_in_seq('', ADAPTER, 1) == (None, (1 << 19) - 1, 0)
+
+        # the match end only moves while the score improves
+        seq = 'CCC' + ADAPTER[:-1] + 'TG'
+        assert _search_in_seq(seq, ADAPTER, 1)[0] == 20
+
+    def test_batch_search(self):
+        if adapters.numpy is None:
+            return
+        random.seed(42)
+        seqs = []
+        for _ in range(200):
+            seq = [random.choice('ACGT') for _ in range(random.randint(0,
+                                                                      60))]
+            position = random.randint(0, len(seq))
+            adapter = list(ADAPTER)
+            for _ in range(random.randint(0, 3)):
+                adapter[random.randrange(len(adapter))] = random.choice('ACGT')
+            seq[position:position] = adapter
+            seqs.append(''.join(seq[:random.randint(position, len(seq))]))
+        expected = [_search_in_seq(seq, ADAPTER, 1) for seq in seqs]
+        assert _search_in_seqs(seqs, ADAPTER, 1) == expected
+        assert _search_in_seqs([], ADAPTER, 1) == []
+
+    def test_adapter_starts(self):
+        seqs = ['CCCCC' + ADAPTER + 'TTTT',
+                # an insertion, and too many errors
+                'CCCCC' + ADAPTER[:5] + 'T' + ADAPTER[5:],
+                'CCCCC' + ADAPTER[:5] + 'T' + ADAPTER[5:12] + 'C' +
+                ADAPTER[13:],
+                # a deletion
+                'CCCCC' + ADAPTER[:8] + ADAPTER[9:],
+                # partial adapters
+                'CCCCC' + ADAPTER[:3], 'CCCCC' + ADAPTER[:2],
+                'CCCCC' + ADAPTER[:9] + 'C' + ADAPTER[10:13],
+                'CCCCC' + ADAPTER[:6] + 'C' + ADAPTER[7:9],
+                # in lower case and with Ns
+                'ccccc' + ADAPTER.lower(), 'CCCCC' + 'N' * 19, 'C' * 20, '']
+        starts = [5, 5, None, 5, 5, None, 5, None, 5, None, None, None]
+        assert find_adapter_starts(seqs, [ADAPTER]) == starts
+
+        # the first adapter of every read
+        assert find_adapter_starts(seqs[:3], ['CCCCC', ADAPTER]) == [0, 0, 0]
+        assert find_adapter_starts(['AAA' + ADAPTER + 'CCCCC'],
+                                   ['CCCCC', ADAPTER]) == [3]
+
+        # without numpy
+        numpy = adapters.numpy
+        adapters.numpy = None
+        try:
+            assert find_adapter_starts(seqs, [ADAPTER]) == starts
+        finally:
+            adapters.numpy = numpy
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'AdapterSearchTest']
+    unittest.main()
@@ -0,0 +1,108 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import os.path
+import unittest
+import cPickle as pickle
+
+from crumbs.alignment_cache import AlignmentCache, _encode_result
+from crumbs.utils.file_utils import TemporaryDir
+
+
+def _create_result(name, num_matches=1):
+    match_part = {'query_start': 0, 'query_end': 99, 'subject_start': 10,
+                  'subject_end': 109, 'scores': {'expect': 1e-30,
+                                                 'identity': 98.0}}
+    match = {'subject': {'name': 'subject', 'length': 200}, 'start': 0,
+             'end': 99, 'subject_start': 10, 'subject_end': 109,
+             'scores': {'expect': 1e-30}, 'match_parts': [match_part]}
+    return {'query': {'name': name, 'length': 100},
+            'matches': [match] * num_matches}
+
+
+class AlignmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDir()
+        self.fpath = os.path.join(self.temp_dir.name, 'cache.sqlite')
+
+    def tearDown(self):
+        self.temp_dir.close()
+
+    def test_results(self):
+        cache = AlignmentCache(self.fpath)
+        result = _create_result('seq1')
+        cache.add_result('key1', result)
+        cache.add_result('key2', None)
+        # the results are encoded when they are added
+        result['matches'] = []
+        assert cache.get_results(['key1']) == {}
+        cache.flush()
+
+        results = cache.get_results(['key1', 'key2', 'key3'])
+        assert results == {'key1': _create_result('seq1'), 'key2': None}
+        stats = cache.get_stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+        assert stats['num_results'] == 2
+        assert stats['hit_rate'] == 0.5
+        cache.close()
+
+        # the cache is kept in the file
+        cache = AlignmentCache(self.fpath)
+        assert 'key1' in cache.get_results(['key1'])
+        assert cache.get_stats()['hits'] == 3
+        cache.reset_stats()
+        stats = cache.get_stats()
+        assert stats['hits'] == stats['misses'] == 0
+        assert stats['hit_rate'] is None
+        assert stats['size'] > 0
+
+        # a result already stored is not replaced
+        cache.add_result('key1', None)
+        cache.flush()
+        assert cache.get_results(['key1'])['key1'] is not None
+
+        # the cache can be used by other processes
+        cache = pickle.loads(pickle.dumps(cache))
+        assert 'key1' in cache.get_results(['key1'])
+        cache.close()
+
+    def test_lru_eviction(self):
+        result_size = len(_encode_result(_create_result('seq', 3)))
+        cache = AlignmentCache(self.fpath, max_size=result_size * 3)
+        for index in range(3):
+            cache.add_result('key{}'.format(index), _create_result('seq', 3))
+            cache.flush()
+        assert cache.get_stats()['evictions'] == 0
+
+        # key0 is used, so key1 is the least recently used one
+        cache.get_results(['key0'])
+        cache.add_result('key3', _create_result('seq', 3))
+        cache.flush()
+        keys = ['key{}'.format(index) for index in range(4)]
+        assert sorted(cache.get_results(keys)) == ['key0', 'key2', 'key3']
+        stats = cache.get_stats()
+        assert stats['evictions'] == 1
+        assert stats['size'] == result_size * 3
+        cache.close()
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'AlignmentCacheTest']
+    unittest.main()
@@ -15,18 +15,28 @@
 
 import unittest
 import os.path
+from cStringIO import StringIO
 from tempfile import NamedTemporaryFile
 
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
 from crumbs.blast import (do_blast, BlasterForFewSubjects,
-                          get_or_create_blastdb, _blastdb_exists, Blaster)
+                          get_or_create_blastdb, _blastdb_exists, Blaster,
+                          OligoBlaster, _swap_queries_and_subjects,
+                          _index_match_parts_by_subject,
+                          _TABBLAST_FORMAT_WITH_LENGTHS, get_blast_threads,
+                          _split_in_chunks, _get_cache_keys,
+                          _do_cached_blast, generate_tabblast_format)
+from crumbs import blast
+from crumbs.alignment_cache import AlignmentCache
+from crumbs.alignment_result import TabularBlastParser, filter_alignments
 from crumbs.utils.file_utils import TemporaryDir
-from crumbs.settings import get_setting
+from crumbs.settings import get_setting, get_settings
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.tags import NUCL, SEQITEM, SEQRECORD
-from crumbs.seq import SeqWrapper, SeqItem, assing_kind_to_seqs
+from crumbs.seq import SeqWrapper, SeqItem, assing_kind_to_seqs, get_name
+from crumbs.seqio import read_seqs
 
 TITANIUM_LINKER = get_setting('TITANIUM_LINKER')
 FLX_LINKER = get_setting('FLX_LINKER')
@@ -148,6 +158,61 @@ class BlastMaterTest(unittest.TestCase):
         assert [expected_region] == linker_region
 
 
+class OligoBlasterTest(unittest.TestCase):
+    def test_swap_queries_and_subjects(self):
+        # the reads blasted against the oligos
+        blast = 'read1\toligo1\t60\t30\t31\t60\t1\t30\t1e-10\t100\n'
+        blast += 'read2\toligo1\t60\t30\t11\t40\t30\t1\t1e-10\t100\n'
+        blast += 'read2\toligo2\t60\t20\t51\t60\t1\t10\t1e-3\t100\n'
+        blasts = TabularBlastParser(StringIO(blast),
+                                    _TABBLAST_FORMAT_WITH_LENGTHS)
+        blasts = list(_swap_queries_and_subjects(blasts))
+        assert [(b['query']['name'], b['matches'][0]['subject']['name'])
+                for b in blasts] == [('oligo1', 'read1'), ('oligo1', 'read2'),
+                                     ('oligo2', 'read2')]
+        assert blasts[0]['query']['length'] == 30
+        assert blasts[0]['matches'][0]['subject']['length'] == 60
+        # the oligo coordinates are forward
+        match_part = blasts[1]['matches'][0]['match_parts'][0]
+        assert (match_part['query_start'], match_part['query_end']) == (0, 29)
+        assert (match_part['subject_start'],
+                match_part['subject_end']) == (39, 10)
+
+        # the filters see the oligos as queries
+        filters = [{'kind': 'min_length', 'min_num_residues': 13,
+                    'length_in_query': False}]
+        blasts = TabularBlastParser(StringIO(blast),
+                                    _TABBLAST_FORMAT_WITH_LENGTHS)
+        blasts = filter_alignments(_swap_queries_and_subjects(blasts),
+                                   config=filters)
+        match_parts = _index_match_parts_by_subject(blasts, False)
+        assert len(match_parts['read1']) == 1
+        assert len(match_parts['read2']) == 1
+
+    def test_oligo_blaster(self):
+        seq_5 = 'CTAGTCTAGTCGTAGTCATGGCTGTAGTCTAGTCTACGATTCGTATCAGTTGTGTGAC'
+        mate_fhand = create_a_matepair_file()
+        seqs = list(read_seqs([mate_fhand]))
+
+        linkers = [SeqItem('titan', ['>titan\n', TITANIUM_LINKER + '\n']),
+                   SeqItem('flx', ['>flx\n', FLX_LINKER + '\n'])]
+        linkers = assing_kind_to_seqs(SEQITEM, linkers, 'fasta')
+
+        expected_region = (len(seq_5), len(seq_5 + TITANIUM_LINKER) - 1)
+        matcher = OligoBlaster(linkers, program='blastn',
+                               elongate_for_global=True, num_threads=2)
+        # the database is reused for every packet
+        for _ in range(2):
+            matcher.match_seqs(seqs)
+            linker_region = matcher.get_matched_segments_for_read('seq1')[0]
+            assert [expected_region] == linker_region
+        matcher.match_seqs([])
+        assert matcher.get_matched_segments_for_read('seq1') is None
+        db_dir = matcher._db_dir.name
+        matcher.close()
+        assert not os.path.exists(db_dir)
+
+
 class BlasterTest(unittest.TestCase):
     def xtest_blaster(self):
         seq = 'GAGAAATTCCTTTGGAAGTTATTCCGTAGCATAAGAGCTGAAACTTCAGAGCAAGTTT'
@@ -160,6 +225,131 @@ class BlasterTest(unittest.TestCase):
         print blaster.get_matched_segments('seq')
         assert blaster.get_matched_segments('seq') == [(1, 1740)]
 
+    def test_blaster_in_chunks(self):
+        blastdb = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
+        match = 'CCAAAGTACGGTCTCCCAAGCGGTCTCTTACCGGACACCGTCACCGATTTCACCCTCT'
+        seqs = []
+        for index in range(5):
+            seq = 'ATCATGTAGTTACACATGAACACACACATG' * index + match
+            seqrec = SeqRecord(Seq(seq), id='seq{}'.format(index))
+            seqs.append(SeqWrapper(SEQRECORD, seqrec, None))
+        expected = Blaster(seqs, blastdb, 'blastn').blasts
+        assert len(expected) == 5
+        blaster = Blaster(seqs, blastdb, 'blastn', processes=3, threads=4)
+        assert blaster.blasts == expected
+        assert blaster.blasts.keys() == expected.keys()
+
+    def test_split_in_chunks(self):
+        assert _split_in_chunks(range(7), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+        assert _split_in_chunks(range(2), 2) == [[0], [1]]
+
+    def test_blast_threads(self):
+        settings = get_settings()
+        max_threads = settings['BLAST_MAX_THREADS']
+        settings['BLAST_MAX_THREADS'] = 8
+        try:
+            assert get_blast_threads(4) == (4, 4)
+            assert get_blast_threads(2, 6) == (2, 6)
+            # the threads of all the workers are limited
+            assert get_blast_threads(4, workers=4) == (2, 2)
+            assert get_blast_threads(4, 16, workers=2) == (4, 4)
+            assert get_blast_threads(2, workers=16) == (1, 1)
+        finally:
+            settings['BLAST_MAX_THREADS'] = max_threads
+
+class BlastCacheTest(unittest.TestCase):
+    def _create_seqs(self):
+        match = 'CCAAAGTACGGTCTCCCAAGCGGTCTCTTACCGGACACCGTCACCGATTTCACCCTCT'
+        seqs = ['ATCATGTAGTTACACATGAACACACACATG' + match,
+                'ATCATGTAGTTACACATGAACACACACATG']
+        seqrecs = [SeqRecord(Seq(seq), id='seq{}'.format(index))
+                   for index, seq in enumerate(seqs)]
+        return [SeqWrapper(SEQRECORD, seqrec, None) for seqrec in seqrecs]
+
+    def test_cached_results(self):
+        blastdb = os.path.join(TEST_DATA_DIR, 'blastdbs', 'arabidopsis_genes')
+        seqs = self._create_seqs()
+        temp_dir = TemporaryDir()
+        cache = AlignmentCache(os.path.join(temp_dir.name, 'cache.sqlite'))
+        params = {'outfmt': generate_tabblast_format(
+                                                _TABBLAST_FORMAT_WITH_LENGTHS)}
+        keys = _get_cache_keys(seqs, blastdb, 'blastn', params,
+                               _TABBLAST_FORMAT_WITH_LENGTHS)
+        match_part = {'query_start': 30, 'query_end': 87,
+                      'subject_start': 0, 'subject_end': 57,
+                      'scores': {'expect': 1e-25, 'identity': 100.0}}
+        match = {'subject': {'name': 'AT1G1', 'length': 100}, 'start': 30,
+                 'end': 87, 'subject_start': 0, 'subject_end': 57,
+                 'scores': {'expect': 1e-25}, 'match_parts': [match_part]}
+        cache.add_result(keys[0], {'query': {'name': 'other', 'length': 88},
+                                   'matches': [match]})
+        cache.add_result(keys[1], None)
+        cache.flush()
+
+        # all the seqs are found in the cache, so blast is not run
+        blaster = Blaster(seqs, blastdb, 'blastn', cache=cache)
+        assert blaster.get_matched_segments('seq0') == [(0, 57)]
+        assert blaster.get_matched_segments('seq1') is None
+        assert cache.get_stats()['hits'] == 2
+
+        # the keys depend on the blast params
+        params['task'] = 'blastn'
+        assert _get_cache_keys(seqs, blastdb, 'blastn', params,
+                               _TABBLAST_FORMAT_WITH_LENGTHS)[0] != keys[0]
+        temp_dir.close()
+
+    def test_repeated_query_names(self):
+        blastdb = os.path.join(TEST_DATA_DIR, 'blastdbs', 'arabidopsis_genes')
+        # the interleaved pairs without /1 and /2 have the same name
+        seqs = [SeqWrapper(SEQRECORD, SeqRecord(Seq(seq), id='pair'), None)
+                for seq in ('ACTGACTGAC', 'GGGGCCCCAA')]
+        blasted_queries = []
+
+        def fake_blast(queries, db_fpath, program, **kwargs):
+            # only the first query has a match
+            blasted_queries.extend(queries)
+            name = get_name(queries[0])
+            return iter(['\t'.join([name, 'AT1G1', '10', '100', '1', '10',
+                                    '1', '10', '1e-10', '100.0']) + '\n'])
+
+        temp_dir = TemporaryDir()
+        cache = AlignmentCache(os.path.join(temp_dir.name, 'cache.sqlite'))
+        params = {'outfmt': generate_tabblast_format(
+                                                _TABBLAST_FORMAT_WITH_LENGTHS)}
+        do_blast_in_chunks = blast._do_blast_in_chunks
+        blast._do_blast_in_chunks = fake_blast
+        try:
+            results = list(_do_cached_blast(seqs, blastdb, 'blastn', params,
+                                            _TABBLAST_FORMAT_WITH_LENGTHS,
+                                            cache))
+        finally:
+            blast._do_blast_in_chunks = do_blast_in_chunks
+        assert len(set(get_name(query) for query in blasted_queries)) == 2
+        assert [result['query']['name'] for result in results] == ['pair']
+
+        # every result is cached with the key of its query
+        keys = _get_cache_keys(seqs, blastdb, 'blastn', params,
+                               _TABBLAST_FORMAT_WITH_LENGTHS)
+        cached_results = cache.get_results(keys)
+        assert cached_results[keys[0]]['query']['name'] == 'pair'
+        assert cached_results[keys[1]] is None
+        cache.close()
+        temp_dir.close()
+
+    def test_cached_blaster(self):
+        blastdb = os.path.join(TEST_DATA_DIR, 'blastdbs', 'arabidopsis_genes')
+        seqs = self._create_seqs()
+        temp_dir = TemporaryDir()
+        cache = AlignmentCache(os.path.join(temp_dir.name, 'cache.sqlite'))
+        expected = Blaster(seqs, blastdb, 'blastn').blasts
+        assert Blaster(seqs, blastdb, 'blastn', cache=cache).blasts == expected
+        assert Blaster(seqs, blastdb, 'blastn', cache=cache).blasts == expected
+        stats = cache.get_stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+        temp_dir.close()
+
+
 if __name__ == '__main__':
     #import sys;sys.argv = ['', 'BlastTest.test_get_or_create_blastdb']
     unittest.main()
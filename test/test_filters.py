@@ -20,7 +20,7 @@
 import unittest
 
 from string import ascii_lowercase
-from random import choice
+from random import choice, seed
 from subprocess import check_output, call, CalledProcessError
 import os.path
 from tempfile import NamedTemporaryFile
@@ -28,6 +28,7 @@ from tempfile import NamedTemporaryFile
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 from Bio.SeqFeature import SeqFeature, FeatureLocation
+import pysam
 
 from crumbs.filters import (FilterByLength, FilterById, FilterByQuality,
                             FilterBlastMatch, FilterBlastShort,
@@ -37,9 +38,12 @@ from crumbs.filters import (FilterByLength, FilterById, FilterByQuality,
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.tags import (NUCL, SEQS_FILTERED_OUT, SEQS_PASSED, SEQITEM,
-                               SEQRECORD)
-from crumbs.seq import get_name, get_str_seq, SeqWrapper
+                               SEQRECORD, SEQ_BATCH)
+from crumbs.seq import get_name, get_str_seq, SeqWrapper, SeqItem
 from crumbs.seqio import read_seq_packets
+from crumbs.seq_batch import SeqBatch, NUMPY_AVAILABLE
+from crumbs.settings import get_settings
+from crumbs.exceptions import ItemsNotSortedError
 
 
 _seqs_to_names = lambda seqs: [get_name(s) for pair in seqs for s in pair]
@@ -149,6 +153,13 @@ class LengthFilterTest(unittest.TestCase):
         assert not result
         assert '>s1\naCTg\n>s2\nAC\n' in open(filtered_fhand.name).read()
 
+        # the input file is processed by several workers
+        filtered_fhand = NamedTemporaryFile()
+        result = check_output([filter_bin, '-n', '3', '-p', '2', '-e',
+                               filtered_fhand.name, fasta_fhand.name])
+        assert result == '>s1\naCTg\n'
+        assert open(filtered_fhand.name).read() == '>s2\nAC\n'
+
         # with pairs
         fasta = '>s1.f\naCTg\n>s1.r\nAC\n>s2.f\naTg\n>s2.r\nAC\n'
         fasta += '>s3.f\naCTg\n>s3.r\nACTG\n'
@@ -216,6 +227,32 @@ class SeqListFilterTest(unittest.TestCase):
         assert '>s2\n' in result
         assert '>s1\n' not in result
 
+        # with an index
+        fasta_fhand = _make_fhand(fasta + '>s3\nGG\n')
+        list_fhand = _make_fhand('s3\ns1\n')
+        try:
+            result = check_output([filter_bin, '-x', '-l', list_fhand.name,
+                                   fasta_fhand.name])
+            assert result == '>s1\naCTg\n>s3\nGG\n'
+        finally:
+            os.remove(fasta_fhand.name + '.crumbs.idx')
+
+        # with an id index written once and reused
+        id_index_fhand = NamedTemporaryFile(suffix='.crumbs.ids')
+        result = check_output([filter_bin, '-l', list_fhand.name, '-i',
+                               id_index_fhand.name, fasta_fhand.name])
+        assert result == '>s1\naCTg\n>s3\nGG\n'
+        result = check_output([filter_bin, '-r', '-i', id_index_fhand.name,
+                               fasta_fhand.name])
+        assert result == '>s2\nAC\n'
+
+        # the id index can not be used with the seqs index
+        stderr = NamedTemporaryFile()
+        assert call([filter_bin, '-x', '-l', list_fhand.name, '-i',
+                     id_index_fhand.name, fasta_fhand.name], stderr=stderr)
+        assert '--id_index can not be used with --use_index' in \
+                                                    open(stderr.name).read()
+
 
 class QualityFilterTest(unittest.TestCase):
     'It tests the filtering by a quality threshold'
@@ -243,6 +280,24 @@ class QualityFilterTest(unittest.TestCase):
         passed = _seqs_to_names(filter_(seqs)[SEQS_PASSED])
         assert passed == ['seq1']
 
+        # with SeqItems
+        seq1 = SeqItem('seq1', ['@seq1\n', 'AAcTg\n', '+\n', 'KKIKI\n'])
+        seq1 = SeqWrapper(object=seq1, kind=SEQITEM, file_format='fastq')
+        seq2 = SeqItem('seq2', ['@seq2\n', 'AAcTg\n', '+\n', 'IIKIK\n'])
+        seq2 = SeqWrapper(object=seq2, kind=SEQITEM, file_format='fastq')
+        seqs = {SEQS_PASSED: [[seq1], [seq2]], SEQS_FILTERED_OUT: []}
+        filter_ = FilterByQuality(threshold=41)
+        passed = _seqs_to_names(filter_(seqs)[SEQS_PASSED])
+        assert passed == ['seq1']
+
+        # only the uppercase residues are averaged
+        filter_ = FilterByQuality(threshold=42, ignore_masked=True)
+        passed = _seqs_to_names(filter_(seqs)[SEQS_PASSED])
+        assert passed == ['seq1']
+        filter_ = FilterByQuality(threshold=40, ignore_masked=True)
+        passed = _seqs_to_names(filter_(seqs)[SEQS_PASSED])
+        assert passed == ['seq1', 'seq2']
+
     def test_filter_by_qual_bin(self):
         'It uses the filter_by_quality binary'
         filter_bin = os.path.join(BIN_DIR, 'filter_by_quality')
@@ -314,6 +369,16 @@ class BlastMatchFilterTest(unittest.TestCase):
         assert filter_packets[SEQS_PASSED] == []
         assert len(filter_packets[SEQS_FILTERED_OUT]) == 1
 
+        # several blasts for every packet
+        seq2 = SeqRecord(Seq('ATCATGTAGTTACACATGAACACACACATG'), id='seq2')
+        seq2 = SeqWrapper(object=seq2, kind=SEQRECORD, file_format=None)
+        seqs = {SEQS_PASSED: [[seq1], [seq2]], SEQS_FILTERED_OUT: []}
+        filter_ = FilterBlastMatch(blastdb, 'blastn', filters,
+                                   blast_processes=2, blast_threads=2)
+        filter_packets = filter_(seqs)
+        assert filter_packets[SEQS_PASSED] == [[seq2]]
+        assert filter_packets[SEQS_FILTERED_OUT] == [[seq1]]
+
     def test_filter_blast_bin(self):
         'It test the binary of the filter_by_blast'
         filter_bin = os.path.join(BIN_DIR, 'filter_by_blast')
@@ -344,6 +409,12 @@ class BlastMatchFilterTest(unittest.TestCase):
                                seq_fhand.name])
         assert 'CATGAACACACACAT' in result
 
+        # several blasts
+        result = check_output([filter_bin, '-b', blastdb, '-x', '1e-27',
+                               '--blast_processes', '2', '--blast_threads',
+                               '4', '-p', '2', seq_fhand.name])
+        assert 'CATGAACACACACAT' in result
+
         # fail if -a an -l given i in the command line
         stderr = NamedTemporaryFile()
         try:
@@ -497,6 +568,15 @@ class ComplexityFilterTest(unittest.TestCase):
         assert '>s1\n' in open(filtered_fhand.name).read()
         assert '>s2\n' in result
 
+        # the seqs too short to have a score pass without warnings
+        fasta_fhand = _make_fhand('>s3\nTTT\n>s4\nTTTTT\n' + fasta)
+        stderr = NamedTemporaryFile()
+        result = check_output([filter_bin, fasta_fhand.name], stderr=stderr)
+        assert '>s3\n' in result
+        assert '>s4\n' in result
+        assert '>s1\n' not in result
+        assert open(stderr.name).read() == ''
+
 
 class RpkmFilterTest(unittest.TestCase):
     def test_filter_by_read_count(self):
@@ -545,6 +625,84 @@ class BamFilterTest(unittest.TestCase):
         filtered_out = _seqs_to_names(new_filterpacket[SEQS_FILTERED_OUT])
         assert filtered_out == ['seq19', 'seq20', 'seq21', 'seq22']
 
+    @staticmethod
+    def _write_bam(reads):
+        'It writes a BAM with the given (name, mapq) reads, None is unmapped'
+        bam_fhand = NamedTemporaryFile(suffix='.bam')
+        header = {'HD': {'VN': '1.0', 'SO': 'queryname'},
+                  'SQ': [{'SN': 'ref', 'LN': 100}]}
+        bam = pysam.AlignmentFile(bam_fhand.name, 'wb', header=header)
+        for name, mapq in reads:
+            read = pysam.AlignedSegment()
+            read.query_name = name
+            read.query_sequence = 'ACT'
+            if mapq is None:
+                read.flag = 4
+                read.reference_id = -1
+            else:
+                read.reference_id = 0
+                read.reference_start = 1
+                read.mapping_quality = mapq
+                read.cigartuples = [(0, 3)]
+            bam.write(read)
+        bam.close()
+        return bam_fhand
+
+    def _filter_reads(self, filter_, names):
+        reads = [[SeqWrapper(SEQRECORD, SeqRecord(seq=Seq('ACT'), id=name),
+                             None)] for name in names]
+        packet = filter_({SEQS_PASSED: reads, SEQS_FILTERED_OUT: []})
+        return _seqs_to_names(packet[SEQS_PASSED])
+
+    def test_sorted_bam_filter(self):
+        'It filters the reads along with a BAM sorted by name'
+        bam1 = self._write_bam([('r1', 30), ('r1', 30), ('r2', None),
+                                ('r3', 5), ('r10', 30)])
+        bam2 = self._write_bam([('r01', 30), ('r2', 30), ('r20', 30)])
+        names = ['r01', 'r1', 'r2', 'r3', 'r4', 'r10', 'r11', 'r20']
+        expected = ['r01', 'r1', 'r2', 'r3', 'r10', 'r20']
+        filter_ = FilterByBam([bam1.name, bam2.name])
+        assert self._filter_reads(filter_, names) == expected
+        filter_ = FilterByBam([bam1.name, bam2.name], sorted_by_name=True)
+        assert self._filter_reads(filter_, names) == expected
+
+        # the mapq and the reverse are taken into account
+        filter_ = FilterByBam([bam1.name], min_mapq=10, sorted_by_name=True,
+                              reverse=True)
+        assert self._filter_reads(filter_, names) == ['r01', 'r2', 'r3', 'r4',
+                                                      'r11', 'r20']
+
+        # the cursors go on with the next packets
+        filter_ = FilterByBam([bam1.name], sorted_by_name=True)
+        assert self._filter_reads(filter_, ['r1', 'r2']) == ['r1']
+        assert self._filter_reads(filter_, ['r3', 'r4', 'r10']) == ['r3',
+                                                                    'r10']
+
+        # picard sorts the names lexicographically
+        bam = self._write_bam([('r10', 30), ('r2', 30)])
+        filter_ = FilterByBam([bam.name], sorted_by_name=True,
+                              name_order='lexicographic')
+        assert self._filter_reads(filter_, ['r1', 'r10', 'r2']) == ['r10',
+                                                                    'r2']
+
+    def test_unsorted_bam_filter(self):
+        'It fails if the reads or the BAM are not sorted by name'
+        bam = self._write_bam([('r1', 30), ('r3', 30)])
+        filter_ = FilterByBam([bam.name], sorted_by_name=True)
+        try:
+            self._filter_reads(filter_, ['r3', 'r1'])
+            self.fail('ItemsNotSortedError expected')
+        except ItemsNotSortedError:
+            pass
+
+        bam = self._write_bam([('r3', 30), ('r1', 30)])
+        filter_ = FilterByBam([bam.name], sorted_by_name=True)
+        try:
+            self._filter_reads(filter_, ['r1', 'r2', 'r4'])
+            self.fail('ItemsNotSortedError expected')
+        except ItemsNotSortedError:
+            pass
+
 
 class FilterBowtie2Test(unittest.TestCase):
     @staticmethod
@@ -651,6 +809,56 @@ class NsFilterTest(unittest.TestCase):
         assert '>s2\n' in result
 
 
+@unittest.skipIf(not NUMPY_AVAILABLE, 'NumPy is not installed')
+class BatchFilterTest(unittest.TestCase):
+    'It checks that the batch filters agree with the per seq filters'
+    @staticmethod
+    def _make_packet():
+        seed(1)
+        seqs = []
+        for idx in range(200):
+            length = choice([0, 3, 10, 40, 70, 150])
+            seq = ''.join(choice('ACGTacgtNn') for _ in range(length))
+            if idx % 7 == 0:
+                seq = 'N' * length
+            elif idx % 11 == 0:
+                seq = 'A' * length
+            quals = ''.join(choice('#5?FIJ') for _ in range(length))
+            name = 'seq{}.{}'.format(idx // 2, 'f' if idx % 2 else 'r')
+            lines = ['@' + name + '\n', seq + '\n', '+\n', quals + '\n']
+            seqs.append(SeqWrapper(SEQITEM, SeqItem(name, lines), 'fastq'))
+        return SeqBatch(seqs)
+
+    def test_batch_and_per_seq(self):
+        batch = self._make_packet()
+        filters = [FilterByLength(minimum=30), FilterByLength(maximum=60),
+                   FilterByLength(minimum=20, ignore_masked=True),
+                   FilterByQuality(threshold=25),
+                   FilterByQuality(threshold=25, ignore_masked=True),
+                   FilterDustComplexity(), FilterAllNs()]
+        settings = get_settings()
+        try:
+            for filter_ in filters:
+                for drags in (True, False):
+                    for reverse in (True, False):
+                        filter_.failed_drags_pair = drags
+                        filter_.reverse = reverse
+                        results = []
+                        for batch_filters in (True, False):
+                            settings['BATCH_FILTERS'] = batch_filters
+                            packets = seq_to_filterpackets(
+                                [batch], group_paired_reads=True)
+                            results.append(filter_(packets.next()))
+                        batch_res, seq_res = results
+                        for kind in (SEQS_PASSED, SEQS_FILTERED_OUT):
+                            assert batch_res[kind] == seq_res[kind]
+                        assert (batch_res[SEQ_BATCH] ==
+                                [seq for pair in seq_res[SEQS_PASSED]
+                                 for seq in pair])
+        finally:
+            settings['BATCH_FILTERS'] = True
+
+
 if __name__ == "__main__":
     #import sys; sys.argv = ['', 'DrawDistanceDistribution']
     unittest.main()
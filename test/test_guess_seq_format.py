@@ -20,6 +20,7 @@ from tempfile import NamedTemporaryFile
 from StringIO import StringIO
 
 from crumbs.utils.bin_utils import BIN_DIR
+from crumbs.settings import get_setting
 from crumbs.utils.file_formats import get_format, _guess_format
 from crumbs.exceptions import (UnknownFormatError, FileIsEmptyError,
                                UndecidedFastqVersionError)
@@ -191,6 +192,24 @@ GAAGGATCGATCGGCCTCGGCGGTGTTCCCAAAAATCTAAGAGCGTTTACTCCAAGCTTC''')
         fhand = StringIO(txt)
         assert _guess_format(fhand, True) == 'fastq'
 
+    def test_truncated_chunk(self):
+        'The last record of the peeked chunk is truncated'
+        record = '@read\n' + 'T' * 60 + '\n+\n' + 'f' * 60 + '\n'
+        chunk_size = get_setting('CHUNK_TO_GUESS_FASTQ_VERSION')
+        txt = record * (chunk_size // len(record) + 10)
+        # the chunk ends in the middle of a record
+        assert chunk_size % len(record)
+        assert _guess_format(StringIO(txt), True) == 'fastq-illumina'
+
+        # a malformed record is not ignored
+        malformed = '@read\n' + 'T' * 60 + '\n+\n' + 'f' * 50 + '\n'
+        fhand = StringIO(record * 10 + malformed + txt)
+        try:
+            _guess_format(fhand, True)
+            self.fail('UndecidedFastqVersionError expected')
+        except UndecidedFastqVersionError:
+            pass
+
 if __name__ == '__main__':
     #import sys;sys.argv = ['', 'SffExtractTest.test_items_in_gff']
     unittest.main()
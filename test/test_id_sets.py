@@ -0,0 +1,120 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import os
+import pickle
+import unittest
+
+from crumbs import id_sets
+from crumbs.id_sets import (create_id_set, write_id_index, HashedIdSet,
+                            MappedIdSet, ID_INDEX_EXTENSION)
+from crumbs.seq_batch import NUMPY_AVAILABLE
+from crumbs.settings import get_settings
+from crumbs.utils.file_utils import TemporaryDir
+from crumbs.exceptions import MalformedFile
+
+NAMES = ['read_{}'.format(index) for index in range(5000)]
+OTHERS = ['other_{}'.format(index) for index in range(5000)]
+
+
+class IdSetTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDir()
+        settings = get_settings()
+        self._settings = {key: settings[key] for key in ('MAX_IDS_IN_SET',
+                                                         'MAX_IDS_IN_MEMORY')}
+        self._numpy = id_sets.numpy
+
+    def tearDown(self):
+        self.temp_dir.close()
+        get_settings().update(self._settings)
+        id_sets.numpy = self._numpy
+
+    def _check_id_set(self, id_set):
+        assert len(id_set) == len(NAMES)
+        assert all(name in id_set for name in NAMES)
+        assert not any(name in id_set for name in OTHERS)
+
+    def test_kinds(self):
+        settings = get_settings()
+        settings['MAX_IDS_IN_SET'] = 10000
+        id_set = create_id_set(iter(NAMES))
+        assert isinstance(id_set, set)
+
+        settings['MAX_IDS_IN_SET'] = 100
+        if NUMPY_AVAILABLE:
+            id_set = create_id_set(NAMES + NAMES[:10])
+            assert isinstance(id_set, HashedIdSet)
+            self._check_id_set(id_set)
+
+        # on disk, sorted in several chunks
+        settings['MAX_IDS_IN_MEMORY'] = 1000
+        id_set = create_id_set(iter(NAMES))
+        assert isinstance(id_set, MappedIdSet)
+        self._check_id_set(id_set)
+        id_set.close()
+
+        # without numpy
+        id_sets.numpy = None
+        settings['MAX_IDS_IN_SET'] = 100
+        id_set = create_id_set(iter(NAMES))
+        assert isinstance(id_set, MappedIdSet)
+        self._check_id_set(id_set)
+        id_set.close()
+
+        assert create_id_set([]) == set()
+
+    def test_id_index(self):
+        index_fpath = os.path.join(self.temp_dir.name,
+                                   'names' + ID_INDEX_EXTENSION)
+        id_set = create_id_set(reversed(NAMES), index_fpath=index_fpath)
+        self._check_id_set(id_set)
+        id_set.close()
+
+        # the index can be reused and sent to other processes
+        id_set = MappedIdSet(index_fpath)
+        self._check_id_set(id_set)
+        id_set = pickle.loads(pickle.dumps(id_set))
+        self._check_id_set(id_set)
+
+        # the bloom filter is the same with and without numpy
+        id_sets.numpy = None
+        index_fpath2 = os.path.join(self.temp_dir.name, 'names2.ids')
+        write_id_index(NAMES, index_fpath2)
+        assert open(index_fpath).read() == open(index_fpath2).read()
+
+        # without bloom filter
+        write_id_index(NAMES, index_fpath2, bits_per_id=0)
+        id_set = MappedIdSet(index_fpath2)
+        self._check_id_set(id_set)
+        assert os.path.getsize(index_fpath2) < os.path.getsize(index_fpath)
+
+        # empty and wrong
+        write_id_index([], index_fpath2)
+        id_set = MappedIdSet(index_fpath2)
+        assert 'read_1' not in id_set
+        id_set.close()
+        self.assertRaises(ValueError, id_set._mapped_file.size)
+        open(index_fpath2, 'w').write('not an index')
+        self.assertRaises(MalformedFile, MappedIdSet, index_fpath2)
+
+
+if __name__ == '__main__':
+    #import sys;sys.argv = ['', 'IdSetTest.test_kinds']
+    unittest.main()
@@ -15,17 +15,24 @@
 
 import unittest
 import subprocess
+import sys
 import os.path
+from time import time
 from tempfile import NamedTemporaryFile
 
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.mapping import (get_or_create_bowtie2_index, _bowtie2_index_exists,
                             map_with_bowtie2, get_or_create_bwa_index,
                             _bwa_index_exists, map_with_bwamem,
-                            map_process_to_bam, sort_fastx_files)
+                            map_process_to_bam, sort_fastx_files,
+                            MappingSession, create_bowtie2_session)
 from crumbs.utils.file_utils import TemporaryDir
 from crumbs.utils.bin_utils import get_binary_path
-from crumbs.seq import get_name
+from crumbs.seq import get_name, SeqItem, SeqWrapper
+from crumbs.seqio import read_seqs
+from crumbs.utils.tags import SEQITEM
+from crumbs.exceptions import ExternalBinaryError
+from crumbs.settings import get_setting
 import pysam
 
 
@@ -78,6 +85,23 @@ class Bowtie2Test(unittest.TestCase):
         map_process_to_bam(bowtie2, bam_fhand.name)
         directory.close()
 
+    def test_bowtie2_session(self):
+        reference_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
+        reads_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fastq')
+        directory = TemporaryDir()
+        index_fpath = get_or_create_bowtie2_index(reference_fpath,
+                                                  directory.name)
+        seqs = list(read_seqs([open(reads_fpath)]))
+        session = create_bowtie2_session(index_fpath)
+        names = [get_name(seq) for seq in seqs]
+        for packet in (seqs[:3], seqs[3:]):
+            sam_lines = session.map_seqs(packet)
+            assert [line.split('\t')[0] for line in sam_lines] == names[:3]
+            names = names[3:]
+        assert session.header_lines[0].startswith('@HD')
+        session.close()
+        directory.close()
+
     def test_rev_compl_fragmented_reads(self):
         index_fpath = os.path.join(TEST_DATA_DIR, 'ref_example.fasta')
 
@@ -206,6 +230,112 @@ class Bwa2Test(unittest.TestCase):
         #    print aligned_read
 
 
+# It writes a SAM line for every fastq read, mapped if the read starts with an
+# A. The input and the output are fully buffered, like the mappers do.
+# it writes the reads in batches of the given number of reads and it exits
+# with the given status
+_FAKE_MAPPER = '''import sys
+batch_size, exit_status = int(sys.argv[1]), int(sys.argv[2])
+sys.stdout.write('@HD\\tVN:1.0\\n')
+lines, sam_lines = [], []
+for line in sys.stdin:
+    lines.append(line)
+    if len(lines) == 4:
+        name, seq = lines[0][1:].split()[0], lines[1].strip()
+        flag = 0 if seq[0] == 'A' else 4
+        sam_lines.append('\\t'.join([name, str(flag), '*', '0', '0', '*',
+                                      '*', '0', '0', seq,
+                                      lines[3].strip()]) + '\\n')
+        lines = []
+    if len(sam_lines) == batch_size:
+        sys.stdout.write(''.join(sam_lines))
+        sys.stdout.flush()
+        sam_lines = []
+sys.stdout.write(''.join(sam_lines))
+sys.exit(exit_status)
+'''
+
+
+def _create_seq(name, seq):
+    lines = ['@' + name + '\n', seq + '\n', '+\n', 'I' * len(seq) + '\n']
+    return SeqWrapper(SEQITEM, SeqItem(name, lines), 'fastq')
+
+
+class MappingSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.mapper_fhand = NamedTemporaryFile(suffix='.py')
+        self.mapper_fhand.write(_FAKE_MAPPER)
+        self.mapper_fhand.flush()
+
+    def tearDown(self):
+        self.mapper_fhand.close()
+
+    def _start_session(self, batch_size=1, exit_status=0, timeout=None):
+        cmd = [sys.executable, self.mapper_fhand.name, str(batch_size),
+               str(exit_status)]
+        return MappingSession(cmd, timeout=timeout)
+
+    def test_session(self):
+        session = self._start_session()
+        for packet_num in range(3):
+            seqs = [_create_seq('s{}_{}'.format(packet_num, num),
+                                'ACGT' if num % 2 else 'TTGG')
+                    for num in range(100)]
+            sam_lines = session.map_seqs(seqs)
+            assert len(sam_lines) == 100
+            fields = [line.split('\t') for line in sam_lines]
+            assert [field[0] for field in fields] == [get_name(seq)
+                                                      for seq in seqs]
+            assert fields[1][1] == '0' and fields[2][1] == '4'
+        assert session.map_seqs([]) == []
+        assert session.header_lines == ['@HD\tVN:1.0\n']
+        session.close()
+
+        # the mapper fails
+        session = MappingSession([sys.executable, '-c',
+                                  'import sys; sys.exit(1)'])
+        try:
+            session.map_seqs([_create_seq('s1', 'ACGT')])
+            self.fail('ExternalBinaryError expected')
+        except ExternalBinaryError:
+            pass
+
+    def test_mapper_buffers(self):
+        # the mapper keeps many more reads than the flush reads written at
+        # a time
+        batch_size = get_setting('MAPPING_SESSION_FLUSH_READS') * 20 + 7
+        session = self._start_session(batch_size=batch_size)
+        for packet_num in range(3):
+            seqs = [_create_seq('s{}_{}'.format(packet_num, num), 'ACGT')
+                    for num in range(10)]
+            sam_lines = session.map_seqs(seqs)
+            assert [line.split('\t')[0] for line in sam_lines] == \
+                                                [get_name(seq) for seq in seqs]
+        session.close()
+
+    def test_exit_status(self):
+        # the mapper fails once all the reads have been mapped
+        session = self._start_session(exit_status=1)
+        assert len(session.map_seqs([_create_seq('s1', 'ACGT')])) == 1
+        try:
+            session.close()
+            self.fail('ExternalBinaryError expected')
+        except ExternalBinaryError:
+            pass
+
+    def test_timeout(self):
+        # the mapper reads the reads, but it does not write them
+        cmd = [sys.executable, '-c', 'import sys; sys.stdin.read()']
+        session = MappingSession(cmd, timeout=1)
+        start = time()
+        try:
+            session.map_seqs([_create_seq('s1', 'ACGT')])
+            self.fail('RuntimeError expected')
+        except RuntimeError, error:
+            assert 'did not map the reads in 1 seconds' in str(error)
+        assert time() - start < 30
+
+
 class SortSeqsFileTest(unittest.TestCase):
     def test_sort_by_position_in_ref(self):
         index_fpath = os.path.join(TEST_DATA_DIR, 'ref_example.fasta')
@@ -0,0 +1,134 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+from __future__ import division
+
+import unittest
+
+from crumbs.oligo_matcher import OligoMatcher, _align_in_band
+from crumbs.seq import SeqItem, SeqWrapper
+from crumbs.utils.tags import SEQITEM
+
+OLIGO = 'AAGCAGTGGTATCAACGCAGAGTACATGGG'
+SEQ = 'CCAAAGTACGGTCTCCCAAGCGGTCTCTTACCGGACACCGTCACCGATTTCACCCTCT'
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+def _create_seq(name, seq):
+    return SeqWrapper(SEQITEM, SeqItem(name, ['>' + name + '\n', seq + '\n']),
+                      'fasta')
+
+
+def _reverse_complement(seq):
+    return ''.join(COMPLEMENT[base] for base in reversed(seq))
+
+
+class AlignmentTest(unittest.TestCase):
+    def test_banded_alignment(self):
+        # score, query start and end, subject start and end, identities and
+        # columns
+        assert _align_in_band('ACGTACGT', 'TTACGTACGTTT', 0, 4) == (8, 0, 7,
+                                                                  2, 9, 8, 8)
+        # a mismatch
+        assert _align_in_band('ACGTACGTAAAAAAA', 'ACGTTCGTAAAAAAA', -1,
+                              1) == (11, 0, 14, 0, 14, 14, 15)
+        # a gap
+        alignment = _align_in_band('ACGTACGTACGTACGTACGT',
+                                   'ACGTACGTACGGTACGTACGT', -2, 2)
+        assert alignment == (13, 0, 19, 0, 20, 20, 21)
+        # the band does not reach the match
+        assert _align_in_band('ACGTACGT', 'TTTTTTTTTTACGTACGT', 0, 2)[0] == 1
+        assert _align_in_band('AAAA', 'CCCCCCCC', 0, 2) is None
+
+
+class OligoMatcherTest(unittest.TestCase):
+    def test_match(self):
+        seqs = [_create_seq('seq', SEQ), _create_seq('oligo_end', SEQ + OLIGO),
+                _create_seq('rev', SEQ[:20] + _reverse_complement(OLIGO) +
+                            SEQ[20:])]
+        matcher = OligoMatcher([_create_seq('oligo', OLIGO)])
+        matcher.match_seqs(seqs)
+        assert matcher.get_matched_segments_for_read('seq') is None
+        segments = matcher.get_matched_segments_for_read('oligo_end')
+        assert segments == ([(58, 87)], False)
+        segments = matcher.get_matched_segments_for_read('rev')
+        assert segments == ([(20, 49)], False)
+
+        # the match parts have the blast coordinates
+        match_part = matcher._match_parts['rev'][0]
+        assert match_part['query_start'] == 0
+        assert match_part['query_end'] == 29
+        assert match_part['subject_start'] == 49
+        assert match_part['subject_end'] == 20
+
+        # the previous matches are forgotten
+        matcher.match_seqs(seqs[:1])
+        assert matcher.get_matched_segments_for_read('oligo_end') is None
+
+    def test_filters(self):
+        # an oligo with a mismatch every 6 bases has not enough identity
+        mutated = list(OLIGO)
+        for index in range(2, len(mutated), 6):
+            mutated[index] = COMPLEMENT[mutated[index]]
+        seqs = [_create_seq('mutated', SEQ + ''.join(mutated)),
+                _create_seq('short', SEQ + OLIGO[:12]),
+                _create_seq('one_mismatch', SEQ + OLIGO[:15] + 'T' +
+                            OLIGO[16:])]
+        matcher = OligoMatcher([_create_seq('oligo', OLIGO)])
+        matcher.match_seqs(seqs)
+        assert matcher.get_matched_segments_for_read('mutated') is None
+        assert matcher.get_matched_segments_for_read('short') is None
+        segments = matcher.get_matched_segments_for_read('one_mismatch')
+        assert segments == ([(58, 87)], False)
+        match_part = matcher._match_parts['one_mismatch'][0]
+        assert match_part['scores'] == {'score': 26, 'identity': 29 / 30 * 100}
+
+        # the expect depends on the number of reads
+        seqs = [_create_seq('partial', SEQ + OLIGO[:16])]
+        matcher.match_seqs(seqs)
+        assert matcher.get_matched_segments_for_read('partial')
+        seqs += [_create_seq('seq{}'.format(num), SEQ) for num in range(1000)]
+        matcher.match_seqs(seqs)
+        assert matcher.get_matched_segments_for_read('partial') is None
+
+    def test_elongation(self):
+        seqs = [_create_seq('partial', SEQ + OLIGO[:25] + 'CC')]
+        matcher = OligoMatcher([_create_seq('oligo', OLIGO)],
+                               elongate_for_global=True)
+        matcher.match_seqs(seqs)
+        segments = matcher.get_matched_segments_for_read('partial')
+        assert segments == ([(58, 84)], False)
+        assert matcher._match_parts['partial'][0]['elongated'] == 2
+
+        seqs = [_create_seq('partial', OLIGO[10:] + SEQ)]
+        matcher.match_seqs(seqs)
+        segments = matcher.get_matched_segments_for_read('partial')
+        assert segments == ([(0, 19)], False)
+
+        # the match already covers the whole oligo
+        seqs = [_create_seq('partial', SEQ + OLIGO[:18] + 'C' + OLIGO[19:])]
+        matcher.match_seqs(seqs)
+        segments = matcher.get_matched_segments_for_read('partial')
+        assert segments == ([(58, 87)], False)
+        assert 'elongated' not in matcher._match_parts['partial'][0]
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'OligoMatcherTest']
+    unittest.main()
@@ -0,0 +1,197 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import unittest
+import os.path
+from subprocess import check_output, Popen, PIPE
+from tempfile import NamedTemporaryFile
+
+from crumbs.pipeline import (parse_step, create_pipeline_steps, Pipeline,
+                             seq_to_pipeline_packets, PipelineReport)
+from crumbs.filters import FilterByLength
+from crumbs.trim import (TrimEdges, TrimOrMask, TrimByQuality,
+                         Trim3PrimeAdapters)
+from crumbs.seqio import read_seq_packets
+from crumbs.seq import get_str_seq, get_name
+from crumbs.utils.bin_utils import BIN_DIR
+from crumbs.utils.tags import (SEQS_PASSED, SEQS_FILTERED_OUT, ORPHAN_SEQS,
+                               PIPELINE_STATS)
+from crumbs.settings import get_setting
+
+FASTQ = '@s1.f\nAACCGGTTAACCGGTT\n+\nIIIIIIIIIIIIIIII\n'
+FASTQ += '@s1.r\nACGTACGTAC\n+\nIIIIIIIIII\n'
+FASTQ += '@s2.f\nAACCGGTTAACCGGTTAA\n+\nIIIIIIIIIIIIIIIIII\n'
+FASTQ += '@s2.r\nAACCGGTTAACCGGTTAAC\n+\nIIIIIIIIIIIIIIIIIII\n'
+FASTQ += '@s3.f\nAACC\n+\nIIII\n'
+
+
+def _make_fhand(content=''):
+    'It makes temporary fhands'
+    fhand = NamedTemporaryFile()
+    fhand.write(content)
+    fhand.flush()
+    return fhand
+
+
+def _get_names(pairs):
+    return [get_name(seq) for pair in pairs for seq in pair]
+
+
+class StepParsingTest(unittest.TestCase):
+    'It tests the parsing of the steps'
+    def test_parse_step(self):
+        name, klass, kwargs = parse_step('trim_edges(left=3, right=2)')
+        assert name == 'trim_edges'
+        assert klass is TrimEdges
+        assert kwargs == {'left': 3, 'right': 2}
+
+        assert parse_step('FilterByLength') == ('FilterByLength',
+                                                FilterByLength, {})
+        # the crumb defaults
+        kwargs = parse_step('trim_quality(window=3)')[2]
+        assert kwargs == {'window': 3, 'threshold':
+                          get_setting('DEFAULT_QUALITY_TRIM_TRESHOLD')}
+
+        step = "trim_nextera_adapters(adapters=['CTGTCTCTTATACACATCT'])"
+        name, klass, kwargs = parse_step(step)
+        assert klass is Trim3PrimeAdapters
+        assert kwargs == {'adapters': ['CTGTCTCTTATACACATCT']}
+
+        for step in ('foo', 'trim_edges(3)', 'trim_edges(left=a)',
+                     'os.system("ls")', 'FilterByLength(', 'SeqItem()'):
+            self.assertRaises(ValueError, parse_step, step)
+
+    def test_create_steps(self):
+        steps = create_pipeline_steps(['trim_edges(left=1)',
+                                       'trim_quality', 'trim_or_mask',
+                                       'FilterByLength(minimum=3)'],
+                                      mask=True, failed_drags_pair=False)
+        names = [name for name, _ in steps]
+        assert names == ['trim_edges', 'trim_or_mask', 'trim_quality',
+                         'trim_or_mask', 'FilterByLength']
+        assert steps[1][1].mask
+        assert not steps[3][1].mask
+        assert isinstance(steps[2][1], TrimByQuality)
+        assert isinstance(steps[3][1], TrimOrMask)
+        assert not steps[4][1].failed_drags_pair
+
+        self.assertRaises(ValueError, create_pipeline_steps,
+                          ['FilterByLength(foo=3)'])
+
+
+class PipelineTest(unittest.TestCase):
+    'It tests the pipeline of filters and trimmers'
+    @staticmethod
+    def test_pipeline():
+        steps = create_pipeline_steps(['trim_edges(left=1, right=1)',
+                                       'filter_by_length(minimum=10)'])
+        pipeline = Pipeline(steps)
+        seqs = read_seq_packets([_make_fhand(FASTQ)])
+        packets = list(seq_to_pipeline_packets(seqs,
+                                               group_paired_reads=True))
+        packet = pipeline(packets[0])
+        assert _get_names(packet[SEQS_PASSED]) == ['s2.f', 's2.r']
+        assert _get_names(packet[SEQS_FILTERED_OUT]) == ['s1.f', 's1.r',
+                                                         's3.f']
+        assert get_str_seq(packet[SEQS_PASSED][0][0]) == 'ACCGGTTAACCGGTTA'
+        assert not packet[ORPHAN_SEQS]
+
+        stats = packet[PIPELINE_STATS]
+        assert [step_stats[:4] for step_stats in stats] == [(5, 5, 0, 0),
+                                                            (5, 5, 0, 0),
+                                                            (5, 2, 3, 0)]
+        report = PipelineReport([name for name, _ in steps])
+        report.add_packet_stats(stats)
+        report.add_packet_stats(stats)
+        step_stats = report.get_step_stats()[2]
+        assert step_stats[0] == 'filter_by_length'
+        assert step_stats[1]['seqs_in'] == 10
+        assert step_stats[1]['seqs_filtered_out'] == 6
+        assert 'filter_by_length' in report.get_report()
+
+    @staticmethod
+    def test_orphans():
+        steps = create_pipeline_steps(['trim_edges(left=6, right=6)',
+                                       'filter_by_length(minimum=5)'])
+        pipeline = Pipeline(steps)
+        seqs = read_seq_packets([_make_fhand(FASTQ)])
+        packets = seq_to_pipeline_packets(seqs, group_paired_reads=True)
+        packet = pipeline(list(packets)[0])
+        # s1.r is trimmed completely, so s1.f is an orphan
+        assert [get_name(seq) for seq in packet[ORPHAN_SEQS]] == ['s1.f']
+        assert _get_names(packet[SEQS_PASSED]) == ['s2.f', 's2.r']
+        assert _get_names(packet[SEQS_FILTERED_OUT]) == ['s3.f']
+        assert packet[PIPELINE_STATS][1][:4] == (5, 3, 0, 1)
+
+
+class PipelineBinTest(unittest.TestCase):
+    'It tests the crumbs_pipeline binary'
+    def test_bin(self):
+        pipeline_bin = os.path.join(BIN_DIR, 'crumbs_pipeline')
+        assert 'usage' in check_output([pipeline_bin, '-h'])
+
+        fastq_fhand = _make_fhand(FASTQ)
+        filtered_fhand = NamedTemporaryFile()
+        report_fhand = NamedTemporaryFile()
+        steps = ['-s', 'trim_edges(left=1, right=1)', '-s',
+                 'filter_by_length(minimum=10)']
+        result = check_output([pipeline_bin, fastq_fhand.name, '-e',
+                               filtered_fhand.name, '--report',
+                               report_fhand.name] + steps)
+        assert result.startswith('@s1.f\nACCGGTTAACCGGT\n+\n')
+        assert '@s2.f\n' in result
+        assert '@s1.r' not in result
+        assert '@s1.r\nCGTACGTA\n' in open(filtered_fhand.name).read()
+        assert 'filter_by_length' in open(report_fhand.name).read()
+
+        # the same result as the piped crumbs and with several processes
+        trim_bin = os.path.join(BIN_DIR, 'trim_edges')
+        length_bin = os.path.join(BIN_DIR, 'filter_by_length')
+        trim = Popen([trim_bin, '-l', '1', '-r', '1', fastq_fhand.name],
+                     stdout=PIPE)
+        piped_result = check_output([length_bin, '-n', '10'],
+                                    stdin=trim.stdout)
+        trim.wait()
+        assert result == piped_result
+        result2 = check_output([pipeline_bin, fastq_fhand.name, '-p', '2',
+                                '--report', report_fhand.name] + steps)
+        assert result2 == result
+
+        # paired reads and steps from a file
+        steps_fhand = _make_fhand('-s\ntrim_edges(left=6, right=6)\n')
+        orphan_fhand = NamedTemporaryFile()
+        result = check_output([pipeline_bin, fastq_fhand.name,
+                               '@' + steps_fhand.name, '--paired_reads',
+                               '--orphan_file', orphan_fhand.name,
+                               '--report', report_fhand.name])
+        assert '@s1.f' not in result
+        assert '@s2.r' in result
+        assert '@s1.f' in open(orphan_fhand.name).read()
+
+        # wrong steps
+        stderr = NamedTemporaryFile()
+        self.assertRaises(Exception, check_output,
+                          [pipeline_bin, fastq_fhand.name, '-s', 'foo'],
+                          stderr=stderr)
+        assert 'Unknown filter or trimmer' in open(stderr.name).read()
+
+
+if __name__ == '__main__':
+    #import sys;sys.argv = ['', 'PipelineTest.test_pipeline']
+    unittest.main()
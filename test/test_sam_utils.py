@@ -21,7 +21,8 @@
 import unittest
 
 from crumbs.utils.sam import (bit_tags_to_int_flag, int_flag_to_bit_tags,
-                              IS_PAIRED, IS_IN_PROPER_PAIR)
+                              IS_PAIRED, IS_IN_PROPER_PAIR,
+                              iter_sam_mapped_names, natural_name_key)
 
 
 class FlagTests(unittest.TestCase):
@@ -38,6 +39,26 @@ class FlagTests(unittest.TestCase):
         assert IS_IN_PROPER_PAIR in int_flag_to_bit_tags(1 | 2)
 
 
+class MappedNamesTests(unittest.TestCase):
+    def test_sam_mapped_names(self):
+        sam = ['@HD\tVN:1.0\tSO:unsorted\n',
+               '@SQ\tSN:ref\tLN:100\n',
+               'read1\t0\tref\t1\t40\t3M\t*\t0\t0\tACT\t###\n',
+               'read2\t4\t*\t0\t0\t*\t*\t0\t0\tACT\t###\n',
+               'read3\t16\tref\t5\t10\t3M\t*\t0\t0\tACT\t###\n',
+               'read3\t256\tref\t9\t0\t3M\t*\t0\t0\tACT\t###\n']
+        names = list(iter_sam_mapped_names(sam))
+        assert names == ['read1', 'read3', 'read3']
+        assert list(iter_sam_mapped_names(sam, min_mapq=10)) == ['read1']
+
+    def test_natural_name_key(self):
+        # the order of samtools sort -n
+        names = ['r10', 'r2', 'r1', 'r01', 'a', 'r1:2', 'r1:10', 'r1_1']
+        names.sort(key=natural_name_key)
+        assert names == ['a', 'r01', 'r1', 'r1:2', 'r1:10', 'r1_1', 'r2',
+                         'r10']
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'ComplexityFilterTest']
     unittest.main()
\ No newline at end of file
@@ -18,10 +18,17 @@
 # pylint: disable=C0111
 
 import unittest
+import pickle
+
+from array import array
 
 from crumbs.seq import (get_length, get_str_seq, get_int_qualities,
-        get_str_qualities, slice_seq, copy_seq, SeqItem, SeqWrapper)
-from crumbs.utils.tags import SEQITEM, ILLUMINA_QUALITY
+        get_str_qualities, slice_seq, copy_seq, SeqItem, SeqWrapper,
+        get_packet_int_qualities, get_packet_str_qualities,
+        _int_quals_to_str_quals, get_name, get_title, get_annotations,
+        CompactSeqItem, compact_seqs, get_view_cache_stats,
+        reset_view_cache_stats)
+from crumbs.utils.tags import SEQITEM, ILLUMINA_QUALITY, SANGER_QUALITY
 
 
 class SeqMethodsTest(unittest.TestCase):
@@ -105,6 +112,57 @@ class SeqMethodsTest(unittest.TestCase):
         seq = SeqWrapper(SEQITEM, seq, 'fastq-illumina')
         assert get_str_qualities(seq, 'fastq') == '!"""####'
 
+    def test_quality_codec(self):
+        sanger = ''.join(chr(code) for code in range(33, 127))
+        seq = SeqItem(name='seq', lines=['@seq\n', 'a' * 94 + '\n', '+\n',
+                                         sanger + '\n'])
+        seq = SeqWrapper(SEQITEM, seq, 'fastq')
+        quals = get_int_qualities(seq)
+        assert isinstance(quals, array)
+        assert list(quals) == range(94)
+        assert _int_quals_to_str_quals(quals, SANGER_QUALITY) == sanger
+        assert _int_quals_to_str_quals(range(94), SANGER_QUALITY) == sanger
+
+        # qualities above 62 can not be encoded in the illumina format
+        try:
+            get_str_qualities(seq, ILLUMINA_QUALITY)
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+        try:
+            _int_quals_to_str_quals([30, 300], SANGER_QUALITY)
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+        # an invalid illumina character
+        seq = SeqItem(name='seq', lines=['@seq\n', 'aa\n', '+\n', '@!\n'])
+        seq = SeqWrapper(SEQITEM, seq, 'fastq-illumina')
+        try:
+            get_int_qualities(seq)
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+    def test_packet_qualities(self):
+        seq1 = SeqItem(name='s1', lines=['@s1\n', 'aaaa\n', '+\n', '!???\n'])
+        seq1 = SeqWrapper(SEQITEM, seq1, 'fastq')
+        seq2 = SeqItem(name='s2', lines=['@s2\n', 'aa\n', '+\n', '+5\n'])
+        seq2 = SeqWrapper(SEQITEM, seq2, 'fastq')
+        seq3 = SeqItem(name='s3', lines=['@s3\n', 'aaa\n', '+\n', '@AB\n'])
+        seq3 = SeqWrapper(SEQITEM, seq3, 'fastq-illumina')
+        seqs = [seq1, seq2, seq3]
+
+        quals = get_packet_int_qualities(seqs)
+        assert [list(qual) for qual in quals] == [[0, 30, 30, 30], [10, 20],
+                                                  [0, 1, 2]]
+        assert get_packet_str_qualities(seqs) == ['!???', '+5', '@AB']
+        quals = get_packet_str_qualities(seqs, ILLUMINA_QUALITY)
+        assert quals == ['@^^^', 'JT', '@AB']
+        assert quals == [get_str_qualities(seq, ILLUMINA_QUALITY)
+                                                               for seq in seqs]
+        assert get_packet_str_qualities(seqs, 'fastq')[2] == '!"#'
+
     def test_slice(self):
         # with fasta
         seq = SeqItem(name='s1', lines=['>s1\n', 'ACTGGTAC\n'])
@@ -179,6 +237,59 @@ class SeqMethodsTest(unittest.TestCase):
         assert seq.object == ('seq2', ['>seq2\n', 'aaaa\n'],
                               {})
 
+    def test_compact_seqitem(self):
+        seqitem = SeqItem(name='seq', lines=['@seq desc\n', 'aaaa\n', '+\n',
+                                             '!???\n'])
+        seqs = [SeqWrapper(SEQITEM, seqitem, 'fastq')]
+        seq = list(compact_seqs(seqs))[0]
+        assert isinstance(seq.object, CompactSeqItem)
+        assert seq.object._annotations is None
+        assert seq.object == seqitem
+        assert get_name(seq) == 'seq'
+        assert get_title(seq) == 'seq desc'
+        assert get_str_seq(seq) == 'aaaa'
+        assert get_str_qualities(seq) == '!???'
+        assert list(get_int_qualities(seq)) == [0, 30, 30, 30]
+        assert get_str_seq(slice_seq(seq, 1, 3)) == 'aa'
+        seq2 = copy_seq(seq, name='seq2')
+        assert seq2.object.lines == ['@seq2\n', 'aaaa\n', '+\n', '!???\n']
+        get_annotations(seq)['a'] = 'b'
+        assert seq.object.annotations == {'a': 'b'}
+        assert pickle.loads(pickle.dumps(seq.object, 2)) == seq.object
+
+        # lines with more than one newline require offsets
+        seqitem = SeqItem(name='s1', lines=['>s1\n', 'ACTG\nGTAC\n'])
+        seq = CompactSeqItem.from_seqitem(seqitem)
+        assert seq._offsets is not None
+        assert seq.lines == ['>s1\n', 'ACTG\nGTAC\n']
+        assert seq.get_buffer() == '>s1\nACTG\nGTAC\n'
+
+    def test_derived_view_cache(self):
+        reset_view_cache_stats()
+        seq = SeqItem(name='seq', lines=['@seq\n', 'aaaa\n', '+\n',
+                                         '!???\n'])
+        seq = SeqWrapper(SEQITEM, seq, 'fastq')
+        quals = get_int_qualities(seq)
+        assert get_int_qualities(seq) is quals
+        stats = get_view_cache_stats()['int_qualities']
+        assert stats['hits'] == 1 and stats['misses'] == 1
+        assert stats['hit_rate'] == 0.5
+
+        # the copies and the slices have their own values
+        assert list(get_int_qualities(slice_seq(seq, 1, 3))) == [30, 30]
+        assert get_int_qualities(copy_seq(seq)) is not quals
+        assert get_view_cache_stats()['int_qualities']['misses'] == 3
+
+        # the cache depends on the format
+        seq = SeqWrapper(SEQITEM, seq.object, 'fastq-illumina')
+        self.assertRaises(ValueError, get_int_qualities, seq)
+
+        # the compact SeqItems are not cached
+        seq = list(compact_seqs([SeqWrapper(SEQITEM, seq.object, 'fastq')]))[0]
+        assert get_int_qualities(seq) is not get_int_qualities(seq)
+        reset_view_cache_stats()
+        assert not get_view_cache_stats()
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'SeqMethodsTest.test_int_qualities']
     unittest.main()
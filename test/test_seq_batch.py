@@ -0,0 +1,95 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import unittest
+import pickle
+
+from crumbs.seq import SeqItem, SeqWrapper, get_str_seq
+from crumbs.seq_batch import SeqBatch, create_seq_batches, NUMPY_AVAILABLE
+from crumbs.utils.tags import SEQITEM
+
+
+def _make_seq(name, seq, quals=None):
+    if quals is None:
+        return SeqWrapper(SEQITEM, SeqItem(name, ['>' + name + '\n',
+                                                  seq + '\n']), 'fasta')
+    lines = ['@' + name + '\n', seq + '\n', '+\n', quals + '\n']
+    return SeqWrapper(SEQITEM, SeqItem(name, lines), 'fastq')
+
+
+@unittest.skipIf(not NUMPY_AVAILABLE, 'NumPy is not installed')
+class SeqBatchTest(unittest.TestCase):
+    'It tests the columnar seq packets'
+    @staticmethod
+    def test_columns():
+        seqs = [_make_seq('s1', 'ACGT', '!!5?'), _make_seq('s2', '', ''),
+                _make_seq('s3', 'aaN', 'III')]
+        batch = SeqBatch(seqs)
+        assert batch == seqs
+        assert batch.seqs.tostring() == 'ACGTaaN'
+        assert list(batch.offsets) == [0, 4, 4, 7]
+        assert list(batch.lengths) == [4, 0, 3]
+        assert list(batch.quals) == [0, 0, 20, 30, 40, 40, 40]
+        assert list(batch.sum_per_seq(batch.quals)) == [50, 0, 120]
+
+        # no qualities
+        batch = SeqBatch([_make_seq('s1', 'ACGT')])
+        try:
+            batch.quals
+            raise AssertionError('AttributeError expected')
+        except AttributeError:
+            pass
+
+    @staticmethod
+    def test_take():
+        seqs = [_make_seq('s1', 'ACGT', '!!5?'), _make_seq('s2', 'C', '5'),
+                _make_seq('s3', 'aaN', 'III')]
+        batch = SeqBatch(seqs)
+        assert list(batch.take([True, False, True]).lengths) == [4, 3]
+
+        batch.quals
+        subset = batch.take([False, True, True])
+        assert [get_str_seq(seq) for seq in subset] == ['C', 'aaN']
+        assert subset.seqs.tostring() == 'CaaN'
+        assert list(subset.offsets) == [0, 1, 4]
+        assert list(subset.quals) == [20, 40, 40, 40]
+
+        assert not batch.take([False, False, False])
+
+    @staticmethod
+    def test_pickle():
+        batch = SeqBatch([_make_seq('s1', 'ACGT', '!!5?')])
+        batch.quals
+        batch2 = pickle.loads(pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+        assert isinstance(batch2, SeqBatch)
+        assert batch2 == batch
+        assert not batch2._columns
+        assert batch2.seqs.tostring() == 'ACGT'
+
+    @staticmethod
+    def test_create_batches():
+        packets = [[_make_seq('s1', 'AC')], [_make_seq('s2', 'G')]]
+        batches = list(create_seq_batches(packets))
+        assert all(isinstance(batch, SeqBatch) for batch in batches)
+        assert batches == packets
+
+
+if __name__ == '__main__':
+    #import sys;sys.argv = ['', 'SeqBatchTest.test_take']
+    unittest.main()
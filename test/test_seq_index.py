@@ -0,0 +1,109 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import os
+import unittest
+
+from crumbs.seq_index import (SeqFileIndex, get_seqs_by_name,
+                              _scan_fastx_records, INDEX_EXTENSION)
+from crumbs.utils.file_utils import TemporaryDir
+from crumbs.seq import get_name, get_str_seq
+from crumbs.exceptions import MalformedFile
+
+FASTQ = '@seq1 desc\nACTG\n+\n!!!!\n@seq2\nAC\nTG\n+\n!!\n!!\n\n@seq3\nA\n+\n!\n'
+
+
+class SeqIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDir()
+
+    def tearDown(self):
+        self.temp_dir.close()
+
+    def _make_file(self, content, fname='seqs'):
+        fpath = os.path.join(self.temp_dir.name, fname)
+        fhand = open(fpath, 'w')
+        fhand.write(content)
+        fhand.close()
+        return fpath
+
+    def test_scan_records(self):
+        fpath = self._make_file(FASTQ)
+        records = list(_scan_fastx_records(open(fpath)))
+        assert [record[0] for record in records] == ['seq1', 'seq2', 'seq3']
+        for name, start, length in records:
+            assert FASTQ[start:start + length].startswith('@' + name)
+        assert FASTQ[records[1][1]:sum(records[1][1:])].endswith('!!\n!!\n')
+
+        fpath = self._make_file('>s1\nAC\nTG\n\n>s2\nAA')
+        assert list(_scan_fastx_records(open(fpath))) == [('s1', 0, 11),
+                                                         ('s2', 11, 6)]
+        fpath = self._make_file('@s1\nACTG\n+\n!!!!!\n')
+        try:
+            list(_scan_fastx_records(open(fpath)))
+            self.fail('MalformedFile expected')
+        except MalformedFile:
+            pass
+
+    def test_index(self):
+        fpath = self._make_file(FASTQ)
+        index = SeqFileIndex(fpath)
+        assert index.index_fpath == fpath + INDEX_EXTENSION
+        assert len(index) == 3
+        assert 'seq2' in index
+        assert 'seq4' not in index
+        assert get_str_seq(index['seq2']) == 'ACTG'
+        assert index['seq1'].object.lines[0] == '@seq1 desc\n'
+        try:
+            index['seq4']
+            self.fail('KeyError expected')
+        except KeyError:
+            pass
+        index.close()
+
+        # the seqs are returned in the file order
+        seqs = get_seqs_by_name(fpath, ['seq3', 'seq4', 'seq1'])
+        assert [get_name(seq) for seq in seqs] == ['seq1', 'seq3']
+
+        # the index is rebuilt when the file changes
+        index_mtime = os.stat(fpath + INDEX_EXTENSION).st_mtime
+        os.utime(fpath, (index_mtime - 10, index_mtime - 10))
+        fhand = open(fpath, 'a')
+        fhand.write('@seq4\nGG\n+\n!!\n')
+        fhand.close()
+        index = SeqFileIndex(fpath)
+        assert len(index) == 4
+        assert get_str_seq(index['seq4']) == 'GG'
+        index.close()
+
+    def test_fasta_index(self):
+        fasta = '>s1\nACTG\nAA\n>s2\nGG\n>s1\nTT'
+        fpath = self._make_file(fasta, 'seqs.fasta')
+        index_fpath = os.path.join(self.temp_dir.name, 'other.idx')
+        index = SeqFileIndex(fpath, index_fpath=index_fpath)
+        assert [get_str_seq(seq) for seq in index.get_seqs('s1')] == ['ACTGAA',
+                                                                      'TT']
+        assert index.file_format == 'fasta'
+        assert os.path.exists(index_fpath)
+        index.close()
+
+
+if __name__ == '__main__':
+    #import sys;sys.argv = ['', 'SeqIndexTest.test_index']
+    unittest.main()
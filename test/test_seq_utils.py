@@ -27,11 +27,19 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
 from crumbs.utils.bin_utils import BIN_DIR
-from crumbs.utils.file_utils import fhand_is_seekable, wrap_in_buffered_reader
+from crumbs.utils.file_utils import (fhand_is_seekable, TemporaryDir,
+                                     wrap_in_buffered_reader)
 from crumbs.utils.seq_utils import (uppercase_length, ChangeCase,
-                                    get_uppercase_segments)
+                                    get_uppercase_segments,
+                                    get_record_aligned_ranges,
+                                    process_seq_files, _scatter_seq_files,
+                                    _get_scatterable_files,
+                                    process_seq_packets)
 from crumbs.utils.tags import SWAPCASE, UPPERCASE, LOWERCASE, SEQRECORD
 from crumbs.seq import assing_kind_to_seqs, get_str_seq
+from crumbs.seqio import (write_filter_packets, read_seq_packets,
+                          AdaptivePacketizer)
+from crumbs.filters import FilterByLength, seq_to_filterpackets
 
 
 class SeekableFileTest(unittest.TestCase):
@@ -142,6 +150,189 @@ class ChangeCaseTest(unittest.TestCase):
         assert '@seq1\nATCGT\n+' in result
 
 
+class _UnpicklableUppercase(object):
+    'It fails if it is sent to the workers with every packet'
+    def __reduce__(self):
+        raise RuntimeError('The pipeline should be sent once to the workers')
+
+    def __call__(self, seqs):
+        return [str_seq.upper() for str_seq in seqs]
+
+
+class _ClosableUppercase(object):
+    'It writes a file named with its process id when it is closed'
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+    def __call__(self, seqs):
+        return [str_seq.upper() for str_seq in seqs]
+
+    def close(self):
+        open(os.path.join(self.out_dir, str(os.getpid())), 'w').close()
+
+
+class ProcessSeqPacketsTest(unittest.TestCase):
+    def test_functions_installed_in_workers(self):
+        packets = [['ac', 'gT'], ['t'], ['Nn']]
+        upper = _UnpicklableUppercase()
+        for processes in (1, 2):
+            result, workers = process_seq_packets(iter(packets), [upper],
+                                                  processes=processes)
+            assert list(result) == [['AC', 'GT'], ['T'], ['NN']]
+            if workers is not None:
+                workers.close()
+                workers.join()
+
+    def test_functions_closed(self):
+        packets = [['ac'], ['t'], ['Nn'], ['g']]
+        for processes in (1, 2):
+            out_dir = TemporaryDir()
+            upper = _ClosableUppercase(out_dir.name)
+            result = process_seq_packets(iter(packets), [upper],
+                                         processes=processes)[0]
+            assert list(result) == [['AC'], ['T'], ['NN'], ['G']]
+            # the functions are closed in every process once all the packets
+            # have been processed
+            closed = os.listdir(out_dir.name)
+            if processes == 1:
+                assert closed == [str(os.getpid())]
+            else:
+                assert len(closed) == processes
+            out_dir.close()
+
+    def test_bounded_packets_in_flight(self):
+        read_packets = []
+
+        def packets():
+            for index in range(20):
+                read_packets.append(index)
+                yield [str(index)]
+
+        upper = _UnpicklableUppercase()
+        for keep_order in (True, False):
+            del read_packets[:]
+            result, workers = process_seq_packets(packets(), [upper],
+                                                  processes=2,
+                                                  keep_order=keep_order,
+                                                  max_packets_in_flight=3)
+            processed = []
+            for packet in result:
+                processed.extend(packet)
+                # the reading waits for the consumer
+                assert len(read_packets) - len(processed) <= 3
+            if keep_order:
+                assert processed == [str(index) for index in range(20)]
+            else:
+                assert sorted(processed, key=int) == [str(index)
+                                                      for index in range(20)]
+            assert result.stats['packets_sent'] == 20
+            assert result.stats['max_queue_depth'] == 3
+            assert result.stats['queue_depth'] == 0
+            workers.join()
+
+    def test_packet_costs(self):
+        fasta = ''.join('>s{}\nACTG\n'.format(idx) for idx in range(30))
+        for processes in (1, 2):
+            packetizer = AdaptivePacketizer(min_bytes=10, initial_bytes=30)
+            packets = read_seq_packets([StringIO(fasta)],
+                                       packetizer=packetizer)
+            packets = process_seq_packets(packets, [lambda seqs: seqs],
+                                          processes=processes,
+                                          packetizer=packetizer)[0]
+            assert sum(len(packet) for packet in packets) == 30
+            assert packetizer.secs_per_byte is not None
+            assert not packetizer._packet_bytes
+
+    def test_worker_error(self):
+        def packets():
+            yield ['a']
+            yield [1]
+
+        result, workers = process_seq_packets(packets(),
+                                              [_UnpicklableUppercase()],
+                                              processes=2)
+        try:
+            list(result)
+            self.fail('AttributeError expected')
+        except AttributeError:
+            workers.terminate()
+
+
+def _create_seq_file(records):
+    fhand = NamedTemporaryFile()
+    fhand.write(''.join(records))
+    fhand.flush()
+    return fhand
+
+
+class ScatterTest(unittest.TestCase):
+    # the quality lines starting with @ should not be taken as titles
+    fastq = ['@seq{0}\n{1}\n+\n@{2}\n'.format(index, 'A' * (index % 7 + 1),
+                                               '#' * (index % 7))
+             for index in range(100)]
+    fasta = ['>seq{0}\n{1}\n{1}\n'.format(index, 'A' * (index % 7 + 1))
+             for index in range(100)]
+
+    def test_record_aligned_ranges(self):
+        for records, file_format in ((self.fastq, 'fastq'),
+                                     (self.fasta, 'fasta')):
+            fhand = _create_seq_file(records)
+            content = open(fhand.name).read()
+            ranges = get_record_aligned_ranges(fhand.name, file_format, 7,
+                                               min_range_size=0)
+            assert len(ranges) == 7
+            assert ranges[0][0] == 0
+            assert ranges[-1][1] == len(content)
+            chunks = [content[start:end] for start, end in ranges]
+            assert ''.join(chunks) == content
+            for chunk in chunks:
+                assert chunk[0] == ('@' if file_format == 'fastq' else '>')
+                assert chunk in content
+                lines_in_record = 4 if file_format == 'fastq' else 3
+                assert chunk.count('\n') % lines_in_record == 0
+
+            # small files are not split
+            ranges = get_record_aligned_ranges(fhand.name, file_format, 7)
+            assert ranges == [(0, len(content))]
+
+    def test_scatter(self):
+        in_fhand = _create_seq_file(self.fastq)
+        filter_ = FilterByLength(minimum=4)
+        results = []
+        for processes in (1, 2):
+            passed_fhand = NamedTemporaryFile()
+            filtered_fhand = NamedTemporaryFile()
+            if processes == 1:
+                process_seq_files([open(in_fhand.name)], [filter_],
+                                  seq_to_filterpackets, write_filter_packets,
+                                  passed_fhand, filtered_fhand, 'fastq')
+            else:
+                seq_files = _get_scatterable_files([open(in_fhand.name)])
+                assert seq_files == [(in_fhand.name, 'fastq')]
+                _scatter_seq_files(seq_files, [filter_], seq_to_filterpackets,
+                                   write_filter_packets, passed_fhand,
+                                   filtered_fhand, 'fastq', processes,
+                                   {'size': 3}, min_range_size=0)
+            passed_fhand.flush()
+            filtered_fhand.flush()
+            results.append((open(passed_fhand.name).read(),
+                            open(filtered_fhand.name).read()))
+        assert results[0] == results[1]
+        assert results[0][0].count('@seq') == 56
+
+    def test_scatterable_files(self):
+        fhand = _create_seq_file(self.fasta)
+        assert _get_scatterable_files([open(fhand.name)])
+        # non seekable
+        assert _get_scatterable_files([wrap_in_buffered_reader(
+                            open(fhand.name), force_wrap=True)]) is None
+        # multiline fastq
+        fastq = ['@seq{0}\nAA\nAA\n+\nII\nII\n'.format(idx)
+                 for idx in range(3)]
+        fhand = _create_seq_file(fastq)
+        assert _get_scatterable_files([open(fhand.name)]) is None
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'ChangeCaseTest.test_bin']
     unittest.main()
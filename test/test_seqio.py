@@ -19,6 +19,7 @@
 
 import os
 import unittest
+import cPickle as pickle
 from  cStringIO import StringIO
 from tempfile import NamedTemporaryFile
 from subprocess import Popen, PIPE
@@ -30,9 +31,14 @@ from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.seqio import (guess_seq_type, fastaqual_to_fasta, seqio,
                           _write_seqrecords, _read_seqrecords,
-                          _itemize_fastx, read_seqs, write_seqs)
-from crumbs.utils.tags import SEQITEM, SEQRECORD
-from crumbs.exceptions import IncompatibleFormatError, MalformedFile
+                          _itemize_fastx, _itemize_fastx_blocks,
+                          _itemize_fastx_mmap, read_seqs, write_seqs,
+                          read_seq_packets, AdaptivePacketizer)
+from crumbs.seq import MappedSeqLines, get_str_seq, copy_seq
+from crumbs.utils.tags import (SEQITEM, SEQRECORD, LINE_READER, BLOCK_READER,
+                               MMAP_READER)
+from crumbs.exceptions import (IncompatibleFormatError, MalformedFile,
+                               FileIsEmptyError)
 
 
 FASTA = ">seq1\natctagtc\n>seq2\natctagtc\n>seq3\natctagtc\n"
@@ -107,6 +113,19 @@ class SeqIOTest(unittest.TestCase):
         except MalformedFile as error:
             assert 'Lengths of sequence and quality'  in str(error)
 
+        # several files in different formats
+        illumina = '@seq4\natcgt\n+\n^^^^^\n'
+        fasta = '>seq1\natcgt\n>seq2\natc\n\ngt'
+        out_fhand = StringIO()
+        seqio([self._make_fhand(FASTQ), self._make_fhand(illumina)],
+              out_fhand, 'fastq')
+        assert out_fhand.getvalue() == FASTQ + '@seq4\natcgt\n+\n?????\n'
+        out_fhand = StringIO()
+        seqio([self._make_fhand(fasta), self._make_fhand(FASTQ)], out_fhand,
+              'fasta')
+        expected = fasta + '\n>seq1\natcgt\n>seq2\natcgt\n>seq3\natcgt\n'
+        assert out_fhand.getvalue() == expected
+
         # genbank to fasta
         out_fhand = NamedTemporaryFile()
         genbank_fhand = open(os.path.join(TEST_DATA_DIR, 'sequence.gb'))
@@ -178,6 +197,94 @@ class SimpleIOTest(unittest.TestCase):
         assert seqs == [('s1', ['@s1\n', 'ACTGATTA\n', '+\n', '12341234\n'],
                          {})]
 
+    def test_block_itemizer(self):
+        'It tests the block itemizer against the line itemizer'
+        contents = ['>s1\nACTG\n>s2 desc\nACTG\n',
+                    '>s1\nACTG\nGTAC\n>s2 desc\nACTG\n',
+                    '>s1\nACTG\n\n>s2 desc\nACTG\n',
+                    '>s1\nAC\r\nGT\r\n>s2\nA',
+                    '>s1\nACTG \n>s2\nAC\n',
+                    '@s1\nACTG\n+\n1234\n@s2 desc\nACTG\n+\n4321\n',
+                    '@s1\nACTG\n+\n1234\n\n@s2 desc\nACTG\n+\n4321\n',
+                    '@s1\nACTG\n+s1\n1234\n@s2\nAC\n+\n12\n',
+                    # a multiline fastq after a singleline one
+                    '@s1\nACTG\n+\n1234\n@s2\nACTG\nAA\n+\n1234\n@@\n',
+                    '@s1\nACTG\nATTA\n+\n1234\n1234\n',
+                    '@s1\nACTG\n+\n1234\n' * 1100]
+        for content in contents:
+            expected = [(seq.name, list(seq.lines), seq.annotations)
+                        for seq in _itemize_fastx(StringIO(content))]
+            # small blocks to test the records split between blocks
+            for block_size in (1, 3, 7, 10000):
+                fhand = StringIO(content)
+                seqs = list(_itemize_fastx_blocks(fhand, block_size))
+                assert seqs == expected
+
+        # empty file
+        try:
+            list(_itemize_fastx_blocks(StringIO('\n\n'), 3))
+            self.fail('FileIsEmptyError expected')
+        except FileIsEmptyError:
+            pass
+
+        # truncated file
+        fhand = StringIO('@s1\nACTG\n+\n1234\n@s2\nAC\n+\n1')
+        try:
+            list(_itemize_fastx_blocks(fhand, 3))
+            self.fail('MalformedFile expected')
+        except MalformedFile:
+            pass
+
+        # the reader can be chosen
+        for reader in (LINE_READER, BLOCK_READER):
+            fhand = StringIO('>s1\nACTG\n>s2 desc\nACTG\n')
+            seqs = list(read_seqs([fhand], seqitem_reader=reader))
+            assert [seq.object.name for seq in seqs] == ['s1', 's2']
+
+    def test_mmap_itemizer(self):
+        'It tests the memory mapped itemizer'
+        contents = ['>s1\nACTG\n>s2 desc\nACTG\n',
+                    '>s1\nACTG\nGTAC\n>s2 desc\nACTG\n',
+                    '>s1\nACTG\n\nGTAC\n>s2 desc\nACTG\n',
+                    '>s1\nACTG \n>s2\nAC\n',
+                    '@s1\nACTG\n+\n1234\n\n@s2 desc\nACTG\n+\n4321\n',
+                    '@s1\nACTG\n+s1\n1234\n@s2\nAC\n+\n12\n',
+                    '@s1\nACTG\n+\n1234\n@s2\nACTG\nAA\n+\n1234\n@@\n',
+                    '@s1\nAC\n+\n12\n@s2\nAC\n+\n12']
+        for content in contents:
+            expected = list(_itemize_fastx_blocks(StringIO(content)))
+            fhand = NamedTemporaryFile()
+            fhand.write(content)
+            fhand.flush()
+            seqs = list(_itemize_fastx_mmap(open(fhand.name)))
+            assert seqs == expected
+
+        content = '@s1\nACTG\n+\n1234\n@s2 desc\nAC\n+\n12\n'
+        fhand = NamedTemporaryFile(suffix='.fastq')
+        fhand.write(content)
+        fhand.flush()
+        seqs = list(read_seqs([open(fhand.name)], seqitem_reader=MMAP_READER))
+        lines = seqs[0].object.lines
+        assert isinstance(lines, MappedSeqLines)
+        assert lines[1] == 'ACTG\n'
+        assert lines[-1] == '1234\n'
+        assert lines[:2] == ['@s1\n', 'ACTG\n']
+        assert get_str_seq(seqs[1]) == 'AC'
+        assert get_str_seq(copy_seq(seqs[1], seq='GT')) == 'GT'
+
+        # the records are written from the mapped file
+        out_fhand = StringIO()
+        write_seqs(seqs, out_fhand)
+        assert out_fhand.getvalue() == content
+
+        # when pickled the lines are copied
+        seq = pickle.loads(pickle.dumps(seqs[0], pickle.HIGHEST_PROTOCOL))
+        assert seq.object.lines == ['@s1\n', 'ACTG\n', '+\n', '1234\n']
+
+        # non seekable files are not mapped
+        seqs = list(read_seqs([StringIO(content)], seqitem_reader=MMAP_READER))
+        assert isinstance(seqs[0].object.lines, list)
+
     def test_seqitems_io(self):
         'It checks the different seq class streams IO'
         fhand = StringIO('>s1\nACTG\n>s2 desc\nACTG\n')
@@ -213,6 +320,69 @@ class SimpleIOTest(unittest.TestCase):
         assert fhand.getvalue() == '>s1\nACTG\n>s2 desc\nACTG\n'
 
 
+class AdaptivePacketizerTest(unittest.TestCase):
+    # every record has 21 bytes
+    fasta = ''.join('>s{:02d}\n{}\n'.format(idx, 'A' * 15)
+                    for idx in range(40))
+
+    def test_packets(self):
+        packetizer = AdaptivePacketizer(min_bytes=10, initial_bytes=50,
+                                        max_bytes=1000)
+        packets = list(read_seq_packets([StringIO(self.fasta)],
+                                        packetizer=packetizer))
+        # the second packet is bigger
+        assert [len(packet) for packet in packets[:3]] == [3, 5, 3]
+        assert sum(len(packet) for packet in packets) == 40
+        assert packetizer.stats['packets'] == len(packets)
+        assert packetizer.stats['bytes'] == len(self.fasta)
+        assert packetizer.stats['max_seqs'] == 5
+        assert 'Seq packets: 13' in packetizer.get_report()
+
+        # pairs are not split
+        packetizer = AdaptivePacketizer(min_bytes=10, initial_bytes=50,
+                                        max_bytes=1000, seqs_multiple=2)
+        packets = list(read_seq_packets([StringIO(self.fasta)],
+                                        packetizer=packetizer))
+        assert all(len(packet) % 2 == 0 for packet in packets)
+
+    def test_cost(self):
+        # without fixed cost the initial size is kept
+        packetizer = AdaptivePacketizer(target_secs=1, min_bytes=10,
+                                        initial_bytes=100, max_bytes=10000)
+        for index, size in enumerate((100, 200, 100)):
+            packetizer._packet_bytes[index] = size
+            packetizer.record_cost(index, size / 1000.)
+        assert abs(packetizer.fixed_secs) < 1e-9
+        assert packetizer.budget == 100
+
+        # unless the packets take longer than the target time
+        packetizer = AdaptivePacketizer(target_secs=0.05, min_bytes=10,
+                                        initial_bytes=100, max_bytes=10000)
+        for index, size in enumerate((100, 200, 100)):
+            packetizer._packet_bytes[index] = size
+            packetizer.record_cost(index, size / 1000.)
+        assert packetizer.budget == 50
+
+        # a big fixed cost makes the packets big
+        packetizer = AdaptivePacketizer(target_secs=1, min_bytes=10,
+                                        initial_bytes=100, max_bytes=100000,
+                                        max_overhead=0.1)
+        for index, size in enumerate((100, 200, 100)):
+            packetizer._packet_bytes[index] = size
+            packetizer.record_cost(index, 2 + size / 1000.)
+        assert abs(packetizer.fixed_secs - 2) < 1e-6
+        assert packetizer.budget == 18000
+
+        # the size is kept between the limits
+        packetizer = AdaptivePacketizer(target_secs=1, min_bytes=10,
+                                        initial_bytes=100, max_bytes=1000,
+                                        max_overhead=0.1)
+        for index, size in enumerate((100, 200)):
+            packetizer._packet_bytes[index] = size
+            packetizer.record_cost(index, 2 + size / 1000.)
+        assert packetizer.budget == 1000
+
+
 class PipingTest(unittest.TestCase):
     'It tests that we get no error when trying to write in a closed pipe'
     def test_write_closed_pipe(self):
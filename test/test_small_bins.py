@@ -132,6 +132,13 @@ class CatTest(unittest.TestCase):
         result = BZ2File(StringIO(result)).read()
         assert '\nACTATCATGGCAGATA\n' in  result
 
+        # compression level and threads
+        for threads in ('0', '2'):
+            cmd = [cat_bin, '-z', '--compression_level', '1',
+                   '--compression_threads', threads, in_fhand.name]
+            result = GzipFile(fileobj=StringIO(check_output(cmd))).read()
+            assert '\nACTATCATGGCAGATA\n' in  result
+
     def test_gzipped_input(self):
         'It can read compressed files'
         # we need a compressed file
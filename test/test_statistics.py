@@ -22,6 +22,8 @@ import unittest
 from subprocess import check_output
 from tempfile import NamedTemporaryFile
 import operator
+import random
+from collections import Counter
 
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
@@ -30,12 +32,15 @@ from crumbs.statistics import (IntCounter, draw_histogram_ascii, IntBoxplot,
                                calculate_sequence_stats, NuclFreqsPlot,
                                KmerCounter, calculate_dust_score,
                                calculate_nx, BestItemsKeeper,
-                               count_seqs)
+                               count_seqs, calculate_dust_scores)
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.seqio import read_seqs
 from crumbs.seq import SeqWrapper
+from crumbs.seq_batch import SeqBatch, NUMPY_AVAILABLE
 from crumbs.utils.tags import SEQRECORD, SEQITEM
+from crumbs.iterutils import rolling_window
+from crumbs.settings import get_setting
 
 
 class HistogramTest(unittest.TestCase):
@@ -211,6 +216,40 @@ class KmerCounterTest(unittest.TestCase):
         assert list(kmers.values) == [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2]
 
 
+def _calculate_rawscore(string):
+    'The dust raw score of a window as calculated by the first implementation'
+    triplet_counts = Counter()
+    for triplet in rolling_window(string, 3):
+        triplet_counts[triplet.upper()] += 1
+    return sum(tc * (tc - 1) * 0.5 for tc in triplet_counts.viewvalues())
+
+
+def _calculate_dust_score(seq):
+    'The dust score as calculated by the first implementation'
+    length = len(seq)
+    if length == 3:
+        return 0
+    if length <= 5:
+        return None
+    windowsize = get_setting('DUST_WINDOWSIZE')
+    windowstep = get_setting('DUST_WINDOWSTEP')
+    dustscores = []
+    if length > windowsize:
+        windows = 0
+        for seq_in_win in rolling_window(seq, windowsize, windowstep):
+            score = _calculate_rawscore(seq_in_win)
+            dustscores.append(score / (windowsize - 2))
+            windows += 1
+        remaining_seq = seq[windows * windowstep:]
+    else:
+        remaining_seq = seq
+    length = len(remaining_seq)
+    score = _calculate_rawscore(remaining_seq)
+    dustscore = score / (length - 3) * (windowsize - 2) / (length - 2)
+    dustscores.append(dustscore)
+    return sum(dustscores) / len(dustscores) * 100 / 31
+
+
 class DustCalculationTest(unittest.TestCase):
     'It calculates dust scores'
     @staticmethod
@@ -236,6 +275,43 @@ class DustCalculationTest(unittest.TestCase):
             seqrec = SeqWrapper(SEQRECORD, seqrec, None)
             assert calculate_dust_score(seqrec) - scorex4 < 0.01
 
+    @staticmethod
+    def test_dustscore_regression():
+        'The incremental dust scores are the ones of the first implementation'
+        random.seed(17)
+        alphabets = ['ACGT', 'ACGTacgt', 'ACGTNn', 'AT', 'ACGTNnRY-*']
+        for _ in range(2000):
+            alphabet = random.choice(alphabets)
+            length = random.choice([random.randint(0, 70),
+                                    random.randint(60, 400)])
+            if random.random() < 0.3:
+                # low complexity
+                seq = random.choice(alphabet) * length
+                seq = ''.join(random.choice(alphabet) if random.random() < 0.1
+                              else residue for residue in seq)
+            else:
+                seq = ''.join(random.choice(alphabet) for _ in range(length))
+            seqrec = SeqWrapper(SEQRECORD, SeqRecord(Seq(seq)), None)
+            assert calculate_dust_score(seqrec) == _calculate_dust_score(seq)
+
+    @unittest.skipIf(not NUMPY_AVAILABLE, 'NumPy is not installed')
+    def test_batch_dustscores(self):
+        'It calculates the dust scores of a SeqBatch'
+        seqs = ['TTTTTTTTTTTTTTTTTTTTTTTTTTTT', 'TATATATATATATATATATATATATATA',
+                'GAAGAAGAAGAAGAAGAAGAAGAAGAAG', 'AACTGCAGTCGATGCTGATTCGATCGAT',
+                'AACTGAAAAAAAATTTTTTTAAAAAAAA']
+        seqs = [seq * times for seq in seqs for times in (1, 3, 4)]
+        seqs += ['acgTTgcaNNgtcAAAAAAAAA' * 5, 'ACG', 'AC', 'ACGTA', '']
+        seqs = [SeqWrapper(SEQRECORD, SeqRecord(Seq(seq)), None)
+                for seq in seqs]
+        scores = calculate_dust_scores(SeqBatch(seqs))
+        for seq, score in zip(seqs, scores):
+            expected = calculate_dust_score(seq)
+            if expected is None:
+                assert score != score  # NaN
+            else:
+                assert abs(score - expected) < 1e-9
+
 
 class NxCalculationTest(unittest.TestCase):
     'It calculates N50 and N95'
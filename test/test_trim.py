@@ -24,7 +24,8 @@ from Bio.SeqRecord import SeqRecord
 
 from crumbs.trim import (TrimLowercasedLetters, TrimEdges, TrimOrMask,
                          TrimByQuality, TrimWithBlastShort,
-                         seq_to_trim_packets, TrimMatePairChimeras)
+                         seq_to_trim_packets, TrimMatePairChimeras,
+                         Trim3PrimeAdapters)
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.utils.tags import (SEQRECORD, SEQITEM, TRIMMING_RECOMMENDATIONS,
                                VECTOR, ORPHAN_SEQS, SEQS_PASSED, OTHER)
@@ -596,111 +597,83 @@ class TrimChimericRegions(unittest.TestCase):
         assert counts != 0
 
 
-# class TrimNexteraAdaptersTest(unittest.TestCase):
-#     def test_nextera_trimming(self):
-#         TODO: it is not working OK
-#         #check for seq_record. It does not work
-#         'It trims oligos using blast-short'
-#
-#         oligo1 = SeqRecord(Seq('AGATGTGTATAAGAGACAG'))
-#         oligo2 = SeqRecord(Seq('CTGTCTCTTATACACATCT'))
-#         oligo1 = SeqWrapper(SEQRECORD, oligo1, None)
-#         oligo2 = SeqWrapper(SEQRECORD, oligo2, None)
-#
-#         adaptors = [oligo1, oligo2]
-#
-#         blast_trim = TrimNexteraAdapters(oligos=adaptors)
-#         fhand = StringIO(FASTQ5)
-#         seq_packets = read_seq_packets([fhand],
-#                                             prefered_seq_classes=[SEQRECORD])
-#         trim_packets = list(seq_to_trim_packets(seq_packets))
-#         trim_packets2 = blast_trim(trim_packets[0])
-#         # It should trim the first and the second reads.
-#         res = [get_annotations(s).get(TRIMMING_RECOMMENDATIONS, {}).get(OTHER,
-#                                                                         [])
-#                             for l in trim_packets2[SEQS_PASSED] for s in l]
-#         assert res == [[(39, 100)], [(47, 100)], [], [(42, 60)]]
-#
-#         # With SeqItems
-#         oligo1 = SeqItem('oligo1', ['>oligo1\n', 'AGATGTGTATAAGAGACAG\n'])
-#         oligo2 = SeqItem('oligo2', ['>oligo2\n', 'CTGTCTCTTATACACATCT\n'])
-#         oligo1 = SeqWrapper(SEQITEM, oligo1, 'fasta')
-#         oligo2 = SeqWrapper(SEQITEM, oligo2, 'fasta')
-#
-#         adaptors = [oligo1, oligo2]
-#
-#         blast_trim = TrimNexteraAdapters(oligos=adaptors)
-#         fhand = StringIO(FASTQ5)
-#         seq_packets = list(read_seq_packets([fhand],
-#                                             prefered_seq_classes=[SEQITEM]))
-#         trim_packets = list(seq_to_trim_packets(seq_packets))
-#         trim_packets2 = blast_trim(trim_packets[0])
-#         # It should trim the first and the second reads.
-#         res = [get_annotations(s).get(TRIMMING_RECOMMENDATIONS, {}).get(OTHER,
-#                                                                         [])
-#                             for l in trim_packets2[SEQS_PASSED] for s in l]
-#         assert res == [[(39, 100)], [(47, 100)], [], [(42, 60)]]
-
-#     def test_trim_with_cutadapt(self):
-#         #TODO finish it by importing the cutadapt code or remove it
-#         in_fhand = NamedTemporaryFile(suffix='.fastq')
-#         in_fhand.write(FASTQ5)
-#         in_fhand.flush()
-#         out_fhand = NamedTemporaryFile()
-#         summary_fhand = NamedTemporaryFile()
-#
-#         oligos = {_3END: ['CTGTCTCTTATACACATCT', 'AGATGTGTATAAGAGACAG']}
-#         trim_with_cutadapt(in_fhand.name, out_fhand.name, oligos,
-#                            summary_fpath=summary_fhand.name)
-#         trimmed_reads = read_seqs([open(out_fhand.name)])
-#         read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
-#         read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
-#         expected_seqs = ['TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT', read3,
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA']
-#         for seq in trimmed_reads:
-#             assert get_str_seq(seq) in expected_seqs
-
-#     def xtest_trim_nextera_adapters_bin(self):
-#         'It tests the trim nextera adapters  binary'
-#          TODO finish it by importing the cutadapt code or remove it
-#         trim_bin = os.path.join(BIN_DIR, 'trim_nextera_adapters')
-#         assert 'usage' in check_output([trim_bin, '-h'])
-#
-#         with blast algorithm
-#         in_fhand = NamedTemporaryFile(suffix='.fastq')
-#         in_fhand.write(FASTQ5)
-#         in_fhand.flush()
-#         out_fhand = NamedTemporaryFile()
-#
-#         cmd = [trim_bin, in_fhand.name, '-o', out_fhand.name]
-#         check_output(cmd)
-#         trimmed_reads = read_seqs([open(out_fhand.name)])
-#         read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
-#         read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
-#         last read should no be trimmed this way, but keep 5 As more
-#         expected_seqs = ['TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT', read3,
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA',
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA']
-#         for seq in trimmed_reads:
-#             assert get_str_seq(seq) in expected_seqs
-#
-#         with cutadapt
-#         in_fhand = NamedTemporaryFile(suffix='.fastq')
-#         in_fhand.write(FASTQ5)
-#         in_fhand.flush()
-#         out_fhand = NamedTemporaryFile()
-#         summary_fhand = NamedTemporaryFile()
-#
-#         cmd = [trim_bin, in_fhand.name, '-o', out_fhand.name, '-c',
-#                '-s', summary_fhand.name]
-#         check_output(cmd)
-#         trimmed_reads = read_seqs([open(out_fhand.name)])
-#         read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
-#         read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
-#         expected_seqs = ['TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT', read3,
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA']
-#         for seq in trimmed_reads:
-#             assert get_str_seq(seq) in expected_seqs
+class Trim3PrimeAdaptersTest(unittest.TestCase):
+    'It tests the 3 prime adapter trimming'
+    def test_nextera_trimming(self):
+        'It trims the Nextera adapters'
+        oligo1 = SeqItem('oligo1', ['>oligo1\n', 'AGATGTGTATAAGAGACAG\n'])
+        oligo2 = SeqRecord(Seq('CTGTCTCTTATACACATCT'))
+        adapters = [SeqWrapper(SEQITEM, oligo1, 'fasta'),
+                    SeqWrapper(SEQRECORD, oligo2, None)]
+        for adapters in (adapters, None):
+            trim_adapters = Trim3PrimeAdapters(adapters=adapters)
+            fhand = StringIO(FASTQ5)
+            seq_packets = read_seq_packets([fhand],
+                                           prefered_seq_classes=[SEQITEM])
+            trim_packets = list(seq_to_trim_packets(seq_packets))
+            trim_packets2 = trim_adapters(trim_packets[0])
+            # the last read has only the adapter start
+            res = [get_annotations(s).get(TRIMMING_RECOMMENDATIONS,
+                                          {}).get(VECTOR, [])
+                   for l in trim_packets2[SEQS_PASSED] for s in l]
+            assert res == [[(39, 100)], [(47, 100)], [], [(47, 60)]]
+
+    def test_errors(self):
+        'It allows some errors in the adapters'
+        adapter = 'AGATGTGTATAAGAGACAG'
+        seqs = ['CCCCCCCCCC' + 'AGATGTGAATAAGAGACAG' + 'TTT',
+                'CCCCCCCCCC' + 'AGATGTGTATAAAGAGACAG',
+                'CCCCCCCCCC' + 'AGATCTGAATAAGAGACAG',
+                'CCCCCCCCCC' + 'AGAT', 'CCCCCCCCCC' + 'AG']
+        seqs = [SeqWrapper(SEQITEM, SeqItem('s' + str(index),
+                                            ['>s\n', seq + '\n']), 'fasta')
+                for index, seq in enumerate(seqs)]
+        trim_packet = {SEQS_PASSED: [[seq] for seq in seqs],
+                       ORPHAN_SEQS: []}
+        trim_adapters = Trim3PrimeAdapters(adapters=[adapter])
+        trim_packet = TrimOrMask()(trim_adapters(trim_packet))
+        res = [get_str_seq(s) for l in trim_packet[SEQS_PASSED] for s in l]
+        assert res == ['CCCCCCCCCC', 'CCCCCCCCCC',
+                       'CCCCCCCCCCAGATCTGAATAAGAGACAG', 'CCCCCCCCCC',
+                       'CCCCCCCCCCAG']
+
+        # with a higher error rate
+        trim_adapters = Trim3PrimeAdapters(adapters=[adapter], error_rate=0.2,
+                                           min_overlap=2)
+        trim_packet = {SEQS_PASSED: [[seq] for seq in seqs],
+                       ORPHAN_SEQS: []}
+        trim_packet = TrimOrMask()(trim_adapters(trim_packet))
+        res = [get_str_seq(s) for l in trim_packet[SEQS_PASSED] for s in l]
+        assert res == ['CCCCCCCCCC'] * 5
+
+    def test_trim_nextera_adapters_bin(self):
+        'It tests the trim nextera adapters binary'
+        trim_bin = os.path.join(BIN_DIR, 'trim_nextera_adapters')
+        assert 'usage' in check_output([trim_bin, '-h'])
+
+        in_fhand1 = _make_fhand(FASTQ5)
+        in_fhand2 = _make_fhand(FASTQ)
+        out_fhand = NamedTemporaryFile()
+        cmd = [trim_bin, in_fhand1.name, in_fhand2.name, '-o', out_fhand.name,
+               '-p', '2']
+        check_output(cmd)
+        trimmed_reads = [get_str_seq(seq)
+                         for seq in read_seqs([open(out_fhand.name)])]
+        read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
+        read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
+        assert trimmed_reads == ['T' * 39, 'A' * 47, read3, 'A' * 47,
+                                 'aTCgt', 'atcGT']
+
+        # with an adapter file
+        oligos_fhand = _make_fhand('AGATGTGTATAAGAGACAG\n')
+        cmd = [trim_bin, in_fhand1.name, '-o', out_fhand.name, '-l',
+               oligos_fhand.name]
+        check_output(cmd)
+        trimmed_reads = [get_str_seq(seq)
+                         for seq in read_seqs([open(out_fhand.name)])]
+        assert trimmed_reads[:2] == ['T' * 39,
+                                     'A' * 47 + 'CTGTCTCTTATACACATCT']
+
 
 if __name__ == '__main__':
     #import sys; sys.argv = ['', 'TrimChimericRegions']
@@ -20,9 +20,15 @@ import hashlib
 from subprocess import Popen, PIPE, check_output, CalledProcessError
 from tempfile import NamedTemporaryFile
 from cStringIO import StringIO
+from gzip import GzipFile
 
 from crumbs.utils.file_utils import (TemporaryDir, rel_symlink,
-                                     wrap_in_buffered_reader)
+                                     wrap_in_buffered_reader,
+                                     uncompress_if_required,
+                                     open_threaded_gzip, compress_fhand,
+                                     _ParallelBlockWriter)
+from crumbs.utils.tags import GZIP, BGZF, BZIP2
+from crumbs.utils.optional_modules import BgzfWriter
 from crumbs.utils.bin_utils import check_process_finishes, popen, BIN_DIR
 
 from crumbs.exceptions import ExternalBinaryError, MissingBinaryError
@@ -167,6 +173,85 @@ class ErrorHandlingTest(unittest.TestCase):
             stderr.close()
 
 
+class CompressedInputTest(unittest.TestCase):
+    'It tests the decompression of the input files'
+    @staticmethod
+    def _make_gzip(content, num_members=1):
+        fhand = NamedTemporaryFile(suffix='.gz')
+        member_len = len(content) // num_members + 1
+        for start in range(0, len(content), member_len):
+            gz_fhand = GzipFile(fileobj=fhand, mode='w')
+            gz_fhand.write(content[start:start + member_len])
+            gz_fhand.close()
+        fhand.flush()
+        return fhand
+
+    def test_threaded_gzip(self):
+        'It decompresses gzip files in a background thread'
+        content = ''.join('@seq%i\nACTG\n+\n#III\n' % i for i in range(5000))
+        for num_members in (1, 3):
+            fhand = self._make_gzip(content, num_members)
+            in_fhand = uncompress_if_required(open(fhand.name))
+            assert in_fhand.read() == content
+
+            # the decompressed file can be peeked and iterated
+            in_fhand = open_threaded_gzip(open(fhand.name))
+            assert in_fhand.peek(4).startswith('@seq')
+            assert in_fhand.name == fhand.name
+            assert ''.join(in_fhand) == content
+            assert get_format(open_threaded_gzip(open(fhand.name))) == 'fastq'
+
+        # a truncated file
+        fhand = self._make_gzip(content)
+        truncated = NamedTemporaryFile(suffix='.gz')
+        truncated.write(open(fhand.name).read()[:-100])
+        truncated.flush()
+        try:
+            open_threaded_gzip(open(truncated.name)).read()
+            self.fail('EOFError expected')
+        except EOFError:
+            pass
+
+    def test_parallel_bgzf(self):
+        'It decompresses the bgzf blocks in parallel'
+        content = ''.join('>seq%i\nACTGGTCA\n' % i for i in range(50000))
+        with NamedTemporaryFile(suffix='.bgz') as fhand:
+            bgzf_fhand = BgzfWriter(fhand.name)
+            bgzf_fhand.write(content)
+            bgzf_fhand.close()
+            for num_threads in (1, 3):
+                in_fhand = open_threaded_gzip(open(fhand.name),
+                                              num_threads=num_threads)
+                assert in_fhand.read() == content
+
+
+class CompressedOutputTest(unittest.TestCase):
+    'It tests the compression of the output files'
+    def test_parallel_compression(self):
+        'It compresses the blocks in parallel'
+        content = ''.join('>seq%i\nACTGGTCA\n' % i for i in range(50000))
+        for kind in (GZIP, BGZF, BZIP2):
+            for num_threads in (0, 3):
+                out_fhand = NamedTemporaryFile()
+                fhand = compress_fhand(open(out_fhand.name, 'w'), kind,
+                                       compression_level=1,
+                                       num_threads=num_threads)
+                for start in range(0, len(content), 1000):
+                    fhand.write(content[start:start + 1000])
+                fhand.close()
+                in_fhand = uncompress_if_required(open(out_fhand.name))
+                assert in_fhand.read() == content
+
+        # the gzip members are written in order
+        out_fhand = NamedTemporaryFile()
+        fhand = _ParallelBlockWriter(open(out_fhand.name, 'w'), GZIP,
+                                     level=6, num_threads=2, block_size=1000)
+        fhand.write(content)
+        fhand.write('>last\nACTG\n')
+        fhand.close()
+        assert GzipFile(out_fhand.name).read() == content + '>last\nACTG\n'
+
+
 class SettingsTest(unittest.TestCase):
     'It tests the get_settings function'
     def test_get_settings(self):